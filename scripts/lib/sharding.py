@@ -3,7 +3,7 @@ import json
 import os
 import subprocess
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
@@ -36,7 +36,9 @@ with open('/etc/zulip/nginx_sharding.conf.tmp', 'w') as nginx_sharding_conf_f, \
         sys.exit(0)
 
     nginx_sharding_conf_f.write("set $tornado_server http://tornado9800;\n")
-    shard_map: Dict[str, int] = {}
+    # A host listed under several ports is split between those Tornado
+    # processes by user ID; see zerver/tornado/sharding.py.
+    shard_map: Dict[str, List[int]] = {}
     external_host = subprocess.check_output([os.path.join(BASE_DIR, 'scripts/get-django-setting'),
                                              'EXTERNAL_HOST'],
                                             universal_newlines=True).strip()
@@ -48,9 +50,22 @@ with open('/etc/zulip/nginx_sharding.conf.tmp', 'w') as nginx_sharding_conf_f, \
                 host = shard
             else:
                 host = f"{shard}.{external_host}"
-            assert host not in shard_map, f"host {host} duplicated"
-            shard_map[host] = int(port)
-            write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
+            assert int(port) not in shard_map.get(host, []), f"host {host} duplicated"
+            if host not in shard_map:
+                # Requests not tied to an event queue go to the
+                # host's first port.
+                write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
+            shard_map.setdefault(host, []).append(int(port))
         nginx_sharding_conf_f.write('\n')
 
-    sharding_json_f.write(json.dumps(shard_map) + '\n')
+    if any(len(ports) > 1 for ports in shard_map.values()):
+        # Event queue IDs start with the port of the Tornado process
+        # holding them; route requests for a queue to that process.
+        nginx_sharding_conf_f.write("""if ($arg_queue_id ~ "^([0-9]+)_") {
+    set $tornado_server http://tornado$1;
+}\n""")
+
+    sharding_json_f.write(json.dumps({
+        host: ports[0] if len(ports) == 1 else ports
+        for host, ports in shard_map.items()
+    }) + '\n')
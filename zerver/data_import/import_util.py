@@ -5,6 +5,7 @@ import shutil
 from typing import (
     AbstractSet,
     Any,
+    BinaryIO,
     Callable,
     Dict,
     Iterable,
@@ -14,6 +15,7 @@ from typing import (
     Set,
     Tuple,
     TypeVar,
+    Union,
 )
 
 import orjson
@@ -711,3 +713,73 @@ def create_converted_data_files(data: Any, output_dir: str, file_path: str) -> N
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     with open(output_file, 'wb') as fp:
         fp.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+class RowSpool:
+    '''Rows that a conversion accumulates as it goes, like the reactions
+    to every message, kept in a temporary file of JSON lines rather than
+    in memory, so that the memory used doesn't grow with the length of
+    the history being converted.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.count = 0
+        self.file = open(path, 'wb')
+
+    def extend(self, rows: Iterable[ZerverFieldsT]) -> None:
+        for row in rows:
+            self.file.write(orjson.dumps(row) + b'\n')
+            self.count += 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[ZerverFieldsT]:
+        self.file.flush()
+        with open(self.path, 'rb') as f:
+            for line in f:
+                yield orjson.loads(line)
+
+    def batches(self, batch_size: int) -> Iterator[List[ZerverFieldsT]]:
+        batch: List[ZerverFieldsT] = []
+        for row in self:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self) -> None:
+        self.file.close()
+        os.remove(self.path)
+
+def write_json_rows(fp: BinaryIO, rows: Iterable[Any]) -> None:
+    fp.write(b'[')
+    for i, row in enumerate(rows):
+        fp.write(b',\n' if i else b'\n')
+        fp.write(orjson.dumps(row))
+    fp.write(b'\n]')
+
+def create_streamed_data_file(data: Union[RowSpool, Dict[str, Any]], output_dir: str,
+                              file_path: str) -> None:
+    '''Like create_converted_data_files, but writes the rows of any
+    RowSpool (either data itself, or one of its values) one at a time,
+    rather than loading them all into memory.
+    '''
+    output_file = output_dir + file_path
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'wb') as fp:
+        if isinstance(data, RowSpool):
+            write_json_rows(fp, data)
+            return
+
+        fp.write(b'{')
+        for i, (key, value) in enumerate(data.items()):
+            fp.write(b',\n' if i else b'\n')
+            fp.write(orjson.dumps(key) + b': ')
+            if isinstance(value, RowSpool):
+                write_json_rows(fp, value)
+            else:
+                fp.write(orjson.dumps(value))
+        fp.write(b'\n}\n')
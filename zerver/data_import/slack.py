@@ -1,8 +1,10 @@
+import itertools
 import logging
 import os
 import random
 import shutil
 import subprocess
+import tempfile
 from collections import defaultdict
 from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlencode
@@ -14,6 +16,7 @@ from django.forms.models import model_to_dict
 from django.utils.timezone import now as timezone_now
 
 from zerver.data_import.import_util import (
+    RowSpool,
     ZerverFieldsT,
     build_attachment,
     build_avatar,
@@ -27,6 +30,7 @@ from zerver.data_import.import_util import (
     build_usermessages,
     build_zerver_realm,
     create_converted_data_files,
+    create_streamed_data_file,
     make_subscriber_map,
     process_avatars,
     process_emojis,
@@ -56,6 +60,14 @@ AddedMPIMsT = Dict[str, Tuple[str, int]]
 DMMembersT = Dict[str, Tuple[str, str]]
 SlackToZulipRecipientT = Dict[str, int]
 
+# The number of messages we convert at a time.
+SLACK_MESSAGE_BATCH_SIZE = 100
+# We start a new messages-NNNNNN.json dump file after this many
+# UserMessage rows, even if it has fewer than chunk_size messages.
+MAX_USERMESSAGES_PER_DUMP_FILE = 200000
+# The number of uploads we download (and keep in memory) at a time.
+SLACK_UPLOAD_BATCH_SIZE = 10000
+
 def rm_tree(path: str) -> None:
     if os.path.exists(path):
         shutil.rmtree(path)
@@ -568,11 +580,16 @@ def convert_slack_workspace_messages(slack_data_dir: str, users: List[ZerverFiel
                                      zerver_userprofile: List[ZerverFieldsT],
                                      zerver_realmemoji: List[ZerverFieldsT], domain_name: str,
                                      output_dir: str,
-                                     chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> Tuple[List[ZerverFieldsT],
-                                                                                        List[ZerverFieldsT],
-                                                                                        List[ZerverFieldsT]]:
+                                     spool_dir: str,
+                                     chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> Tuple[RowSpool,
+                                                                                        RowSpool,
+                                                                                        RowSpool]:
     """
-    Returns:
+    Writes the messages to messages-NNNNNN.json files as it converts
+    them, so that (like get_messages_iterator) it never holds more than
+    a dump file's worth of messages in memory.
+
+    Returns, spooled to files in spool_dir:
     1. reactions, which is a list of the reactions
     2. uploads, which is a list of uploads to be mapped in uploads records.json
     3. attachment, which is a list of the attachments
@@ -585,46 +602,60 @@ def convert_slack_workspace_messages(slack_data_dir: str, users: List[ZerverFiel
     all_messages = get_messages_iterator(slack_data_dir, added_channels, added_mpims, dm_members)
     logging.info('######### IMPORTING MESSAGES STARTED #########\n')
 
-    total_reactions: List[ZerverFieldsT] = []
-    total_attachments: List[ZerverFieldsT] = []
-    total_uploads: List[ZerverFieldsT] = []
+    total_reactions = RowSpool(os.path.join(spool_dir, 'reactions.jsonl'))
+    total_attachments = RowSpool(os.path.join(spool_dir, 'attachments.jsonl'))
+    total_uploads = RowSpool(os.path.join(spool_dir, 'uploads.jsonl'))
 
     dump_file_id = 1
+    zerver_message: List[ZerverFieldsT] = []
+    zerver_usermessage: List[ZerverFieldsT] = []
 
     subscriber_map = make_subscriber_map(
         zerver_subscription=realm['zerver_subscription'],
     )
 
+    def write_dump_file() -> None:
+        nonlocal dump_file_id, zerver_message, zerver_usermessage
+        message_json = dict(
+            zerver_message=zerver_message,
+            zerver_usermessage=zerver_usermessage)
+
+        message_file = f"/messages-{dump_file_id:06}.json"
+        logging.info("Writing Messages to %s\n", output_dir + message_file)
+        create_converted_data_files(message_json, output_dir, message_file)
+
+        zerver_message = []
+        zerver_usermessage = []
+        dump_file_id += 1
+
+    # We convert the messages in small batches, so that we can start a
+    # new dump file as soon as the current one has enough messages or
+    # UserMessage rows; a batch of messages to a large channel can have
+    # thousands of UserMessage rows per message.
+    batch_size = min(chunk_size, SLACK_MESSAGE_BATCH_SIZE)
     while True:
-        message_data = []
-        _counter = 0
-        for msg in all_messages:
-            _counter += 1
-            message_data.append(msg)
-            if _counter == chunk_size:
-                break
+        message_data = list(itertools.islice(all_messages, batch_size))
         if len(message_data) == 0:
             break
 
-        zerver_message, zerver_usermessage, attachment, uploads, reactions = \
+        batch_message, batch_usermessage, attachment, uploads, reactions = \
             channel_message_to_zerver_message(
                 realm_id, users, slack_user_id_to_zulip_user_id, slack_recipient_name_to_zulip_recipient_id,
                 message_data, zerver_realmemoji, subscriber_map, added_channels, dm_members,
                 domain_name, long_term_idle)
 
-        message_json = dict(
-            zerver_message=zerver_message,
-            zerver_usermessage=zerver_usermessage)
+        zerver_message += batch_message
+        zerver_usermessage += batch_usermessage
+        total_reactions.extend(reactions)
+        total_attachments.extend(attachment)
+        total_uploads.extend(uploads)
 
-        message_file = f"/messages-{dump_file_id:06}.json"
-        logging.info("Writing Messages to %s\n", output_dir + message_file)
-        create_converted_data_files(message_json, output_dir, message_file)
+        if (len(zerver_message) >= chunk_size or
+                len(zerver_usermessage) >= MAX_USERMESSAGES_PER_DUMP_FILE):
+            write_dump_file()
 
-        total_reactions += reactions
-        total_attachments += attachment
-        total_uploads += uploads
-
-        dump_file_id += 1
+    if zerver_message:
+        write_dump_file()
 
     logging.info('######### IMPORTING MESSAGES FINISHED #########\n')
     return total_reactions, total_uploads, total_attachments
@@ -1080,10 +1111,14 @@ def do_convert_data(slack_zip_file: str, output_dir: str, token: str, threads: i
                                                  realm_subdomain, slack_data_dir,
                                                  custom_emoji_list)
 
+    # The rows we accumulate for the whole history are spooled to disk
+    # (next to output_dir, since there may be a lot of them).
+    spool_dir = tempfile.mkdtemp(prefix='slack-conversion-',
+                                 dir=os.path.dirname(os.path.abspath(output_dir)))
     reactions, uploads_list, zerver_attachment = convert_slack_workspace_messages(
         slack_data_dir, user_list, realm_id, slack_user_id_to_zulip_user_id,
         slack_recipient_name_to_zulip_recipient_id, added_channels, added_mpims, dm_members, realm,
-        realm['zerver_userprofile'], realm['zerver_realmemoji'], domain_name, output_dir)
+        realm['zerver_userprofile'], realm['zerver_realmemoji'], domain_name, output_dir, spool_dir)
 
     # Move zerver_reactions to realm.json file
     realm['zerver_reaction'] = reactions
@@ -1099,20 +1134,25 @@ def do_convert_data(slack_zip_file: str, output_dir: str, token: str, threads: i
 
     uploads_folder = os.path.join(output_dir, 'uploads')
     os.makedirs(os.path.join(uploads_folder, str(realm_id)), exist_ok=True)
-    uploads_records = process_uploads(uploads_list, uploads_folder, threads)
+    uploads_records = RowSpool(os.path.join(spool_dir, 'uploads_records.jsonl'))
+    for uploads_batch in uploads_list.batches(SLACK_UPLOAD_BATCH_SIZE):
+        uploads_records.extend(process_uploads(uploads_batch, uploads_folder, threads))
     attachment = {"zerver_attachment": zerver_attachment}
 
     team_info_dict = get_slack_api_data("https://slack.com/api/team.info", "team", token=token)
     realm_icons_folder = os.path.join(output_dir, 'realm_icons')
     realm_icon_records = fetch_team_icons(realm["zerver_realm"][0], team_info_dict, realm_icons_folder)
 
-    create_converted_data_files(realm, output_dir, '/realm.json')
+    create_streamed_data_file(realm, output_dir, '/realm.json')
     create_converted_data_files(emoji_records, output_dir, '/emoji/records.json')
     create_converted_data_files(avatar_records, output_dir, '/avatars/records.json')
-    create_converted_data_files(uploads_records, output_dir, '/uploads/records.json')
-    create_converted_data_files(attachment, output_dir, '/attachment.json')
+    create_streamed_data_file(uploads_records, output_dir, '/uploads/records.json')
+    create_streamed_data_file(attachment, output_dir, '/attachment.json')
     create_converted_data_files(realm_icon_records, output_dir, '/realm_icons/records.json')
 
+    for spool in [reactions, uploads_list, zerver_attachment, uploads_records]:
+        spool.close()
+    rm_tree(spool_dir)
     rm_tree(slack_data_dir)
     subprocess.check_call(["tar", "-czf", output_dir + '.tar.gz', output_dir, '-P'])
 
@@ -1,10 +1,9 @@
 import datetime
-import itertools
+import io
 import logging
 import os
 import time
 from collections import defaultdict
-from operator import itemgetter
 from typing import (
     AbstractSet,
     Any,
@@ -67,6 +66,8 @@ from zerver.lib.cache import (
     cache_with_key,
     delete_user_profile_caches,
     display_recipient_cache_key,
+    flush_realm_user_data,
+    flush_recipient_subscribers,
     flush_user_profile,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
@@ -107,6 +108,7 @@ from zerver.lib.pysa import mark_sanitized
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_data
+from zerver.lib.render_pool import RenderJob, bulk_render_markdown
 from zerver.lib.retention import move_messages_to_archive
 from zerver.lib.send_email import (
     FromAddress,
@@ -119,9 +121,14 @@ from zerver.lib.server_initialization import create_internal_realm, server_initi
 from zerver.lib.sessions import delete_user_sessions
 from zerver.lib.storage import static_path
 from zerver.lib.stream_recipient import StreamRecipientMap
+from zerver.lib.stream_recipient_info import (
+    RecipientUserRow,
+    get_recipient_user_rows,
+    get_stream_subscriber_info,
+)
+from zerver.lib.stream_subscribers import get_subscriber_ids_for_recipients
 from zerver.lib.stream_subscription import (
     get_active_subscriptions_for_stream_id,
-    get_active_subscriptions_for_stream_ids,
     get_bulk_stream_subscriber_info,
     get_stream_subscriptions_for_user,
     get_stream_subscriptions_for_users,
@@ -167,7 +174,7 @@ from zerver.lib.users import (
     get_api_key,
     user_profile_to_user_row,
 )
-from zerver.lib.utils import generate_api_key, log_statsd_event
+from zerver.lib.utils import generate_api_key, log_statsd_event, statsd
 from zerver.lib.validator import check_widget_content
 from zerver.lib.widget import do_widget_post_save_actions
 from zerver.models import (
@@ -224,7 +231,6 @@ from zerver.models import (
     get_user_by_id_in_realm_including_cross_realm,
     get_user_profile_by_id,
     is_cross_realm_bot_email,
-    query_for_ids,
     realm_filters_for_realm,
     stream_name_in_use,
     validate_attachment_request,
@@ -921,6 +927,7 @@ def do_deactivate_stream(stream: Stream, log: bool=True, acting_user: Optional[U
     affected_user_ids = can_access_stream_user_ids(stream)
 
     get_active_subscriptions_for_stream_id(stream.id).update(active=False)
+    flush_recipient_subscribers([stream.recipient_id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -1110,6 +1117,8 @@ def get_recipient_info(recipient: Recipient,
     stream_push_user_ids: Set[int] = set()
     stream_email_user_ids: Set[int] = set()
     wildcard_mention_user_ids: Set[int] = set()
+    known_user_rows: Dict[int, RecipientUserRow] = {}
+    known_user_ids: AbstractSet[int] = set()
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -1124,52 +1133,18 @@ def get_recipient_info(recipient: Recipient,
         assert(stream_topic is not None)
         user_ids_muting_topic = stream_topic.user_ids_muting_topic()
 
-        subscription_rows = stream_topic.get_active_subscriptions().annotate(
-            user_profile_email_notifications=F('user_profile__enable_stream_email_notifications'),
-            user_profile_push_notifications=F('user_profile__enable_stream_push_notifications'),
-            user_profile_wildcard_mentions_notify=F(
-                'user_profile__wildcard_mentions_notify'),
-        ).values(
-            'user_profile_id',
-            'push_notifications',
-            'email_notifications',
-            'wildcard_mentions_notify',
-            'user_profile_email_notifications',
-            'user_profile_push_notifications',
-            'user_profile_wildcard_mentions_notify',
-            'is_muted',
-        ).order_by('user_profile_id')
-
-        message_to_user_ids = [
-            row['user_profile_id']
-            for row in subscription_rows
-        ]
+        # This is usually served from a per-process snapshot, rather
+        # than the database; see zerver/lib/stream_recipient_info.py.
+        subscriber_info = get_stream_subscriber_info(recipient.id, stream_topic.stream_id)
+        message_to_user_ids = subscriber_info.subscriber_ids
+        known_user_rows = subscriber_info.user_rows
+        known_user_ids = subscriber_info.subscriber_id_set
 
-        def should_send(setting: str, row: Dict[str, Any]) -> bool:
-            # This implements the structure that the UserProfile stream notification settings
-            # are defaults, which can be overridden by the stream-level settings (if those
-            # values are not null).
-            if row['is_muted']:
-                return False
-            if row['user_profile_id'] in user_ids_muting_topic:
-                return False
-            if row[setting] is not None:
-                return row[setting]
-            return row['user_profile_' + setting]
-
-        stream_push_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_push_notify
-            if should_send('push_notifications', row)
-        }
-
-        stream_email_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_email_notify
-            if should_send('email_notifications', row)
-        }
+        # Note: muting a stream overrides stream_push_notify and
+        # stream_email_notify; the snapshot accounts for that, but not
+        # for muted topics.
+        stream_push_user_ids = subscriber_info.stream_push_user_ids - user_ids_muting_topic
+        stream_email_user_ids = subscriber_info.stream_email_user_ids - user_ids_muting_topic
 
         if possible_wildcard_mention:
             # If there's a possible wildcard mention, we need to
@@ -1182,11 +1157,9 @@ def get_recipient_info(recipient: Recipient,
             # determining whether this wildcard mention should be
             # treated as a mention (and follow the user's mention
             # notification preferences) or a normal message.
-            wildcard_mention_user_ids = {
-                row['user_profile_id']
-                for row in subscription_rows
-                if should_send("wildcard_mentions_notify", row)
-            }
+            wildcard_mention_user_ids = (
+                subscriber_info.wildcard_mention_user_ids - user_ids_muting_topic
+            )
 
     elif recipient.type == Recipient.HUDDLE:
         message_to_user_ids = get_huddle_user_ids(recipient)
@@ -1205,56 +1178,26 @@ def get_recipient_info(recipient: Recipient,
     # for our data structures not related to bots
     user_ids |= possibly_mentioned_user_ids
 
-    if user_ids:
-        query = UserProfile.objects.filter(
-            is_active=True,
-        ).values(
-            'id',
-            'enable_online_push_notifications',
-            'is_bot',
-            'bot_type',
-            'long_term_idle',
-        )
+    # The snapshot already has the rows for the stream's subscribers
+    # (and none for its deactivated ones), so we only need to query
+    # for any other possibly-mentioned users.
+    rows = [known_user_rows[user_id] for user_id in user_ids if user_id in known_user_rows]
+    rows += get_recipient_user_rows(user_ids - known_user_ids)
 
-        # query_for_ids is fast highly optimized for large queries, and we
-        # need this codepath to be fast (it's part of sending messages)
-        query = query_for_ids(
-            query=query,
-            user_ids=sorted(list(user_ids)),
-            field='id',
-        )
-        rows = list(query)
-    else:
-        # TODO: We should always have at least one user_id as a recipient
-        #       of any message we send.  Right now the exception to this
-        #       rule is `notify_new_user`, which, at least in a possibly
-        #       contrived test scenario, can attempt to send messages
-        #       to an inactive bot.  When we plug that hole, we can avoid
-        #       this `else` clause and just `assert(user_ids)`.
-        #
-        # UPDATE: It's February 2020 (and a couple years after the above
-        #         comment was written).  We have simplified notify_new_user
-        #         so that it should be a little easier to reason about.
-        #         There is currently some cleanup to how we handle cross
-        #         realm bots that is still under development.  Once that
-        #         effort is complete, we should be able to address this
-        #         to-do.
-        rows = []
-
-    def get_ids_for(f: Callable[[Dict[str, Any]], bool]) -> Set[int]:
+    def get_ids_for(f: Callable[[RecipientUserRow], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
         return {
-            row['id']
+            row.id
             for row in rows
             if f(row)
         } & message_to_user_id_set
 
-    def is_service_bot(row: Dict[str, Any]) -> bool:
-        return row['is_bot'] and (row['bot_type'] in UserProfile.SERVICE_BOT_TYPES)
+    def is_service_bot(row: RecipientUserRow) -> bool:
+        return row.is_bot and (row.bot_type in UserProfile.SERVICE_BOT_TYPES)
 
     active_user_ids = get_ids_for(lambda r: True)
     push_notify_user_ids = get_ids_for(
-        lambda r: r['enable_online_push_notifications'],
+        lambda r: r.enable_online_push_notifications,
     )
 
     # Service bots don't get UserMessage rows.
@@ -1263,7 +1206,7 @@ def get_recipient_info(recipient: Recipient,
     )
 
     long_term_idle_user_ids = get_ids_for(
-        lambda r: r['long_term_idle'],
+        lambda r: r.long_term_idle,
     )
 
     # These two bot data structures need to filter from the full set
@@ -1277,15 +1220,15 @@ def get_recipient_info(recipient: Recipient,
     # sure we have the data we need for that without extra database
     # queries.
     default_bot_user_ids = {
-        row['id']
+        row.id
         for row in rows
-        if row['is_bot'] and row['bot_type'] == UserProfile.DEFAULT_BOT
+        if row.is_bot and row.bot_type == UserProfile.DEFAULT_BOT
     }
 
     service_bot_tuples = [
-        (row['id'], row['bot_type'])
+        (row.id, row.bot_type)
         for row in rows
-        if is_service_bot(row)
+        if row.bot_type is not None and is_service_bot(row)
     ]
 
     info: RecipientInfoResult = dict(
@@ -1448,18 +1391,30 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['long_term_idle_user_ids'] = info['long_term_idle_user_ids']
         message['default_bot_user_ids'] = info['default_bot_user_ids']
         message['service_bot_tuples'] = info['service_bot_tuples']
+        message['wildcard_mention_user_ids'] = info['wildcard_mention_user_ids']
 
-        # Render our messages.
+    # Render our messages.  We render them as one batch, so that
+    # bulk_render_markdown can spread large batches across the render
+    # pool's processes, when one has been started.
+    render_jobs: List[RenderJob] = []
+    for message in messages:
         assert message['message'].rendered_content is None
-
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_user_ids'],
-            message['realm'],
+        sender = get_user_profile_by_id(message['message'].sender_id)
+        render_jobs.append(RenderJob(
+            content=message['message'].content,
+            realm=message['realm'],
+            sent_by_bot=sender.is_bot,
+            translate_emoticons=sender.translate_emoticons,
+            message=message['message'],
+            realm_alert_words_automaton=get_alert_word_automaton(message['realm']),
             mention_data=message['mention_data'],
             email_gateway=email_gateway,
-        )
+        ))
+    rendered_contents = bulk_render_markdown(render_jobs)
+
+    for message, rendered_content in zip(messages, rendered_contents):
+        if rendered_content is None:
+            raise JsonableError(_('Unable to render message'))
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = markdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -1473,9 +1428,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         # rendering determined the message had an actual wildcard
         # mention in it (and not e.g. wildcard mention syntax inside a
         # code block).
-        if message['message'].mentions_wildcard:
-            message['wildcard_mention_user_ids'] = info['wildcard_mention_user_ids']
-        else:
+        if not message['message'].mentions_wildcard:
             message['wildcard_mention_user_ids'] = []
 
         '''
@@ -1725,16 +1678,30 @@ def create_user_messages(message: Message,
 
     return user_messages
 
+# Above this many rows, bulk_insert_ums streams them to the database
+# with COPY rather than a multi-row INSERT.
+BULK_INSERT_UMS_COPY_THRESHOLD = 5000
+
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     '''
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    For messages to very large streams, we use COPY, which avoids
+    building and parsing a giant INSERT statement, and is several
+    times faster again.
     '''
     if not ums:
         return
 
+    if len(ums) >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_ums(ums)
+    else:
+        values_insert_ums(ums)
+
+def values_insert_ums(ums: List[UserMessageLite]) -> None:
     vals = [
         (um.user_profile_id, um.message_id, um.flags)
         for um in ums
@@ -1748,6 +1715,19 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     with connection.cursor() as cursor:
         execute_values(cursor.cursor, query, vals)
 
+def copy_insert_ums(ums: List[UserMessageLite]) -> None:
+    # All three columns are integers, so the default text format for
+    # COPY needs no quoting or escaping.
+    data = io.StringIO(''.join(
+        f"{um.user_profile_id}\t{um.message_id}\t{um.flags}\n"
+        for um in ums
+    ))
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(
+            "COPY zerver_usermessage (user_profile_id, message_id, flags) FROM STDIN",
+            data,
+        )
+
 def do_add_submessage(realm: Realm,
                       sender_id: int,
                       message_id: int,
@@ -2634,45 +2614,10 @@ def bulk_get_subscriber_user_ids(stream_dicts: Iterable[Mapping[str, Any]],
     if not recipient_ids:
         return result
 
-    '''
-    The raw SQL below leads to more than a 2x speedup when tested with
-    20k+ total subscribers.  (For large realms with lots of default
-    streams, this function deals with LOTS of data, so it is important
-    to optimize.)
-    '''
-
-    query = SQL('''
-        SELECT
-            zerver_subscription.recipient_id,
-            zerver_subscription.user_profile_id
-        FROM
-            zerver_subscription
-        INNER JOIN zerver_userprofile ON
-            zerver_userprofile.id = zerver_subscription.user_profile_id
-        WHERE
-            zerver_subscription.recipient_id in %(recipient_ids)s AND
-            zerver_subscription.active AND
-            zerver_userprofile.is_active
-        ORDER BY
-            zerver_subscription.recipient_id,
-            zerver_subscription.user_profile_id
-        ''')
-
-    cursor = connection.cursor()
-    cursor.execute(query, {"recipient_ids": tuple(recipient_ids)})
-    rows = cursor.fetchall()
-    cursor.close()
-
+    subscriber_ids = get_subscriber_ids_for_recipients(user_profile.realm_id, recipient_ids)
     recip_to_stream_id = stream_recipient.recipient_to_stream_id_dict()
-
-    '''
-    Using groupby/itemgetter here is important for performance, at scale.
-    It makes it so that all interpreter overhead is just O(N) in nature.
-    '''
-    for recip_id, recip_rows in itertools.groupby(rows, itemgetter(0)):
-        user_profile_ids = [r[1] for r in recip_rows]
-        stream_id = recip_to_stream_id[recip_id]
-        result[stream_id] = list(user_profile_ids)
+    for recip_id, user_profile_ids in subscriber_ids.items():
+        result[recip_to_stream_id[recip_id]] = user_profile_ids
 
     return result
 
@@ -2757,23 +2702,16 @@ def get_peer_user_ids_for_stream_change(stream: Stream,
         return set(active_non_guest_user_ids(stream.realm_id)) - set(altered_user_ids)
 
 def get_user_ids_for_streams(streams: Iterable[Stream]) -> Dict[int, List[int]]:
-    stream_ids = [stream.id for stream in streams]
-
-    all_subs = get_active_subscriptions_for_stream_ids(stream_ids).filter(
-        user_profile__is_active=True,
-    ).values(
-        'recipient__type_id',
-        'user_profile_id',
-    ).order_by(
-        'recipient__type_id',
-    )
-
-    get_stream_id = itemgetter('recipient__type_id')
+    streams_by_realm: Dict[int, List[Stream]] = defaultdict(list)
+    for stream in streams:
+        streams_by_realm[stream.realm_id].append(stream)
 
     all_subscribers_by_stream: Dict[int, List[int]] = defaultdict(list)
-    for stream_id, rows in itertools.groupby(all_subs, get_stream_id):
-        user_ids = [row['user_profile_id'] for row in rows]
-        all_subscribers_by_stream[stream_id] = user_ids
+    for realm_id, realm_streams in streams_by_realm.items():
+        subscriber_ids = get_subscriber_ids_for_recipients(
+            realm_id, [stream.recipient_id for stream in realm_streams])
+        for stream in realm_streams:
+            all_subscribers_by_stream[stream.id] = subscriber_ids[stream.recipient_id]
 
     return all_subscribers_by_stream
 
@@ -2849,6 +2787,8 @@ def bulk_add_subscriptions(streams: Iterable[Stream],
         Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
         sub_ids = [sub.id for (sub, stream) in subs_to_activate]
         Subscription.objects.filter(id__in=sub_ids).update(active=True)
+        flush_recipient_subscribers({sub.recipient_id for (sub, stream)
+                                     in subs_to_add + subs_to_activate})
         occupied_streams_after = list(get_occupied_streams(realm))
 
     # Log Subscription Activities in RealmAuditLog
@@ -3035,6 +2975,7 @@ def bulk_remove_subscriptions(users: Iterable[UserProfile],
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ) .update(active=False)
+        flush_recipient_subscribers({sub.recipient_id for (sub, stream) in subs_to_deactivate})
         occupied_streams_after = list(get_occupied_streams(our_realm))
 
     # Log Subscription Activities in RealmAuditLog
@@ -3972,14 +3913,45 @@ def do_update_user_activity(user_profile_id: int,
         activity.last_visit = log_time
         activity.save(update_fields=["last_visit", "count"])
 
-def send_presence_changed(user_profile: UserProfile, presence: UserPresence) -> None:
+def do_bulk_update_user_activity(
+    activity: Mapping[Tuple[int, int, str], Tuple[int, datetime.datetime]],
+) -> None:
+    """Equivalent to calling do_update_user_activity for each
+    (user_profile_id, client_id, query) -> (count, log_time) item,
+    but in a single INSERT ... ON CONFLICT DO UPDATE statement, which
+    is much faster for the large batches UserActivityWorker processes.
+    """
+    if not activity:
+        return
+
+    vals = [
+        (user_profile_id, client_id, query, count, log_time)
+        for (user_profile_id, client_id, query), (count, log_time) in activity.items()
+    ]
+    query = SQL('''
+        INSERT INTO
+            zerver_useractivity (user_profile_id, client_id, query, count, last_visit)
+        VALUES %s
+        ON CONFLICT (user_profile_id, client_id, query) DO UPDATE SET
+            count = zerver_useractivity.count + EXCLUDED.count,
+            last_visit = EXCLUDED.last_visit
+    ''')
+
+    with connection.cursor() as cursor:
+        execute_values(cursor.cursor, query, vals)
+    statsd.incr('user_activity', len(vals))
+
+def send_presence_changed(user_profile: UserProfile, presence: UserPresence,
+                          user_ids: Optional[List[int]]=None) -> None:
     presence_dict = presence.to_dict()
     event = dict(type="presence",
                  email=user_profile.email,
                  user_id=user_profile.id,
                  server_timestamp=time.time(),
                  presence={presence_dict['client']: presence_dict})
-    send_event(user_profile.realm, event, active_user_ids(user_profile.realm_id))
+    if user_ids is None:
+        user_ids = active_user_ids(user_profile.realm_id)
+    send_event(user_profile.realm, event, user_ids)
 
 def consolidate_client(client: Client) -> Client:
     # The web app reports a client as 'website'
@@ -4048,6 +4020,96 @@ def do_update_user_presence(user_profile: UserProfile,
         # realms are pretty small.
         send_presence_changed(user_profile, presence)
 
+def do_bulk_update_user_presence(
+    presence_updates: Sequence[Tuple[UserProfile, Client, datetime.datetime, int]],
+) -> None:
+    """Equivalent to calling do_update_user_presence for each
+    (user_profile, client, log_time, status) update, in log_time order,
+    but with a constant number of database queries.  Pings for the same
+    user and client are collapsed, so that we send at most one presence
+    event for each of them.
+    """
+    if not presence_updates:
+        return
+
+    pings: Dict[Tuple[int, int], List[Tuple[datetime.datetime, int]]] = defaultdict(list)
+    user_profiles: Dict[int, UserProfile] = {}
+    clients: Dict[int, Client] = {}
+    for user_profile, client, log_time, status in presence_updates:
+        client = consolidate_client(client)
+        user_profiles[user_profile.id] = user_profile
+        clients[client.id] = client
+        pings[(user_profile.id, client.id)].append((log_time, status))
+
+    existing_presences = {
+        (presence.user_profile_id, presence.client_id): presence
+        for presence in UserPresence.objects.filter(user_profile_id__in=user_profiles.keys())
+    }
+
+    changed_presences: List[UserPresence] = []
+    presences_to_notify: List[UserPresence] = []
+    for (user_profile_id, client_id), user_pings in pings.items():
+        user_pings.sort(key=lambda ping: ping[0])
+        presence = existing_presences.get((user_profile_id, client_id))
+        changed = notify = presence is None
+        if presence is None:
+            log_time, status = user_pings[0]
+            presence = UserPresence(
+                user_profile=user_profiles[user_profile_id],
+                client=clients[client_id],
+                realm_id=user_profiles[user_profile_id].realm_id,
+                timestamp=log_time,
+                status=status,
+            )
+        else:
+            # Avoid refetching these for the event below.
+            presence.user_profile = user_profiles[user_profile_id]
+            presence.client = clients[client_id]
+
+        # This applies the same rules as do_update_user_presence to
+        # each ping in turn; see the comments there.
+        for log_time, status in user_pings:
+            stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+            was_idle = presence.status == UserPresence.IDLE
+            if (status == UserPresence.ACTIVE) and (stale_status or was_idle):
+                notify = True
+            if stale_status or was_idle or status == presence.status:
+                presence.timestamp = log_time
+                presence.status = status
+                changed = True
+
+        if changed:
+            changed_presences.append(presence)
+        if notify and not presence.user_profile.realm.presence_disabled:
+            presences_to_notify.append(presence)
+
+    vals = [
+        (presence.user_profile_id, presence.client_id, presence.realm_id,
+         presence.timestamp, presence.status)
+        for presence in changed_presences
+    ]
+    query = SQL('''
+        INSERT INTO
+            zerver_userpresence (user_profile_id, client_id, realm_id, timestamp, status)
+        VALUES %s
+        ON CONFLICT (user_profile_id, client_id) DO UPDATE SET
+            timestamp = EXCLUDED.timestamp,
+            status = EXCLUDED.status
+    ''')
+    if vals:
+        with connection.cursor() as cursor:
+            execute_values(cursor.cursor, query, vals)
+    statsd.incr('user_presence', len(presence_updates))
+
+    # The recipients of presence events are the same for every user in
+    # a realm, so we only compute them once per realm.
+    realm_user_ids: Dict[int, List[int]] = {}
+    for presence in presences_to_notify:
+        realm_id = presence.user_profile.realm_id
+        if realm_id not in realm_user_ids:
+            realm_user_ids[realm_id] = active_user_ids(realm_id)
+        send_presence_changed(presence.user_profile, presence, realm_user_ids[realm_id])
+
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime.datetime) -> None:
     event = {'user_profile_id': user_profile.id,
              'time': datetime_to_timestamp(log_time)}
@@ -5701,10 +5763,12 @@ def do_remove_realm_custom_profile_field(realm: Realm, field: CustomProfileField
     associated with it in CustomProfileFieldValue model.
     """
     field.delete()
+    flush_realm_user_data(realm.id)
     notify_realm_custom_profile_fields(realm, 'delete')
 
 def do_remove_realm_custom_profile_fields(realm: Realm) -> None:
     CustomProfileField.objects.filter(realm=realm).delete()
+    flush_realm_user_data(realm.id)
 
 def try_update_realm_custom_profile_field(realm: Realm, field: CustomProfileField,
                                           name: str, hint: str='',
@@ -5763,6 +5827,7 @@ def do_update_user_custom_profile_data_if_changed(user_profile: UserProfile,
                 field_value.save(update_fields=['value', 'rendered_value'])
             else:
                 field_value.save(update_fields=['value'])
+            flush_realm_user_data(user_profile.realm_id)
             notify_user_update_custom_profile_data(user_profile, {
                 "id": field_value.field_id,
                 "value": field_value.value,
@@ -5774,6 +5839,7 @@ def check_remove_custom_profile_field_value(user_profile: UserProfile, field_id:
         field = CustomProfileField.objects.get(realm=user_profile.realm, id=field_id)
         field_value = CustomProfileFieldValue.objects.get(field=field, user_profile=user_profile)
         field_value.delete()
+        flush_realm_user_data(user_profile.realm_id)
         notify_user_update_custom_profile_data(user_profile, {'id': field_id,
                                                               'value': None,
                                                               'rendered_value': None,
@@ -5,15 +5,20 @@ import logging
 import os
 import random
 import re
+import secrets
 import sys
+import threading
 import time
 import traceback
+from collections import OrderedDict
 from functools import lru_cache, wraps
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     Dict,
+    Generic,
+    Hashable,
     Iterable,
     List,
     Optional,
@@ -27,6 +32,7 @@ from django.conf import settings
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 
@@ -490,6 +496,12 @@ def active_user_ids_cache_key(realm_id: int) -> str:
 def active_non_guest_user_ids_cache_key(realm_id: int) -> str:
     return f"active_non_guest_user_ids:{realm_id}"
 
+def realm_state_version_cache_key(realm_id: int) -> str:
+    return f"realm_state_version:{realm_id}"
+
+def realm_state_event_cache_key(realm_id: int, version: int) -> str:
+    return f"realm_state_event:{realm_id}:{version}"
+
 bot_dict_fields: List[str] = [
     'api_key',
     'avatar_source',
@@ -512,6 +524,106 @@ def bot_dicts_in_realm_cache_key(realm: 'Realm') -> str:
 def get_stream_cache_key(stream_name: str, realm_id: int) -> str:
     return f"stream_by_realm_and_name:{realm_id}:{make_safe_digest(stream_name.strip().lower())}"
 
+# The per-process snapshots in zerver/lib/stream_recipient_info.py
+# are only used while these version keys still hold the values they
+# were built with; deleting a key invalidates every process's snapshot.
+recipient_info_user_fields: List[str] = [
+    'is_active', 'long_term_idle', 'is_bot', 'bot_type',
+    'enable_online_push_notifications',
+    'enable_stream_email_notifications',
+    'enable_stream_push_notifications',
+    'wildcard_mentions_notify',
+]
+
+def recipient_subscribers_version_cache_key(recipient_id: int) -> str:
+    return f"recipient_subscribers_version:{recipient_id}"
+
+def realm_user_settings_version_cache_key(realm_id: int) -> str:
+    return f"realm_user_settings_version:{realm_id}"
+
+# zerver/lib/stream_subscribers.py's cached subscriber lists are
+# checked against the recipient_subscribers_version key above and
+# this one.
+def realm_active_users_version_cache_key(realm_id: int) -> str:
+    return f"realm_active_users_version:{realm_id}"
+
+def recipient_subscriber_ids_cache_key(recipient_id: int) -> str:
+    return f"recipient_subscriber_ids:{recipient_id}"
+
+# Like the keys above, for get_raw_user_data's per-process snapshots
+# of a realm's formatted users, in zerver/lib/users.py.
+def realm_user_data_version_cache_key(realm_id: int) -> str:
+    return f"realm_user_data_version:{realm_id}"
+
+def get_version_keys(keys: List[str]) -> Dict[str, str]:
+    """Returns the current value of each of the given version keys,
+    creating any that don't exist yet.  Code that caches data derived
+    from the database under these versions must read them before it
+    queries the database, so that any change committed after its
+    queries also changes the versions; see delete_version_keys.
+    """
+    versions = cache_get_many(keys)
+    missing = {key: secrets.token_hex(8) for key in keys if key not in versions}
+    if missing:
+        cache_set_many(missing)
+        versions.update(missing)
+    return versions
+
+SnapshotKeyT = TypeVar('SnapshotKeyT', bound=Hashable)
+SnapshotT = TypeVar('SnapshotT')
+
+class SnapshotCache(Generic[SnapshotKeyT, SnapshotT]):
+    """A bounded cache, in this process's memory, of the most recently
+    used snapshots of some database state.  Each snapshot is stored
+    with the versions (see get_version_keys) it was built under, and
+    is only returned while the caller's current versions still match.
+
+    It's safe to use from several threads, and is emptied whenever
+    the tests change KEY_PREFIX.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.snapshots: 'OrderedDict[SnapshotKeyT, Tuple[object, SnapshotT]]' = OrderedDict()
+        self.key_prefix = KEY_PREFIX
+        self.lock = threading.Lock()
+
+    def clear_if_stale(self) -> None:
+        if self.key_prefix != KEY_PREFIX:
+            self.snapshots.clear()
+            self.key_prefix = KEY_PREFIX
+
+    def get(self, key: SnapshotKeyT, versions: object) -> Optional[SnapshotT]:
+        with self.lock:
+            self.clear_if_stale()
+            entry = self.snapshots.get(key)
+            if entry is None or entry[0] != versions:
+                return None
+            self.snapshots.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: SnapshotKeyT, versions: object, snapshot: SnapshotT) -> None:
+        with self.lock:
+            self.clear_if_stale()
+            self.snapshots[key] = (versions, snapshot)
+            self.snapshots.move_to_end(key)
+            while len(self.snapshots) > self.max_size:
+                self.snapshots.popitem(last=False)
+
+def delete_version_keys(keys: List[str]) -> None:
+    cache_delete_many(keys)
+    # A process reading the database before we commit can still build
+    # a snapshot from the old data under a fresh version, so we delete
+    # the keys again once the transaction has committed.
+    transaction.on_commit(lambda: cache_delete_many(keys))
+
+def flush_recipient_subscribers(recipient_ids: Iterable[int]) -> None:
+    delete_version_keys([recipient_subscribers_version_cache_key(recipient_id)
+                         for recipient_id in recipient_ids])
+
+def flush_realm_user_data(realm_id: int) -> None:
+    delete_version_keys([realm_user_data_version_cache_key(realm_id)])
+
 def delete_user_profile_caches(user_profiles: Iterable['UserProfile']) -> None:
     # Imported here to avoid cyclic dependency.
     from zerver.lib.users import get_all_api_keys
@@ -559,10 +671,15 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     # the fields in the dict or become (in)active
     if changed(kwargs, realm_user_dict_fields):
         cache_delete(realm_user_dicts_cache_key(user_profile.realm_id))
+        flush_realm_user_data(user_profile.realm_id)
+
+    if changed(kwargs, recipient_info_user_fields):
+        delete_version_keys([realm_user_settings_version_cache_key(user_profile.realm_id)])
 
     if changed(kwargs, ['is_active']):
         cache_delete(active_user_ids_cache_key(user_profile.realm_id))
         cache_delete(active_non_guest_user_ids_cache_key(user_profile.realm_id))
+        delete_version_keys([realm_active_users_version_cache_key(user_profile.realm_id)])
 
     if changed(kwargs, ['role']):
         cache_delete(active_non_guest_user_ids_cache_key(user_profile.realm_id))
@@ -575,6 +692,15 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if user_profile.is_bot and changed(kwargs, bot_dict_fields):
         cache_delete(bot_dicts_in_realm_cache_key(user_profile.realm))
 
+# Called by models.py to invalidate get_recipient_info's snapshots
+# whenever we save a Subscription object.  Code that changes
+# subscriptions in bulk calls flush_recipient_subscribers directly.
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    subscription = kwargs['instance']
+    if changed(kwargs, ['active', 'is_muted', 'push_notifications', 'email_notifications',
+                        'wildcard_mentions_notify']):
+        flush_recipient_subscribers([subscription.recipient_id])
+
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
 # generally cached indirectly through user_profile objects.
@@ -586,6 +712,7 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
     if realm.deactivated or (kwargs["update_fields"] is not None and
                              "string_id" in kwargs['update_fields']):
         cache_delete(realm_user_dicts_cache_key(realm.id))
+        flush_realm_user_data(realm.id)
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
@@ -1,9 +1,14 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 import copy
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Set
 
 from django.conf import settings
+from django.db import close_old_connections, connection
 from django.utils.translation import ugettext as _
 
 from version import API_FEATURE_LEVEL, ZULIP_VERSION
@@ -36,6 +41,11 @@ from zerver.lib.presence import get_presence_for_user, get_presences_for_realm
 from zerver.lib.push_notifications import push_notifications_enabled
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_source, get_realm_logo_url
+from zerver.lib.realm_state_changelog import (
+    REALM_STATE_EVENT_TYPES,
+    get_realm_state_events,
+    get_realm_state_version,
+)
 from zerver.lib.request import JsonableError
 from zerver.lib.soft_deactivation import reactivate_user_if_soft_deactivated
 from zerver.lib.stream_subscription import handle_stream_notifications_compatibility
@@ -60,6 +70,7 @@ from zerver.models import (
 from zerver.tornado.django_api import get_user_events, request_event_queue
 from zproject.backends import email_auth_enabled, password_auth_enabled
 
+register_logger = logging.getLogger('zulip.register')
 
 def add_realm_logo_fields(state: Dict[str, Any], realm: Realm) -> None:
     state['realm_logo_url'] = get_realm_logo_url(realm, night = False)
@@ -78,6 +89,91 @@ def always_want(msg_type: str) -> bool:
     '''
     return True
 
+# Fetches that take longer than this are logged, with how long each
+# section of the state took.
+SLOW_INITIAL_STATE_FETCH_THRESHOLD = 1.0
+
+# Shared by all of this process's requests, so that the threads, and
+# their database connections, are reused; created on first use, so
+# that it's created after uWSGI forks its workers.
+initial_state_executor: Optional[ThreadPoolExecutor] = None
+initial_state_executor_lock = threading.Lock()
+
+def get_initial_state_executor() -> ThreadPoolExecutor:
+    global initial_state_executor
+    with initial_state_executor_lock:
+        if initial_state_executor is None:
+            initial_state_executor = ThreadPoolExecutor(
+                max_workers=settings.INITIAL_STATE_FETCH_THREADS,
+                thread_name_prefix='initial_state_fetch',
+            )
+        return initial_state_executor
+
+def can_fetch_concurrently() -> bool:
+    # The threads' database connections can't see the changes made
+    # by a transaction we're in (as in tests).
+    return settings.INITIAL_STATE_FETCH_THREADS > 1 and not connection.in_atomic_block
+
+class InitialStateSections:
+    '''Times the sections of fetch_initial_state_data, and fetches the
+    expensive sections that only read from the database.
+
+    With settings.INITIAL_STATE_FETCH_THREADS > 1, those sections are
+    all started on the process's thread pool as soon as this is
+    created, and run concurrently with each other and with the rest
+    of fetch_initial_state_data; each pool thread keeps its own
+    database connection.  Otherwise, each one is fetched when its
+    result is needed.
+    '''
+
+    def __init__(self, concurrent_sections: Dict[str, Callable[[], Any]]) -> None:
+        self.times: Dict[str, float] = {}
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+        self.concurrent_sections = concurrent_sections
+        self.futures: Dict[str, 'Future[Any]'] = {}
+
+        if concurrent_sections and can_fetch_concurrently():
+            executor = get_initial_state_executor()
+            for name, func in concurrent_sections.items():
+                self.futures[name] = executor.submit(self.run_in_thread, name, func)
+
+    def run_in_thread(self, name: str, func: Callable[[], Any]) -> Any:
+        # Like Django does at the start and end of each request, close
+        # this thread's connection if it has broken or is older than
+        # CONN_MAX_AGE; otherwise, it's kept for the next request.
+        close_old_connections()
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.times[name] = time.perf_counter() - start
+            close_old_connections()
+
+    def result(self, name: str) -> Any:
+        future = self.futures.get(name)
+        if future is not None:
+            return future.result()
+        return self.concurrent_sections[name]()
+
+    def finished(self, name: str) -> None:
+        now = time.perf_counter()
+        if name not in self.futures:
+            self.times[name] = now - self.last_time
+        self.last_time = now
+
+    def log_if_slow(self, user_profile: UserProfile) -> None:
+        total_time = time.perf_counter() - self.start_time
+        if total_time < SLOW_INITIAL_STATE_FETCH_THRESHOLD:
+            return
+        section_times = sorted(self.times.items(), key=lambda item: item[1], reverse=True)
+        register_logger.info(
+            'Slow initial state fetch for user %s: %.3fs; %s',
+            user_profile.id,
+            total_time,
+            ', '.join(f'{name} {section_time:.3f}s' for name, section_time in section_times[:5]),
+        )
+
 # Fetch initial data.  When event_types is not specified, clients want
 # all event types.  Whenever you add new code to this function, you
 # should also add corresponding events for changes in the data
@@ -87,7 +183,8 @@ def fetch_initial_state_data(user_profile: UserProfile,
                              queue_id: str, client_gravatar: bool,
                              user_avatar_url_field_optional: bool,
                              slim_presence: bool = False,
-                             include_subscribers: bool = True) -> Dict[str, Any]:
+                             include_subscribers: bool = True,
+                             realm_state_delta: bool = False) -> Dict[str, Any]:
     state: Dict[str, Any] = {'queue_id': queue_id}
     realm = user_profile.realm
 
@@ -97,20 +194,52 @@ def fetch_initial_state_data(user_profile: UserProfile,
     else:
         want = set(event_types).__contains__
 
+    concurrent_sections: Dict[str, Callable[[], Any]] = {}
+    # With realm_state_delta, the client gets the events that changed
+    # its copy of the realm's users and presence data instead of the
+    # whole lists (see zerver/lib/realm_state_changelog.py), so we only
+    # fetch the user's own row, which apply_event needs.
+    if want('presence') and not realm_state_delta:
+        concurrent_sections['presence'] = lambda: get_presences_for_realm(realm, slim_presence)
+    if want('realm_user_groups'):
+        concurrent_sections['realm_user_groups'] = lambda: user_groups_in_realm_serialized(realm)
+    if want('realm_user'):
+        concurrent_sections['realm_user'] = lambda: get_raw_user_data(
+            realm, user_profile,
+            target_user=user_profile if realm_state_delta else None,
+            client_gravatar=client_gravatar,
+            user_avatar_url_field_optional=user_avatar_url_field_optional)
+    if want('recent_private_conversations'):
+        concurrent_sections['recent_private_conversations'] = \
+            lambda: get_recent_private_conversations(user_profile)
+    if want('subscription'):
+        concurrent_sections['subscription'] = lambda: gather_subscriptions_helper(
+            user_profile, include_subscribers=include_subscribers)
+    if want('update_message_flags') and want('message'):
+        concurrent_sections['unread_msgs'] = lambda: get_raw_unread_data(user_profile)
+    if want('starred_messages'):
+        concurrent_sections['starred_messages'] = lambda: get_starred_message_ids(user_profile)
+    if want('stream'):
+        concurrent_sections['stream'] = lambda: do_get_streams(user_profile)
+    sections = InitialStateSections(concurrent_sections)
+
     # Show the version info unconditionally.
     state['zulip_version'] = ZULIP_VERSION
     state['zulip_feature_level'] = API_FEATURE_LEVEL
 
     if want('alert_words'):
         state['alert_words'] = user_alert_words(user_profile)
+        sections.finished('alert_words')
 
     if want('custom_profile_fields'):
         fields = custom_profile_fields_for_realm(realm.id)
         state['custom_profile_fields'] = [f.as_dict() for f in fields]
         state['custom_profile_field_types'] = CustomProfileField.FIELD_TYPE_CHOICES_DICT
+        sections.finished('custom_profile_fields')
 
     if want('hotspots'):
         state['hotspots'] = get_next_hotspots(user_profile)
+        sections.finished('hotspots')
 
     if want('message'):
         # The client should use get_messages() to fetch messages
@@ -124,12 +253,15 @@ def fetch_initial_state_data(user_profile: UserProfile,
             state['max_message_id'] = user_messages[0]['message_id']
         else:
             state['max_message_id'] = -1
+        sections.finished('message')
 
     if want('muted_topics'):
         state['muted_topics'] = get_topic_mutes(user_profile)
+        sections.finished('muted_topics')
 
     if want('presence'):
-        state['presences'] = get_presences_for_realm(realm, slim_presence)
+        state['presences'] = {} if realm_state_delta else sections.result('presence')
+        sections.finished('presence')
 
     if want('realm'):
         for property_name in Realm.property_types:
@@ -188,23 +320,26 @@ def fetch_initial_state_data(user_profile: UserProfile,
             state['realm_signup_notifications_stream_id'] = signup_notifications_stream.id
         else:
             state['realm_signup_notifications_stream_id'] = -1
+        sections.finished('realm')
 
     if want('realm_domains'):
         state['realm_domains'] = get_realm_domains(realm)
+        sections.finished('realm_domains')
 
     if want('realm_emoji'):
         state['realm_emoji'] = realm.get_emoji()
+        sections.finished('realm_emoji')
 
     if want('realm_filters'):
         state['realm_filters'] = realm_filters_for_realm(realm.id)
+        sections.finished('realm_filters')
 
     if want('realm_user_groups'):
-        state['realm_user_groups'] = user_groups_in_realm_serialized(realm)
+        state['realm_user_groups'] = sections.result('realm_user_groups')
+        sections.finished('realm_user_groups')
 
     if want('realm_user'):
-        state['raw_users'] = get_raw_user_data(realm, user_profile,
-                                               client_gravatar=client_gravatar,
-                                               user_avatar_url_field_optional=user_avatar_url_field_optional)
+        state['raw_users'] = sections.result('realm_user')
 
         # For the user's own avatar URL, we force
         # client_gravatar=False, since that saves some unnecessary
@@ -233,9 +368,11 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['email'] = user_profile.email
         state['delivery_email'] = user_profile.delivery_email
         state['full_name'] = user_profile.full_name
+        sections.finished('realm_user')
 
     if want('realm_bot'):
         state['realm_bots'] = get_owned_bot_dicts(user_profile)
+        sections.finished('realm_bot')
 
     # This does not yet have an apply_event counterpart, since currently,
     # new entries for EMBEDDED_BOTS can only be added directly in the codebase.
@@ -245,6 +382,7 @@ def fetch_initial_state_data(user_profile: UserProfile,
             realm_embedded_bots.append({'name': bot.name,
                                         'config': load_bot_config_template(bot.name)})
         state['realm_embedded_bots'] = realm_embedded_bots
+        sections.finished('realm_embedded_bots')
 
     # This does not have an apply_events counterpart either since
     # this data is mostly static.
@@ -256,6 +394,7 @@ def fetch_initial_state_data(user_profile: UserProfile,
                 'config': {c[1]: c[0] for c in integration.config_options},
             })
         state['realm_incoming_webhook_bots'] = realm_incoming_webhook_bots
+        sections.finished('realm_incoming_webhook_bots')
 
     if want('recent_private_conversations'):
         # A data structure containing records of this form:
@@ -270,61 +409,73 @@ def fetch_initial_state_data(user_profile: UserProfile,
         # intermediate form as a dictionary keyed by recipient_id,
         # which is more efficient to update, and is rewritten to the
         # final format in post_process_state.
-        state['raw_recent_private_conversations'] = get_recent_private_conversations(user_profile)
+        state['raw_recent_private_conversations'] = sections.result('recent_private_conversations')
+        sections.finished('recent_private_conversations')
 
     if want('subscription'):
-        subscriptions, unsubscribed, never_subscribed = gather_subscriptions_helper(
-            user_profile, include_subscribers=include_subscribers)
+        subscriptions, unsubscribed, never_subscribed = sections.result('subscription')
         state['subscriptions'] = subscriptions
         state['unsubscribed'] = unsubscribed
         state['never_subscribed'] = never_subscribed
+        sections.finished('subscription')
 
     if want('update_message_flags') and want('message'):
         # Keeping unread_msgs updated requires both message flag updates and
         # message updates. This is due to the fact that new messages will not
         # generate a flag update so we need to use the flags field in the
         # message event.
-        state['raw_unread_msgs'] = get_raw_unread_data(user_profile)
+        state['raw_unread_msgs'] = sections.result('unread_msgs')
+        sections.finished('unread_msgs')
 
     if want('starred_messages'):
-        state['starred_messages'] = get_starred_message_ids(user_profile)
+        state['starred_messages'] = sections.result('starred_messages')
+        sections.finished('starred_messages')
 
     if want('stream'):
-        state['streams'] = do_get_streams(user_profile)
+        state['streams'] = sections.result('stream')
         state['stream_name_max_length'] = Stream.MAX_NAME_LENGTH
         state['stream_description_max_length'] = Stream.MAX_DESCRIPTION_LENGTH
+        sections.finished('stream')
     if want('default_streams'):
         if user_profile.is_guest:
             state['realm_default_streams'] = []
         else:
             state['realm_default_streams'] = streams_to_dicts_sorted(
                 get_default_streams_for_realm(realm.id))
+        sections.finished('default_streams')
     if want('default_stream_groups'):
         if user_profile.is_guest:
             state['realm_default_stream_groups'] = []
         else:
             state['realm_default_stream_groups'] = default_stream_groups_to_dicts_sorted(
                 get_default_stream_groups(realm))
+        sections.finished('default_stream_groups')
 
     if want('stop_words'):
         state['stop_words'] = read_stop_words()
+        sections.finished('stop_words')
 
     if want('update_display_settings'):
         for prop in UserProfile.property_types:
             state[prop] = getattr(user_profile, prop)
         state['emojiset_choices'] = user_profile.emojiset_choices()
+        sections.finished('update_display_settings')
 
     if want('update_global_notifications'):
         for notification in UserProfile.notification_setting_types:
             state[notification] = getattr(user_profile, notification)
         state['available_notification_sounds'] = get_available_notification_sounds()
+        sections.finished('update_global_notifications')
 
     if want('user_status'):
         state['user_status'] = get_user_info_dict(realm_id=realm.id)
+        sections.finished('user_status')
 
     if want('video_calls'):
         state['has_zoom_token'] = user_profile.zoom_token is not None
+        sections.finished('video_calls')
 
+    sections.log_if_slow(user_profile)
     return state
 
 def apply_events(state: Dict[str, Any], events: Iterable[Dict[str, Any]],
@@ -406,7 +557,8 @@ def apply_event(state: Dict[str, Any],
                 person['profile_data'] = {}
             state['raw_users'][person_user_id] = person
         elif event['op'] == "remove":
-            state['raw_users'][person_user_id]['is_active'] = False
+            if person_user_id in state['raw_users']:
+                state['raw_users'][person_user_id]['is_active'] = False
         elif event['op'] == 'update':
             is_me = (person_user_id == user_profile.id)
 
@@ -843,7 +995,8 @@ def do_events_register(user_profile: UserProfile, user_client: Client,
                        include_subscribers: bool = True,
                        client_capabilities: Dict[str, bool] = {},
                        narrow: Iterable[Sequence[str]] = [],
-                       fetch_event_types: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+                       fetch_event_types: Optional[Iterable[str]] = None,
+                       since_realm_state_version: Optional[int] = None) -> Dict[str, Any]:
     # Technically we don't need to check this here because
     # build_narrow_filter will check it, but it's nicer from an error
     # handling perspective to do it before contacting Tornado
@@ -879,11 +1032,22 @@ def do_events_register(user_profile: UserProfile, user_client: Client,
     # Fill up the UserMessage rows if a soft-deactivated user has returned
     reactivate_user_if_soft_deactivated(user_profile)
 
+    want_realm_state = event_types_set is None or bool(
+        event_types_set & REALM_STATE_EVENT_TYPES)
+    # We read the version before fetching the state, so the state
+    # includes every change up to it.
+    realm_state_version = get_realm_state_version(user_profile.realm_id)
+    realm_state_events = None
+    if want_realm_state and since_realm_state_version is not None:
+        realm_state_events = get_realm_state_events(
+            user_profile, since_realm_state_version, realm_state_version, slim_presence)
+
     ret = fetch_initial_state_data(user_profile, event_types_set, queue_id,
                                    client_gravatar=client_gravatar,
                                    user_avatar_url_field_optional=user_avatar_url_field_optional,
                                    slim_presence=slim_presence,
-                                   include_subscribers=include_subscribers)
+                                   include_subscribers=include_subscribers,
+                                   realm_state_delta=realm_state_events is not None)
 
     # Apply events that came in while we were fetching initial data
     events = get_user_events(user_profile, queue_id, -1)
@@ -891,6 +1055,39 @@ def do_events_register(user_profile: UserProfile, user_client: Client,
                  client_gravatar=client_gravatar, slim_presence=slim_presence,
                  fetch_event_types=fetch_event_types)
 
+    if realm_state_events is not None:
+        # The events we just applied to our placeholders for the
+        # realm's users and presence data are only in the changelog
+        # (send_event records them before queueing them), so the
+        # client needs those too.
+        new_realm_state_version = get_realm_state_version(user_profile.realm_id)
+        later_events = get_realm_state_events(
+            user_profile, realm_state_version, new_realm_state_version, slim_presence)
+        realm_state_version = new_realm_state_version
+        if later_events is not None:
+            realm_state_events += later_events
+        else:
+            # Rare, since we just checked the earlier events; fetch
+            # the full state after all.
+            realm_state_events = None
+            if 'raw_users' in ret:
+                ret['raw_users'] = get_raw_user_data(
+                    user_profile.realm, user_profile,
+                    client_gravatar=client_gravatar,
+                    user_avatar_url_field_optional=user_avatar_url_field_optional)
+            if 'presences' in ret:
+                ret['presences'] = get_presences_for_realm(user_profile.realm, slim_presence)
+
+    if want_realm_state:
+        ret['realm_state_version'] = realm_state_version
+    if realm_state_events is not None:
+        ret.pop('raw_users', None)
+        ret.pop('presences', None)
+        ret['realm_state_events'] = [
+            event for event in realm_state_events
+            if event_types_set is None or event['type'] in event_types_set
+        ]
+
     post_process_state(user_profile, ret, notification_settings_null)
 
     if len(events) > 0:
@@ -13,7 +13,7 @@ import os
 import shutil
 import subprocess
 import tempfile
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import boto3
 import orjson
@@ -264,6 +264,19 @@ MESSAGE_TABLES = {
     'zerver_reaction',
 }
 
+# Tables that can have millions of rows in a large realm, and whose
+# rows nothing else in the export reads back.  do_export_realm streams
+# these (and zerver_reaction) into realm.json in batches, rather than
+# holding them in memory.
+STREAMED_TABLES = {
+    'zerver_realmauditlog',
+    'zerver_useractivity',
+    'zerver_useractivityinterval',
+    'zerver_userpresence',
+}
+
+STREAMED_TABLE_BATCH_SIZE = 10000
+
 # These get their own file as analytics data can be quite large and
 # would otherwise make realm.json unpleasant to manually inspect
 ANALYTICS_TABLES = {
@@ -391,6 +404,65 @@ def listify_bithandler_fields(data: TableData, table: TableName) -> None:
         for field in BITHANDLER_FIELDS[table]:
             item[field] = list(item[field])
 
+class StreamedTable:
+    '''A table whose rows are only fetched, in batches through a
+    server-side cursor, as write_realm_data_to_file writes them out;
+    this keeps the memory used to export it bounded however many
+    rows it has.
+    '''
+
+    def __init__(self, table: TableName, query: Any,
+                 exclude: Optional[List[Field]]=None) -> None:
+        self.table = table
+        self.query = query.order_by('id')
+        self.exclude = exclude
+
+    def make_records(self, instances: List[Any]) -> List[Record]:
+        data = {self.table: make_raw(instances, exclude=self.exclude)}
+        if self.table in DATE_FIELDS:
+            floatify_datetime_fields(data, self.table)
+        if self.table in BITHANDLER_FIELDS:
+            listify_bithandler_fields(data, self.table)
+        return data[self.table]
+
+    def batches(self) -> Iterator[List[Record]]:
+        instances: List[Any] = []
+        for instance in self.query.iterator(chunk_size=STREAMED_TABLE_BATCH_SIZE):
+            instances.append(instance)
+            if len(instances) == STREAMED_TABLE_BATCH_SIZE:
+                yield self.make_records(instances)
+                instances = []
+        if instances:
+            yield self.make_records(instances)
+
+def write_realm_data_to_file(output_file: Path, data: TableData,
+                             streamed_tables: Dict[TableName, StreamedTable]) -> Dict[TableName, int]:
+    '''Like write_data_to_file, but writes the rows of streamed_tables
+    in place of their (empty) entries in data, a batch at a time.
+    Returns the number of rows written for each table.
+    '''
+    row_counts: Dict[TableName, int] = {}
+    with open(output_file, "wb") as f:
+        f.write(b'{')
+        for i, (table, rows) in enumerate(data.items()):
+            f.write(b',\n' if i else b'\n')
+            f.write(orjson.dumps(table) + b': [')
+            streamed_table = streamed_tables.get(table)
+            batches = streamed_table.batches() if streamed_table is not None else iter([rows])
+            count = 0
+            for batch in batches:
+                for row in batch:
+                    f.write(b',\n' if count else b'\n')
+                    # See write_data_to_file for why we pass this option.
+                    f.write(orjson.dumps(row, option=orjson.OPT_PASSTHROUGH_DATETIME))
+                    count += 1
+                if streamed_table is not None:
+                    logging.info('Exported %d rows of %s', count, table)
+            f.write(b'\n]' if count else b']')
+            row_counts[table] = count
+        f.write(b'\n}\n')
+    return row_counts
+
 class Config:
     '''A Config object configures a single table for exporting (and, maybe
     some day importing as well.  This configuration defines what
@@ -542,7 +614,15 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             filter_parms.update(config.filter_args)
         assert model is not None
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        if table in STREAMED_TABLES and 'streamed_tables' in context:
+            # Nothing may read this table's rows back, so we leave it
+            # empty here, and fetch its rows as we write them out.
+            assert table is not None
+            assert not config.children
+            context['streamed_tables'][table] = StreamedTable(table, query, exclude=config.exclude)
+            response[table] = []
+        else:
+            rows = list(query)
 
     elif config.id_source:
         # In this mode, we are the figurative Blog, and we now
@@ -906,10 +986,6 @@ def fetch_attachment_data(response: TableData, realm_id: int, message_ids: Set[i
         row for row in response['zerver_attachment']
         if row['messages']]
 
-def fetch_reaction_data(response: TableData, message_ids: Set[int]) -> None:
-    query = Reaction.objects.filter(message_id__in=list(message_ids))
-    response['zerver_reaction'] = make_raw(list(query))
-
 def fetch_huddle_objects(response: TableData, config: Config, context: Context) -> None:
 
     realm = context['realm']
@@ -1460,7 +1536,8 @@ def export_emoji_from_local(realm: Realm, local_dir: Path, output_dir: Path) ->
     with open(os.path.join(output_dir, "records.json"), "wb") as records_file:
         records_file.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
 
-def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
+def do_write_stats_file_for_realm_export(output_dir: Path,
+                                         realm_row_counts: Optional[Dict[TableName, int]]=None) -> None:
     stats_file = os.path.join(output_dir, 'stats.txt')
     realm_file = os.path.join(output_dir, 'realm.json')
     attachment_file = os.path.join(output_dir, 'attachment.json')
@@ -1472,10 +1549,15 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
     with open(stats_file, 'w') as f:
         for fn in fns:
             f.write(os.path.basename(fn) + '\n')
-            with open(fn, "rb") as filename:
-                data = orjson.loads(filename.read())
-            for k in sorted(data):
-                f.write(f'{len(data[k]):5} {k}\n')
+            if fn == realm_file and realm_row_counts is not None:
+                # Avoid loading realm.json, which can be very large.
+                row_counts = realm_row_counts
+            else:
+                with open(fn, "rb") as filename:
+                    data = orjson.loads(filename.read())
+                row_counts = {k: len(data[k]) for k in data}
+            for k in sorted(row_counts):
+                f.write(f'{row_counts[k]:5} {k}\n')
             f.write('\n')
 
         avatar_file = os.path.join(output_dir, 'avatars/records.json')
@@ -1493,6 +1575,7 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
                     public_only: bool=False,
                     consent_message_id: Optional[int]=None) -> str:
     response: TableData = {}
+    streamed_tables: Dict[TableName, StreamedTable] = {}
 
     # We need at least one thread running to export
     # UserMessage rows.  The management command should
@@ -1509,7 +1592,8 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
         response=response,
         config=realm_config,
         seed_object=realm,
-        context=dict(realm=realm, exportable_user_ids=exportable_user_ids),
+        context=dict(realm=realm, exportable_user_ids=exportable_user_ids,
+                     streamed_tables=streamed_tables),
     )
     logging.info('...DONE with get_realm_config() data')
 
@@ -1530,14 +1614,15 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     logging.info('%d messages were exported', len(message_ids))
 
     # zerver_reaction
-    zerver_reaction: TableData = {}
-    fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
-    response.update(zerver_reaction)
+    response['zerver_reaction'] = []
+    streamed_tables['zerver_reaction'] = StreamedTable(
+        'zerver_reaction', Reaction.objects.filter(message_id__in=list(message_ids)))
 
     # Write realm data
     export_file = os.path.join(output_dir, "realm.json")
-    write_data_to_file(output_file=export_file, data=response)
     logging.info('Writing realm data to %s', export_file)
+    realm_row_counts = write_realm_data_to_file(output_file=export_file, data=response,
+                                                streamed_tables=streamed_tables)
 
     # Write analytics data
     export_analytics_tables(realm=realm, output_dir=output_dir)
@@ -1552,7 +1637,7 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     logging.info("Finished exporting %s", realm.string_id)
     create_soft_link(source=output_dir, in_progress=False)
 
-    do_write_stats_file_for_realm_export(output_dir)
+    do_write_stats_file_for_realm_export(output_dir, realm_row_counts=realm_row_counts)
 
     # We need to change back to the current working directory after writing
     # the tarball to the output directory, otherwise the state is compromised
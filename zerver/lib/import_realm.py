@@ -1,37 +1,34 @@
 import datetime
+import io
 import logging
 import os
 import shutil
+import time
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import boto3
 import orjson
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.db import connection
+from django.core.cache import caches
+from django.db import connection, connections
 from django.db.models import Max
 from django.utils.timezone import now as timezone_now
-from psycopg2.extras import execute_values
 from psycopg2.sql import SQL, Identifier
 
 from analytics.models import RealmCount, StreamCount, UserCount
-from zerver.lib.actions import (
-    UserMessageLite,
-    bulk_insert_ums,
-    do_change_avatar_fields,
-    do_change_plan_type,
-)
+from zerver.lib.actions import do_change_avatar_fields, do_change_plan_type
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users, bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
-from zerver.lib.markdown import markdown_convert
 from zerver.lib.markdown import version as markdown_version
 from zerver.lib.parallel import run_parallel
+from zerver.lib.render_pool import RenderJob, bulk_render_markdown, start_render_pool, stop_render_pool
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.upload import BadImageError, guess_type, random_name, sanitize_name
-from zerver.lib.utils import generate_api_key, process_list_in_batches
+from zerver.lib.utils import generate_api_key
 from zerver.models import (
     AlertWord,
     Attachment,
@@ -256,6 +253,8 @@ def fix_message_rendered_content(realm: Realm,
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    render_jobs: List[RenderJob] = []
+    messages_to_render: List[Record] = []
     for message in messages:
         if message['rendered_content'] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -304,36 +303,29 @@ def fix_message_rendered_content(realm: Realm,
                 message['rendered_content'] = str(soup)
             continue
 
-        try:
-            content = message['content']
-
-            sender_id = message['sender_id']
-            sender = sender_map[sender_id]
-            sent_by_bot = sender['is_bot']
-            translate_emoticons = sender['translate_emoticons']
-
-            # We don't handle alert words on import from third-party
-            # platforms, since they generally don't have an "alert
-            # words" type feature, and notifications aren't important anyway.
-            realm_alert_words_automaton = None
-
-            rendered_content = markdown_convert(
-                content=content,
-                realm_alert_words_automaton=realm_alert_words_automaton,
-                message_realm=realm,
-                sent_by_bot=sent_by_bot,
-                translate_emoticons=translate_emoticons,
-            )
-
-            message['rendered_content'] = rendered_content
-            message['rendered_content_version'] = markdown_version
-        except Exception:
-            # This generally happens with two possible causes:
-            # * rendering Markdown throwing an uncaught exception
-            # * rendering Markdown failing with the exception being
-            #   caught in Markdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
+        sender = sender_map[message['sender_id']]
+        # We don't handle alert words on import from third-party
+        # platforms, since they generally don't have an "alert
+        # words" type feature, and notifications aren't important anyway.
+        render_jobs.append(RenderJob(
+            content=message['content'],
+            realm=realm,
+            sent_by_bot=sender['is_bot'],
+            translate_emoticons=sender['translate_emoticons'],
+        ))
+        messages_to_render.append(message)
+
+    # With a render pool (see import_message_data), this uses all the
+    # processes we were given.
+    rendered = bulk_render_markdown(render_jobs)
+    for message, rendered_content in zip(messages_to_render, rendered):
+        if rendered_content is None:
+            # Rendering Markdown threw an exception, which
+            # markdown_convert has already logged.
             logging.warning("Error in Markdown rendering for message ID %s; continuing", message['id'])
+            continue
+        message['rendered_content'] = rendered_content
+        message['rendered_content_version'] = markdown_version
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
     """
@@ -547,6 +539,63 @@ def update_model_ids(model: Any, data: TableData, related_table: TableName) -> N
         update_id_map(related_table, old_id_list[item], allocated_id_list[item])
     re_map_foreign_keys(data, table, 'id', related_table=related_table, id_field=True)
 
+# The tables that can have millions of rows, whose secondary indexes
+# do_import_realm can drop while loading them and rebuild at the end.
+DEFERRED_INDEX_TABLES = [
+    'zerver_message',
+    'zerver_usermessage',
+    'zerver_reaction',
+    'zerver_attachment_messages',
+]
+
+# Rows per COPY statement; large enough that the per-statement
+# overhead is negligible, small enough to bound the buffer's memory.
+BULK_COPY_BATCH_SIZE = 10000
+
+def format_copy_value(value: Any) -> str:
+    # We COPY in CSV format with NULL written as an unquoted \N, and
+    # quote everything else, so that no value can be mistaken for NULL.
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return '"' + str(value).replace('"', '""') + '"'
+
+def copy_rows(table: TableName, columns: List[str], rows: Iterable[Iterable[Any]]) -> int:
+    """Loads the rows into the table with PostgreSQL's COPY, which
+    avoids building and parsing giant INSERT statements, and is many
+    times faster than bulk_create for large tables.  Returns the
+    number of rows loaded."""
+    query = SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        table=Identifier(table),
+        columns=SQL(', ').join(Identifier(column) for column in columns),
+    )
+    count = 0
+    with connection.cursor() as cursor:
+        query_string = query.as_string(cursor.cursor)
+        batch: List[str] = []
+        for row in rows:
+            batch.append(','.join(format_copy_value(value) for value in row) + '\n')
+            if len(batch) == BULK_COPY_BATCH_SIZE:
+                cursor.cursor.copy_expert(query_string, io.StringIO(''.join(batch)))
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.cursor.copy_expert(query_string, io.StringIO(''.join(batch)))
+            count += len(batch)
+    return count
+
+def log_import_rate(model: Any, table: TableName, count: int, start: float,
+                    dump_file_id: Optional[int]=None) -> None:
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    if dump_file_id is None:
+        logging.info("Successfully imported %s rows of %s from %s in %.1fs (%.0f rows/s).",
+                     count, model, table, elapsed, rate)
+    else:
+        logging.info("Successfully imported %s rows of %s from %s[%s] in %.1fs (%.0f rows/s).",
+                     count, model, table, dump_file_id, elapsed, rate)
+
 def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     model = UserMessage
     table = 'zerver_usermessage'
@@ -557,27 +606,13 @@ def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     # We let the DB itself generate ids.  Note that
     # no tables use user_message.id as a foreign key,
     # so we can safely avoid all re-mapping complexity.
-
-    def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id = item['user_profile_id'],
-                message_id = item['message_id'],
-                flags=item['flags'],
-            )
-            for item in items
-        ]
-        bulk_insert_ums(ums)
-
-    chunk_size = 10000
-
-    process_list_in_batches(
-        lst=lst,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
+    start = time.perf_counter()
+    count = copy_rows(
+        table,
+        ['user_profile_id', 'message_id', 'flags'],
+        ((item['user_profile_id'], item['message_id'], int(item['flags'])) for item in lst),
     )
-
-    logging.info("Successfully imported %s from %s[%s].", model, table, dump_file_id)
+    log_import_rate(model, table, count, start, dump_file_id)
 
 def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=None) -> None:
     table = get_db_table(model)
@@ -588,6 +623,59 @@ def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=N
     else:
         logging.info("Successfully imported %s from %s[%s].", model, table, dump_file_id)
 
+def bulk_copy_model(data: TableData, model: Any, dump_file_id: Optional[int]=None) -> None:
+    """Like bulk_import_model, but loads the rows with COPY; we use
+    this for the tables that can have millions of rows.  The rows must
+    already have their ids, since (unlike bulk_create) this doesn't
+    fetch the ids the database assigns."""
+    table = get_db_table(model)
+    fields = model._meta.concrete_fields
+
+    def get_row(item: Record) -> List[Any]:
+        obj = model(**item)
+        assert obj.id is not None
+        return [field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+                for field in fields]
+
+    start = time.perf_counter()
+    count = copy_rows(table, [field.column for field in fields],
+                      (get_row(item) for item in data[table]))
+    log_import_rate(model, table, count, start, dump_file_id)
+
+def drop_deferrable_indexes(tables: List[TableName]) -> List[Tuple[str, str]]:
+    """Drops the secondary indexes on the given tables, so that loading
+    them doesn't pay to update every index row by row; building an
+    index once at the end is much faster.  Primary keys and unique
+    indexes are kept, since they enforce the data's integrity.
+
+    Returns the names and definitions of the dropped indexes, for
+    create_deferred_indexes."""
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid)
+            FROM pg_index
+            JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+            JOIN pg_class table_class ON table_class.oid = pg_index.indrelid
+            WHERE table_class.relname = ANY(%s)
+                AND NOT pg_index.indisprimary
+                AND NOT pg_index.indisunique
+            ORDER BY index_class.relname
+        ''', [tables])
+        indexes = cursor.fetchall()
+        for name, definition in indexes:
+            # Logged so that the indexes can be recreated by hand, if
+            # the import dies before create_deferred_indexes runs.
+            logging.info("Deferring index: %s", definition)
+            cursor.execute(SQL('DROP INDEX {name}').format(name=Identifier(name)))
+    return indexes
+
+def create_deferred_indexes(indexes: List[Tuple[str, str]]) -> None:
+    with connection.cursor() as cursor:
+        for name, definition in indexes:
+            start = time.perf_counter()
+            cursor.execute(definition)
+            logging.info("Built index %s in %.1fs", name, time.perf_counter() - start)
+
 # Client is a table shared by multiple realms, so in order to
 # correctly import multiple realms into the same server, we need to
 # check if a Client object already exists, and so we need to support
@@ -600,6 +688,14 @@ def bulk_import_client(data: TableData, model: Any, table: TableName) -> None:
             client = Client.objects.create(name=item['name'])
         update_id_map(table='client', old_id=item['id'], new_id=client.id)
 
+def close_connections_for_fork() -> None:
+    # Processes forked by run_parallel must not share this process's
+    # database and cache connections; they'll open their own.
+    assert not connection.in_atomic_block
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+
 def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_avatars: bool=False,
                    processing_emojis: bool=False, processing_realm_icons: bool=False) -> None:
     if processing_avatars and processing_emojis:
@@ -759,7 +855,7 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
             for record in records:
                 process_avatars(record)
         else:
-            connection.close()
+            close_connections_for_fork()
             output = []
             for (status, job) in run_parallel(process_avatars, records, processes):
                 output.append(job)
@@ -782,7 +878,14 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
 # Because the Python object => JSON conversion process is not fully
 # faithful, we have to use a set of fixers (e.g. on DateTime objects
 # and Foreign Keys) to do the import correctly.
-def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm:
+#
+# With defer_indexes, we drop the secondary indexes on the tables with
+# a row per message (see DEFERRED_INDEX_TABLES) while loading them, and
+# rebuild them once they're loaded.  That makes importing large realms
+# much faster, but queries on those tables for any other realm on the
+# server will be slow in the meantime.
+def do_import_realm(import_dir: Path, subdomain: str, processes: int=1,
+                    defer_indexes: bool=False) -> Realm:
     logging.info("Importing realm dump %s", import_dir)
     if not os.path.exists(import_dir):
         raise Exception("Missing import directory!")
@@ -1046,15 +1149,36 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
         for user in data['zerver_userprofile']
     }
 
-    # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
-
-    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
-    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
-    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
-                        reaction_field=True)
-    update_model_ids(Reaction, data, 'reaction')
-    bulk_import_model(data, Reaction)
+    # Import zerver_message and zerver_usermessage, and then the
+    # other tables that can have a row for every message.
+    if defer_indexes:
+        deferred_indexes = drop_deferrable_indexes(DEFERRED_INDEX_TABLES)
+    else:
+        deferred_indexes = []
+    try:
+        import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                            processes=processes)
+
+        re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
+        re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
+        re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
+                            reaction_field=True)
+        update_model_ids(Reaction, data, 'reaction')
+        bulk_copy_model(data, Reaction)
+
+        # Do attachments AFTER message data is loaded.
+        # TODO: de-dup how we read these json files.
+        fn = os.path.join(import_dir, "attachment.json")
+        if not os.path.exists(fn):
+            raise Exception("Missing attachment.json file!")
+
+        logging.info("Importing attachment data from %s", fn)
+        with open(fn, "rb") as f:
+            attachment_data = orjson.loads(f.read())
+
+        import_attachments(attachment_data)
+    finally:
+        create_deferred_indexes(deferred_indexes)
 
     # Similarly, we need to recalculate the first_message_id for stream objects.
     for stream in Stream.objects.filter(realm=realm):
@@ -1066,18 +1190,6 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
             stream.first_message_id = first_message.id
         stream.save(update_fields=["first_message_id"])
 
-    # Do attachments AFTER message data is loaded.
-    # TODO: de-dup how we read these json files.
-    fn = os.path.join(import_dir, "attachment.json")
-    if not os.path.exists(fn):
-        raise Exception("Missing attachment.json file!")
-
-    logging.info("Importing attachment data from %s", fn)
-    with open(fn, "rb") as f:
-        data = orjson.loads(f.read())
-
-    import_attachments(data)
-
     # Import the analytics file.
     import_analytics_data(realm=realm, import_dir=import_dir)
 
@@ -1183,56 +1295,106 @@ def get_incoming_message_ids(import_dir: Path,
 
     return message_ids
 
-def import_message_data(realm: Realm,
-                        sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
+def get_message_dump_file_ids(import_dir: Path) -> List[int]:
+    dump_file_ids = []
     dump_file_id = 1
-    while True:
-        message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
-        if not os.path.exists(message_filename):
-            break
+    while os.path.exists(os.path.join(import_dir, f"messages-{dump_file_id:06}.json")):
+        dump_file_ids.append(dump_file_id)
+        dump_file_id += 1
+    return dump_file_ids
 
-        with open(message_filename, "rb") as f:
-            data = orjson.loads(f.read())
+def import_message_dump(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        import_dir: Path,
+                        dump_file_id: int) -> None:
+    message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
+    with open(message_filename, "rb") as f:
+        data = orjson.loads(f.read())
 
-        logging.info("Importing message dump %s", message_filename)
-        re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
-        re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
-        re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
-        fix_datetime_fields(data, 'zerver_message')
-        # Parser to update message content with the updated attachment urls
-        fix_upload_links(data, 'zerver_message')
-
-        # We already create mappings for zerver_message ids
-        # in update_message_foreign_keys(), so here we simply
-        # apply them.
-        message_id_map = ID_MAP['message']
-        for row in data['zerver_message']:
-            row['id'] = message_id_map[row['id']]
+    logging.info("Importing message dump %s", message_filename)
+    re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
+    re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
+    fix_datetime_fields(data, 'zerver_message')
+    # Parser to update message content with the updated attachment urls
+    fix_upload_links(data, 'zerver_message')
+
+    # We already create mappings for zerver_message ids
+    # in update_message_foreign_keys(), so here we simply
+    # apply them.
+    message_id_map = ID_MAP['message']
+    for row in data['zerver_message']:
+        row['id'] = message_id_map[row['id']]
+
+    for row in data['zerver_usermessage']:
+        assert(row['message'] in message_id_map)
+
+    fix_message_rendered_content(
+        realm=realm,
+        sender_map=sender_map,
+        messages=data['zerver_message'],
+    )
+    logging.info("Successfully rendered Markdown for message batch")
 
-        for row in data['zerver_usermessage']:
-            assert(row['message'] in message_id_map)
+    # A LOT HAPPENS HERE.
+    # This is where we actually import the message data.
+    bulk_copy_model(data, Message, dump_file_id)
 
-        fix_message_rendered_content(
-            realm=realm,
-            sender_map=sender_map,
-            messages=data['zerver_message'],
-        )
-        logging.info("Successfully rendered Markdown for message batch")
+    # Due to the structure of these message chunks, we're
+    # guaranteed to have already imported all the Message objects
+    # for this batch of UserMessage objects.
+    re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
+    re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
+    fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
 
-        # A LOT HAPPENS HERE.
-        # This is where we actually import the message data.
-        bulk_import_model(data, Message)
+    bulk_import_user_message_data(data, dump_file_id)
 
-        # Due to the structure of these message chunks, we're
-        # guaranteed to have already imported all the Message objects
-        # for this batch of UserMessage objects.
-        re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
-        re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
-        fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+def import_message_data(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        import_dir: Path,
+                        processes: int=1) -> None:
+    """Imports the messages-NNNNNN.json dump files.  The message ids
+    are all allocated up front (see update_message_foreign_keys), so
+    the dump files are independent of each other, and with several
+    processes we load them in parallel, each in its own forked
+    process (with its own database connection).  With a single dump
+    file, we instead render its messages' Markdown in parallel."""
+    dump_file_ids = get_message_dump_file_ids(import_dir)
+    start = time.perf_counter()
+
+    if processes > 1 and len(dump_file_ids) > 1:
+        close_connections_for_fork()
+
+        def import_dump_file(dump_file_id: int) -> int:
+            try:
+                import_message_dump(realm, sender_map, import_dir, dump_file_id)
+            except Exception:
+                logging.exception("Error importing message dump %s", dump_file_id)
+                return 1
+            return 0
 
-        bulk_import_user_message_data(data, dump_file_id)
-        dump_file_id += 1
+        # run_parallel stops starting new processes after one fails;
+        # we wait for the ones still running before giving up.
+        failed_dump_file_ids = []
+        for (status, dump_file_id) in run_parallel(import_dump_file, dump_file_ids, processes):
+            if status != 0:
+                failed_dump_file_ids.append(dump_file_id)
+        if failed_dump_file_ids:
+            raise Exception(f"Failed to import message dumps {sorted(failed_dump_file_ids)}")
+    else:
+        if processes > 1:
+            start_render_pool(processes)
+        try:
+            for dump_file_id in dump_file_ids:
+                import_message_dump(realm, sender_map, import_dir, dump_file_id)
+        finally:
+            stop_render_pool()
+
+    elapsed = time.perf_counter() - start
+    message_count = len(ID_MAP['message'])
+    logging.info("Imported %s messages from %s dump files in %.1fs (%.0f messages/s).",
+                 message_count, len(dump_file_ids), elapsed,
+                 message_count / elapsed if elapsed > 0 else 0.0)
 
 def import_attachments(data: TableData) -> None:
 
@@ -1292,18 +1454,10 @@ def import_attachments(data: TableData) -> None:
     # Now, go back to our m2m rows.
     # TODO: Do this the kosher Django way.  We may find a
     # better way to do this in Django 1.9 particularly.
-    with connection.cursor() as cursor:
-        sql_template = SQL('''
-            INSERT INTO {m2m_table_name} ({parent_id}, {child_id}) VALUES %s
-        ''').format(
-            m2m_table_name=Identifier(m2m_table_name),
-            parent_id=Identifier(parent_id),
-            child_id=Identifier(child_id),
-        )
-        tups = [(row[parent_id], row[child_id]) for row in m2m_rows]
-        execute_values(cursor.cursor, sql_template, tups)
-
-    logging.info('Successfully imported M2M table %s', m2m_table_name)
+    start = time.perf_counter()
+    count = copy_rows(m2m_table_name, [parent_id, child_id],
+                      ((row[parent_id], row[child_id]) for row in m2m_rows))
+    log_import_rate(parent_model.messages.through, m2m_table_name, count, start)
 
 def import_analytics_data(realm: Realm, import_dir: Path) -> None:
     analytics_filename = os.path.join(import_dir, "analytics.json")
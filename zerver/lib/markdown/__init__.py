@@ -2,6 +2,7 @@
 # detailed documentation on our Markdown syntax.
 import datetime
 import functools
+import hashlib
 import html
 import logging
 import os
@@ -20,6 +21,7 @@ from typing import (
     Iterable,
     List,
     Optional,
+    Sequence,
     Set,
     Tuple,
     TypeVar,
@@ -41,7 +43,7 @@ from markdown.extensions import codehilite, nl2br, sane_lists, tables
 from typing_extensions import TypedDict
 
 from zerver.lib import mention as mention
-from zerver.lib.cache import NotFoundInCache, cache_with_key
+from zerver.lib.cache import NotFoundInCache, cache_get, cache_set, cache_with_key
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import (
     codepoint_to_name,
@@ -51,6 +53,7 @@ from zerver.lib.emoji import (
 )
 from zerver.lib.exceptions import MarkdownRenderingException
 from zerver.lib.markdown import fenced_code
+from zerver.lib.markdown import profiler as markdown_profiler
 from zerver.lib.markdown.fenced_code import FENCE_RE
 from zerver.lib.mention import extract_user_group, possible_mentions, possible_user_group_mentions
 from zerver.lib.tex import render_tex
@@ -1607,30 +1610,83 @@ class MarkdownListPreprocessor(markdown.preprocessors.Preprocessor):
 # other delimiters from the actual content.  This value won't be an
 # option in user-entered capture groups.
 OUTER_CAPTURE_GROUP = "linkifier_actual_match"
-def prepare_realm_pattern(source: str) -> str:
+def prepare_realm_pattern(source: str, outer_capture_group: str=OUTER_CAPTURE_GROUP) -> str:
     """Augment a realm filter so it only matches after start-of-string,
     whitespace, or opening delimiters, won't match if there are word
     characters directly after, and saves what was matched as
-    OUTER_CAPTURE_GROUP."""
-    return fr"""(?<![^\s'"\(,:<])(?P<{OUTER_CAPTURE_GROUP}>{source})(?!\w)"""
+    outer_capture_group."""
+    return fr"""(?<![^\s'"\(,:<])(?P<{outer_capture_group}>{source})(?!\w)"""
 
-# Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
+# Named groups (and references to them) in a realm filter's pattern,
+# which we rename to keep them distinct when combining filters.
+realm_filter_group_name_re = re.compile(r'\(\?(P<|P=|\()([A-Za-z_]\w*)')
+
+class RealmFilterMatcher:
+    """A set of realm filters compiled into a single regular expression,
+    so that finding all of a realm's linkifiers in some text is one
+    pass over it, however many linkifiers the realm has.
+
+    Where filters overlap, the leftmost match wins, with ties going to
+    the filter that comes first.
+    """
+
+    def __init__(self, realm_filters: Sequence[Tuple[str, str]]) -> None:
+        self.format_strings: List[str] = []
+        self.outer_capture_groups: List[str] = []
+        self.group_names: List[List[Tuple[str, str]]] = []
+        alternatives: List[str] = []
+        for index, (source_pattern, format_string) in enumerate(realm_filters):
+            prefix = f'linkifier{index}_'
+            pattern = realm_filter_group_name_re.sub(
+                lambda m: f'(?{m.group(1)}{prefix}{m.group(2)}', source_pattern)
+            outer_capture_group = prefix + OUTER_CAPTURE_GROUP
+            alternatives.append(prepare_realm_pattern(pattern, outer_capture_group))
+            self.format_strings.append(format_string)
+            self.outer_capture_groups.append(outer_capture_group)
+            self.group_names.append([
+                (prefix + name, name)
+                for kind, name in realm_filter_group_name_re.findall(source_pattern)
+                if kind == 'P<'
+            ])
+        self.pattern = '(?:{})'.format('|'.join(alternatives))
+        self.regex = re.compile(self.pattern)
+
+    def get_match(self, m: Match[str]) -> Tuple[int, str, str]:
+        """Returns the index of the filter that made this match, the
+        URL it links to, and the text it matched."""
+        for index, outer_capture_group in enumerate(self.outer_capture_groups):
+            text = m.group(outer_capture_group)
+            if text is not None:
+                groups = {name: m.group(renamed) for renamed, name in self.group_names[index]}
+                return index, self.format_strings[index] % groups, text
+        raise AssertionError("Match doesn't belong to any realm filter")
+
+@functools.lru_cache(maxsize=512)
+def get_realm_filter_matcher(realm_filters: Tuple[Tuple[str, str], ...]) -> RealmFilterMatcher:
+    return RealmFilterMatcher(realm_filters)
+
+def realm_filter_matcher_for(realm_filters: Iterable[Tuple[str, str, int]]) -> RealmFilterMatcher:
+    """Returns the RealmFilterMatcher for a realm's filters.  This is
+    cached on the patterns and format strings themselves, so any change
+    to a realm's filters naturally gets a new matcher."""
+    return get_realm_filter_matcher(tuple(
+        (pattern, format_string) for (pattern, format_string, id) in realm_filters
+    ))
+
+# Linkifies text matching any of a RealmFilterMatcher's realm filters,
+# using the matching filter's format string to construct the URL.
 class RealmFilterPattern(markdown.inlinepatterns.Pattern):
-    """ Applied a given realm filter to the input """
+    """ Applies a realm's filters to the input """
 
-    def __init__(self, source_pattern: str,
-                 format_string: str,
+    def __init__(self, matcher: RealmFilterMatcher,
                  markdown_instance: Optional[markdown.Markdown]=None) -> None:
-        self.pattern = prepare_realm_pattern(source_pattern)
-        self.format_string = format_string
-        markdown.inlinepatterns.Pattern.__init__(self, self.pattern, markdown_instance)
+        self.matcher = matcher
+        markdown.inlinepatterns.Pattern.__init__(self, matcher.pattern, markdown_instance)
 
     def handleMatch(self, m: Match[str]) -> Union[Element, str]:
         db_data = self.md.zulip_db_data
-        return url_to_a(db_data,
-                        self.format_string % m.groupdict(),
-                        m.group(OUTER_CAPTURE_GROUP))
+        index, url, text = self.matcher.get_match(m)
+        return url_to_a(db_data, url, text)
 
 class UserMentionPattern(markdown.inlinepatterns.Pattern):
     def handleMatch(self, m: Match[str]) -> Optional[Element]:
@@ -1971,9 +2027,10 @@ class Markdown(markdown.Markdown):
         return reg
 
     def register_realm_filters(self, inlinePatterns: markdown.util.Registry) -> markdown.util.Registry:
-        for (pattern, format_string, id) in self.getConfig("realm_filters"):
-            inlinePatterns.register(RealmFilterPattern(pattern, format_string, self),
-                                    f'realm_filters/{pattern}', 45)
+        realm_filters = self.getConfig("realm_filters")
+        if realm_filters:
+            inlinePatterns.register(RealmFilterPattern(realm_filter_matcher_for(realm_filters), self),
+                                    'realm_filters', 45)
         return inlinePatterns
 
     def build_treeprocessors(self) -> markdown.util.Registry:
@@ -2047,8 +2104,17 @@ def build_engine(realm_filters: List[Tuple[str, str, int]],
                 guess_lang=False,
             ),
         ])
+    if markdown_profiler.is_profiling_enabled():
+        markdown_profiler.instrument_engine(engine)
     return engine
 
+def enable_markdown_profiling() -> None:
+    """Turns on per-extension profiling in this process (see
+    zerver.lib.markdown.profiler); existing engines are discarded so
+    that they get rebuilt with instrumentation."""
+    markdown_profiler.profiling_enabled = True
+    md_engines.clear()
+
 # Split the topic name into multiple sections so that we can easily use
 # our common single link matching regex on it.
 basic_link_splitter = re.compile(r'[ !;\?\),\'\"]')
@@ -2062,10 +2128,15 @@ def topic_links(realm_filters_key: int, topic_name: str) -> List[str]:
 
     realm_filters = realm_filters_for_realm(realm_filters_key)
 
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, topic_name):
-            matches += [realm_filter[1] % m.groupdict()]
+    if realm_filters:
+        matcher = realm_filter_matcher_for(realm_filters)
+        realm_filter_links: List[Tuple[int, str]] = []
+        for m in matcher.regex.finditer(topic_name):
+            index, url, text = matcher.get_match(m)
+            realm_filter_links.append((index, url))
+        # List the links in the order of the realm filters that made them.
+        realm_filter_links.sort(key=lambda link: link[0])
+        matches += [url for index, url in realm_filter_links]
 
     # Also make raw urls navigable.
     for sub_string in basic_link_splitter.split(topic_name):
@@ -2244,6 +2315,55 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     return dct
 
 
+def content_may_have_per_message_state(
+        content: str,
+        realm_alert_words_automaton: Optional[ahocorasick.Automaton]) -> bool:
+    """Whether rendering this content might depend on (or record on the
+    message) more than markdown_render_cache_key accounts for: user and
+    group mentions, stream links, and alert words.  We check for this
+    conservatively, since these are rare compared to the cost of a
+    wrong cache hit."""
+    if '@' in content or '#**' in content:
+        return True
+    if realm_alert_words_automaton is not None:
+        # Alert words don't change the HTML, but rendering records which
+        # users' alert words the message contains.
+        for _ in realm_alert_words_automaton.iter(content.lower()):
+            return True
+    return False
+
+def markdown_render_cache_key(content: str,
+                              realm_filters_key: int,
+                              message_realm: Optional[Realm],
+                              has_message: bool,
+                              sent_by_bot: bool,
+                              translate_emoticons: bool,
+                              email_gateway: bool,
+                              image_preview: bool,
+                              url_embed_preview: bool) -> str:
+    # Rather than versioning the realm's linkifiers and custom emoji,
+    # we hash their current values (both of which are cached) into the
+    # key, so that changing them naturally misses the old entries.
+    if message_realm is not None and content_has_emoji_syntax(content):
+        active_realm_emoji = sorted(message_realm.get_active_emoji().items())
+    else:
+        active_realm_emoji = []
+    key_data = repr((
+        version,
+        content,
+        realm_filters_key,
+        realm_filter_data.get(realm_filters_key),
+        active_realm_emoji,
+        message_realm.uri if message_realm is not None else None,
+        has_message,
+        sent_by_bot,
+        translate_emoticons,
+        email_gateway,
+        image_preview,
+        url_embed_preview,
+    ))
+    return 'markdown_render:' + hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
 def do_convert(content: str,
                realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
                message: Optional[Message]=None,
@@ -2279,6 +2399,33 @@ def do_convert(content: str,
                 realm_filters_key = ZEPHYR_MIRROR_MARKDOWN_KEY
 
     maybe_update_markdown_engines(realm_filters_key, email_gateway)
+    image_preview = image_preview_enabled(message, message_realm, no_previews)
+    url_embed_preview = url_embed_preview_enabled(message, message_realm, no_previews)
+
+    # With MARKDOWN_RENDER_CACHE, content whose rendering can't depend
+    # on per-message state is looked up in the remote cache, keyed by
+    # everything else the rendering depends on.
+    render_cache_key = None
+    if settings.MARKDOWN_RENDER_CACHE and not content_may_have_per_message_state(
+            content, realm_alert_words_automaton):
+        render_cache_key = markdown_render_cache_key(
+            content, realm_filters_key, message_realm, message is not None,
+            sent_by_bot, translate_emoticons, email_gateway,
+            image_preview, url_embed_preview,
+        )
+        cached = cache_get(render_cache_key)
+        if cached is not None:
+            markdown_render_cache_stats_finish(hit=True)
+            cached_content, message_link_data = cached[0]
+            if message is not None:
+                # Restore what InlineInterestingLinkProcessor would
+                # have set on the message.
+                (message.has_link, message.has_image,
+                 potential_attachment_path_ids) = message_link_data
+                message.potential_attachment_path_ids = list(potential_attachment_path_ids)
+            return cached_content
+        markdown_render_cache_stats_finish(hit=False)
+
     md_engine_key = (realm_filters_key, email_gateway)
 
     if md_engine_key in md_engines:
@@ -2295,10 +2442,8 @@ def do_convert(content: str,
     _md_engine.zulip_message = message
     _md_engine.zulip_realm = message_realm
     _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(
-        message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews)
+    _md_engine.image_preview_enabled = image_preview
+    _md_engine.url_embed_preview_enabled = url_embed_preview
 
     # Pre-fetch data from the DB that is used in the Markdown thread
     if message_realm is not None:
@@ -2336,7 +2481,17 @@ def do_convert(content: str,
         # extremely inefficient in corner cases) as well as user
         # errors (e.g. a realm filter that makes some syntax
         # infinite-loop).
-        rendered_content = timeout(5, _md_engine.convert, content)
+        if markdown_profiler.is_profiling_enabled():
+            markdown_profiler.start_render()
+            render_start = time.perf_counter()
+            rendered_content = timeout(5, _md_engine.convert, content)
+            markdown_profiler.finish_render(
+                time.perf_counter() - render_start,
+                message.id if message is not None else None,
+                message_realm.id if message_realm is not None else None,
+            )
+        else:
+            rendered_content = timeout(5, _md_engine.convert, content)
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -2345,6 +2500,17 @@ def do_convert(content: str,
             raise MarkdownRenderingException(
                 f'Rendered content exceeds {MAX_MESSAGE_LENGTH * 10} characters (message {logging_message_id})'
             )
+
+        # Links still waiting to be fetched for embedding are recorded
+        # on the message, so we can't skip rendering content with any.
+        if render_cache_key is not None and not getattr(message, 'links_for_preview', None):
+            # The key includes whether there's a message, so entries
+            # for messages always have this data.
+            message_link_data = None
+            if message is not None:
+                message_link_data = (message.has_link, message.has_image,
+                                     message.potential_attachment_path_ids)
+            cache_set(render_cache_key, (rendered_content, message_link_data))
         return rendered_content
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -2369,6 +2535,8 @@ def do_convert(content: str,
 markdown_time_start = 0.0
 markdown_total_time = 0.0
 markdown_total_requests = 0
+markdown_render_cache_hits = 0
+markdown_render_cache_misses = 0
 
 def get_markdown_time() -> float:
     return markdown_total_time
@@ -2376,6 +2544,20 @@ def get_markdown_time() -> float:
 def get_markdown_requests() -> int:
     return markdown_total_requests
 
+def get_markdown_render_cache_hits() -> int:
+    return markdown_render_cache_hits
+
+def get_markdown_render_cache_misses() -> int:
+    return markdown_render_cache_misses
+
+def markdown_render_cache_stats_finish(hit: bool) -> None:
+    global markdown_render_cache_hits
+    global markdown_render_cache_misses
+    if hit:
+        markdown_render_cache_hits += 1
+    else:
+        markdown_render_cache_misses += 1
+
 def markdown_stats_start() -> None:
     global markdown_time_start
     markdown_time_start = time.time()
@@ -0,0 +1,140 @@
+"""Opt-in timing of the individual processors in our Markdown engines.
+
+When profiling is enabled (with the MARKDOWN_PROFILING setting, or
+by calling enable_markdown_profiling in zerver.lib.markdown), each
+Markdown engine we build has its preprocessors, block processors,
+inline patterns, treeprocessors and postprocessors wrapped to record
+how long they take and how often they run.  Renders slower than
+SLOW_RENDER_THRESHOLD are logged with their breakdown, and kept as
+samples for ./manage.py profile_markdown to replay.
+
+Note that the "inline" treeprocessor is what runs the inline
+patterns, so its time includes theirs.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, TypeVar, cast
+
+import markdown
+from django.conf import settings
+
+profile_logger = logging.getLogger('zulip.markdown.profile')
+
+SLOW_RENDER_THRESHOLD = 0.5
+MAX_SLOW_RENDER_SAMPLES = 100
+
+profiling_enabled = False
+
+class ExtensionStats:
+    __slots__ = ('calls', 'time')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.time = 0.0
+
+class SlowRender(NamedTuple):
+    message_id: Optional[int]
+    realm_id: Optional[int]
+    time: float
+    extension_times: List[Tuple[str, float]]
+
+# Totals since the process started (or reset_profile was called).
+extension_stats: Dict[str, ExtensionStats] = {}
+# Time spent in each extension during the current render.
+render_extension_times: Dict[str, float] = {}
+slow_render_samples: Deque[SlowRender] = deque(maxlen=MAX_SLOW_RENDER_SAMPLES)
+# Renders run in a thread (see zerver.lib.timeout), and the engines
+# are shared, so we serialize updates to the stats.
+stats_lock = threading.Lock()
+
+def is_profiling_enabled() -> bool:
+    return profiling_enabled or settings.MARKDOWN_PROFILING
+
+def record(name: str, elapsed: float, calls: int=1) -> None:
+    with stats_lock:
+        stats = extension_stats.get(name)
+        if stats is None:
+            stats = extension_stats[name] = ExtensionStats()
+        stats.calls += calls
+        stats.time += elapsed
+        render_extension_times[name] = render_extension_times.get(name, 0.0) + elapsed
+
+FuncT = TypeVar('FuncT', bound=Callable[..., Any])
+
+def timed(name: str, func: FuncT, calls: int=1) -> FuncT:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start, calls)
+    return cast(FuncT, wrapper)  # https://github.com/python/mypy/issues/1927
+
+class TimedRegex:
+    """Wraps an inline pattern's compiled regular expression, so that
+    the time Python-Markdown spends trying the pattern is counted along
+    with the time spent in its handleMatch."""
+
+    def __init__(self, name: str, regex: Any) -> None:
+        self.regex = regex
+        self.match = timed(name, regex.match)
+        self.search = timed(name, regex.search)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.regex, attr)
+
+def instrument_engine(engine: markdown.Markdown) -> None:
+    # Python-Markdown doesn't expose the names in a Registry, so we
+    # use its internal list of them.
+    for kind, registry in [('preprocessors', engine.preprocessors),
+                           ('blockprocessors', engine.parser.blockprocessors),
+                           ('treeprocessors', engine.treeprocessors),
+                           ('postprocessors', engine.postprocessors)]:
+        for item in registry._priority:
+            processor = registry[item.name]
+            name = f'{kind}/{item.name}'
+            processor.run = timed(name, processor.run)
+            if kind == 'blockprocessors':
+                processor.test = timed(name, processor.test, calls=0)
+
+    for item in engine.inlinePatterns._priority:
+        pattern = engine.inlinePatterns[item.name]
+        name = f'inlinepatterns/{item.name}'
+        timed_regex = TimedRegex(name, pattern.getCompiledRegExp())
+        pattern.getCompiledRegExp = lambda timed_regex=timed_regex: timed_regex
+        pattern.handleMatch = timed(name, pattern.handleMatch, calls=0)
+
+def start_render() -> None:
+    with stats_lock:
+        render_extension_times.clear()
+
+def finish_render(elapsed: float, message_id: Optional[int], realm_id: Optional[int]) -> None:
+    if elapsed < SLOW_RENDER_THRESHOLD:
+        return
+    with stats_lock:
+        extension_times = sorted(render_extension_times.items(),
+                                 key=lambda item: item[1], reverse=True)
+    slow_render_samples.append(SlowRender(message_id, realm_id, elapsed, extension_times))
+    # We don't log the content, for privacy; the message ID is enough
+    # to replay the render with ./manage.py profile_markdown.
+    profile_logger.info(
+        'Slow Markdown render (message %s, realm %s): %.3fs; %s',
+        message_id or 'unknown',
+        realm_id or 'unknown',
+        elapsed,
+        ', '.join(f'{name} {extension_time:.3f}s' for name, extension_time in extension_times[:5]),
+    )
+
+def get_extension_stats() -> List[Tuple[str, ExtensionStats]]:
+    with stats_lock:
+        return sorted(extension_stats.items(), key=lambda item: item[1].time, reverse=True)
+
+def reset_profile() -> None:
+    with stats_lock:
+        extension_stats.clear()
+        render_extension_times.clear()
+    slow_render_samples.clear()
@@ -825,13 +825,16 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
 
+    # We fetch tuples rather than dicts; for users with tens of
+    # thousands of unread messages, building the rows (and the loop
+    # below) is a large part of the cost of this function.
     user_msgs = UserMessage.objects.filter(
         user_profile=user_profile,
     ).exclude(
         message__recipient_id__in=excluded_recipient_ids,
     ).extra(
         where=[UserMessage.where_unread()],
-    ).values(
+    ).values_list(
         'message_id',
         'message__sender_id',
         MESSAGE__TOPIC,
@@ -842,22 +845,26 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     ).order_by("-message_id")
 
     # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
-
-    rows = list(reversed(user_msgs))
+    rows = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    rows.reverse()
 
     muted_stream_ids = get_muted_stream_ids(user_profile)
+    muted_stream_id_set = set(muted_stream_ids)
 
     topic_mute_checker = build_topic_mute_checker(user_profile)
 
-    def is_row_muted(stream_id: int, recipient_id: int, topic: str) -> bool:
-        if stream_id in muted_stream_ids:
-            return True
+    # Unread messages are mostly in a few topics, so we only check
+    # whether each topic is muted once.
+    topic_muted_cache: Dict[Tuple[int, str], bool] = {}
 
-        if topic_mute_checker(recipient_id, topic):
+    def is_row_muted(stream_id: int, recipient_id: int, topic: str) -> bool:
+        if stream_id in muted_stream_id_set:
             return True
 
-        return False
+        key = (recipient_id, topic)
+        if key not in topic_muted_cache:
+            topic_muted_cache[key] = topic_mute_checker(recipient_id, topic)
+        return topic_muted_cache[key]
 
     huddle_cache: Dict[int, str] = {}
 
@@ -875,15 +882,12 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     huddle_dict = {}
     mentions = set()
 
-    for row in rows:
-        message_id = row['message_id']
-        msg_type = row['message__recipient__type']
-        recipient_id = row['message__recipient_id']
-        sender_id = row['message__sender_id']
+    mentioned_flag = UserMessage.flags.mentioned.mask
+    wildcard_mentioned_flag = UserMessage.flags.wildcard_mentioned.mask
 
+    for message_id, sender_id, topic, recipient_id, msg_type, type_id, flags in rows:
         if msg_type == Recipient.STREAM:
-            stream_id = row['message__recipient__type_id']
-            topic = row[MESSAGE__TOPIC]
+            stream_id = type_id
             stream_dict[message_id] = dict(
                 stream_id=stream_id,
                 topic=topic,
@@ -894,7 +898,7 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
         elif msg_type == Recipient.PERSONAL:
             if sender_id == user_profile.id:
-                other_user_id = row['message__recipient__type_id']
+                other_user_id = type_id
             else:
                 other_user_id = sender_id
 
@@ -915,15 +919,13 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
             )
 
         # TODO: Add support for alert words here as well.
-        is_mentioned = (row['flags'] & UserMessage.flags.mentioned) != 0
-        is_wildcard_mentioned = (row['flags'] & UserMessage.flags.wildcard_mentioned) != 0
+        is_mentioned = (flags & mentioned_flag) != 0
+        is_wildcard_mentioned = (flags & wildcard_mentioned_flag) != 0
         if is_mentioned:
             mentions.add(message_id)
         if is_wildcard_mentioned:
             if msg_type == Recipient.STREAM:
-                stream_id = row['message__recipient__type_id']
-                topic = row[MESSAGE__TOPIC]
-                if not is_row_muted(stream_id, recipient_id, topic):
+                if not is_row_muted(type_id, recipient_id, topic):
                     mentions.add(message_id)
             else:  # nocoverage # TODO: Test wildcard mentions in PMs.
                 mentions.add(message_id)
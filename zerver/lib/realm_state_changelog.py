@@ -0,0 +1,112 @@
+"""A short changelog, per realm, of the events that update the parts
+of the /register state every user in a realm shares: the realm's users
+and their presence.
+
+send_event records each such event in the remote cache, under the
+next value of a per-realm version counter.  /register returns the
+realm's version, and a client whose event queue has been
+garbage-collected can pass it back when it registers again; if the
+changelog still has every event since that version, the client gets
+just those events, to apply to its copy of the state as it would
+apply them from its event queue, instead of the realm's full user
+list and presence data.
+
+These events can safely be applied more than once, so the changelog
+doesn't need to line up exactly with what the client's old queue
+delivered.  An event that wasn't sent to exactly the realm's active
+users is recorded only as a marker that the delta is incomplete;
+clients registering across it get the full state.
+"""
+import time
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+from zerver.lib import cache
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set,
+    get_cache_backend,
+    realm_state_event_cache_key,
+    realm_state_version_cache_key,
+)
+from zerver.models import UserProfile, active_user_ids
+
+REALM_STATE_EVENT_TYPES = {'realm_user', 'presence'}
+
+# How long we keep each event, and the most events we'll send a
+# client instead of the full state.
+REALM_STATE_EVENT_TIMEOUT = 6 * 60 * 60
+MAX_REALM_STATE_DELTA_EVENTS = 2000
+
+def get_version_key(realm_id: int) -> str:
+    return cache.KEY_PREFIX + realm_state_version_cache_key(realm_id)
+
+def initialize_realm_state_version(realm_id: int) -> None:
+    # If the counter is evicted from the cache, we restart it above any
+    # value the old counter could plausibly have reached, so that no
+    # client's version refers to events from the old counter.
+    get_cache_backend(None).add(get_version_key(realm_id), int(time.time()) << 20,
+                                timeout=None)
+
+def get_realm_state_version(realm_id: int) -> int:
+    initialize_realm_state_version(realm_id)
+    version = get_cache_backend(None).get(get_version_key(realm_id))
+    if version is None:  # nocoverage
+        # Evicted since we added it; any value past the old counter will do.
+        return int(time.time()) << 20
+    return version
+
+def record_realm_state_event(realm_id: int, event: Mapping[str, Any],
+                             user_ids: Iterable[int]) -> None:
+    # Events sent to only some users, like a user's own delivery_email
+    # change, aren't part of the state the realm's users share, and
+    # we can't tell those from a realm-wide event whose recipients
+    # were computed before a user joined or left.  Either way, we
+    # record only that the changelog is incomplete from here, so
+    # that clients registering across it get the full state.
+    realm_wide = set(user_ids) == set(active_user_ids(realm_id))
+
+    initialize_realm_state_version(realm_id)
+    try:
+        version = get_cache_backend(None).incr(get_version_key(realm_id))
+    except ValueError:  # nocoverage
+        # The counter was evicted after we added it; when it's
+        # restarted, every older version will be out of range.
+        return
+    cache_set(realm_state_event_cache_key(realm_id, version),
+              dict(event) if realm_wide else None,
+              timeout=REALM_STATE_EVENT_TIMEOUT)
+
+def get_realm_state_events(user_profile: UserProfile, since_version: int, version: int,
+                           slim_presence: bool) -> Optional[List[Dict[str, Any]]]:
+    """Returns the events recorded for the user's realm after
+    since_version, up to and including version, formatted as the
+    user's event queue would deliver them.  Returns None if the client
+    needs the full state instead: the changelog no longer has all of
+    them, one of them wasn't sent to the whole realm, or the user's
+    own role has changed, which changes which fields they can see on
+    other users.
+    """
+    realm_id = user_profile.realm_id
+    if not 0 <= version - since_version <= MAX_REALM_STATE_DELTA_EVENTS:
+        return None
+
+    keys = [realm_state_event_cache_key(realm_id, event_version)
+            for event_version in range(since_version + 1, version + 1)]
+    cached_events = cache_get_many(keys)
+    if len(cached_events) != len(keys):
+        return None
+
+    events = []
+    for key in keys:
+        event = cached_events[key][0]
+        if event is None:
+            return None
+        if event['type'] == 'realm_user' and event['op'] == 'update':
+            person = event['person']
+            if person['user_id'] == user_profile.id and 'role' in person:
+                return None
+        if event['type'] == 'presence' and slim_presence:
+            # Like process_presence_event in zerver/tornado/event_queue.py.
+            event = {field: value for field, value in event.items() if field != 'email'}
+        events.append(event)
+    return events
@@ -0,0 +1,132 @@
+import multiprocessing
+from multiprocessing.pool import Pool
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import ahocorasick
+from django.core.cache import caches
+from django.db import connection, connections
+
+from zerver.lib.exceptions import MarkdownRenderingException
+from zerver.lib.markdown import MentionData, markdown_convert
+from zerver.lib.message import do_render_markdown
+from zerver.models import Message, Realm
+
+# The attributes do_render_markdown sets on the Message object it is
+# given, which we copy back from the workers.
+RENDERED_MESSAGE_ATTRIBUTES = [
+    'mentions_wildcard',
+    'mentions_user_ids',
+    'mentions_user_group_ids',
+    'alert_words',
+    'links_for_preview',
+    'user_ids_with_alert_words',
+    'has_link',
+    'has_image',
+    'potential_attachment_path_ids',
+]
+
+# Below this many jobs, the overhead of shipping them to the pool
+# outweighs the benefit of rendering them in parallel.
+MIN_JOBS_FOR_RENDER_POOL = 8
+
+class RenderJob(NamedTuple):
+    content: str
+    realm: Optional[Realm]
+    sent_by_bot: bool = False
+    translate_emoticons: bool = False
+    message: Optional[Message] = None
+    realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None
+    mention_data: Optional[MentionData] = None
+    email_gateway: bool = False
+
+class RenderResult(NamedTuple):
+    # None if rendering failed with a MarkdownRenderingException.
+    rendered_content: Optional[str]
+    message_attributes: Dict[str, Any]
+
+render_pool: Optional[Pool] = None
+render_pool_processes = 0
+
+def start_render_pool(processes: int) -> None:
+    """Starts a pool of worker processes for bulk_render_markdown.
+    The workers are forked from this process, and keep their Markdown
+    engines warm across jobs.
+
+    This closes this process's database and cache connections, so that
+    the workers don't share them; it must not be called inside a
+    transaction.
+    """
+    global render_pool, render_pool_processes
+    assert render_pool is None
+    assert not connection.in_atomic_block
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+    render_pool = multiprocessing.get_context('fork').Pool(processes)
+    render_pool_processes = processes
+
+def stop_render_pool() -> None:
+    global render_pool
+    if render_pool is not None:
+        render_pool.close()
+        render_pool.join()
+        render_pool = None
+
+def render_job(job: RenderJob) -> RenderResult:
+    message = job.message
+    try:
+        if message is not None:
+            assert job.realm is not None
+            rendered_content: Optional[str] = do_render_markdown(
+                message=message,
+                content=job.content,
+                realm=job.realm,
+                sent_by_bot=job.sent_by_bot,
+                translate_emoticons=job.translate_emoticons,
+                realm_alert_words_automaton=job.realm_alert_words_automaton,
+                mention_data=job.mention_data,
+                email_gateway=job.email_gateway,
+            )
+        else:
+            rendered_content = markdown_convert(
+                job.content,
+                message_realm=job.realm,
+                sent_by_bot=job.sent_by_bot,
+                translate_emoticons=job.translate_emoticons,
+                realm_alert_words_automaton=job.realm_alert_words_automaton,
+                mention_data=job.mention_data,
+                email_gateway=job.email_gateway,
+            )
+    except MarkdownRenderingException:
+        rendered_content = None
+
+    message_attributes: Dict[str, Any] = {}
+    if message is not None:
+        message_attributes = {
+            attribute: getattr(message, attribute)
+            for attribute in RENDERED_MESSAGE_ATTRIBUTES
+            # A render that failed may not have set them all.
+            if hasattr(message, attribute)
+        }
+    return RenderResult(rendered_content, message_attributes)
+
+def bulk_render_markdown(jobs: Sequence[RenderJob]) -> List[Optional[str]]:
+    """Renders each job's content, in the render pool if one has been
+    started (and the batch is large enough to benefit), and in this
+    process otherwise.  Returns the rendered content for each job, or
+    None for those that failed to render; like do_render_markdown, it
+    sets the mention, alert word and link attributes on any job's
+    message.
+    """
+    if render_pool is None or len(jobs) < MIN_JOBS_FOR_RENDER_POOL:
+        return [render_job(job).rendered_content for job in jobs]
+
+    # The workers render pickled copies of the messages, so we copy
+    # the attributes rendering sets back onto the originals.
+    chunksize = max(1, len(jobs) // (4 * render_pool_processes))
+    results = render_pool.map(render_job, jobs, chunksize=chunksize)
+    for job, result in zip(jobs, results):
+        if job.message is not None:
+            for attribute, value in result.message_attributes.items():
+                setattr(job.message, attribute, value)
+    return [result.rendered_content for result in results]
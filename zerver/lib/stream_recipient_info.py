@@ -0,0 +1,147 @@
+from typing import AbstractSet, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from zerver.lib.cache import (
+    SnapshotCache,
+    get_version_keys,
+    realm_user_settings_version_cache_key,
+    recipient_subscribers_version_cache_key,
+)
+from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
+from zerver.models import Stream, UserProfile, query_for_ids
+
+
+class RecipientUserRow(NamedTuple):
+    id: int
+    enable_online_push_notifications: bool
+    is_bot: bool
+    bot_type: Optional[int]
+    long_term_idle: bool
+
+def get_recipient_user_rows(user_ids: AbstractSet[int]) -> List[RecipientUserRow]:
+    if not user_ids:
+        return []
+    query = UserProfile.objects.filter(
+        is_active=True,
+    ).values_list(
+        'id',
+        'enable_online_push_notifications',
+        'is_bot',
+        'bot_type',
+        'long_term_idle',
+    )
+
+    # query_for_ids is fast highly optimized for large queries, and we
+    # need this codepath to be fast (it's part of sending messages)
+    query = query_for_ids(
+        query=query,
+        user_ids=sorted(user_ids),
+        field='id',
+    )
+    return [RecipientUserRow(*row) for row in query]
+
+class StreamSubscriberInfo:
+    """What get_recipient_info needs to know about a stream's
+    subscribers, before accounting for topic muting: who they are,
+    which of them get stream push/email and wildcard mention
+    notifications, and the RecipientUserRow of each active one.
+    """
+
+    __slots__ = (
+        'realm_id',
+        'subscriber_ids',
+        'subscriber_id_set',
+        'stream_push_user_ids',
+        'stream_email_user_ids',
+        'wildcard_mention_user_ids',
+        'user_rows',
+    )
+
+    def __init__(self, realm_id: int) -> None:
+        self.realm_id = realm_id
+        self.subscriber_ids: List[int] = []
+        self.subscriber_id_set: Set[int] = set()
+        self.stream_push_user_ids: Set[int] = set()
+        self.stream_email_user_ids: Set[int] = set()
+        self.wildcard_mention_user_ids: Set[int] = set()
+        self.user_rows: Dict[int, RecipientUserRow] = {}
+
+# Snapshots for the streams this process has recently sent messages
+# to; a snapshot is only used while the stream's and realm's version
+# keys in the remote cache still match it.
+MAX_CACHED_STREAMS = 100
+stream_subscriber_info_cache: SnapshotCache[int, StreamSubscriberInfo] = SnapshotCache(
+    MAX_CACHED_STREAMS)
+# A stream's realm never changes, so these are never out of date.
+stream_realm_ids: SnapshotCache[int, int] = SnapshotCache(100 * MAX_CACHED_STREAMS)
+
+def get_versions(recipient_id: int, realm_id: int) -> Tuple[str, str]:
+    stream_key = recipient_subscribers_version_cache_key(recipient_id)
+    realm_key = realm_user_settings_version_cache_key(realm_id)
+    versions = get_version_keys([stream_key, realm_key])
+    return (versions[stream_key], versions[realm_key])
+
+def build_stream_subscriber_info(stream_id: int, realm_id: int) -> StreamSubscriberInfo:
+    info = StreamSubscriberInfo(realm_id)
+    rows = get_active_subscriptions_for_stream_id(stream_id).values_list(
+        'user_profile_id',
+        'is_muted',
+        'push_notifications',
+        'email_notifications',
+        'wildcard_mentions_notify',
+        'user_profile__enable_stream_push_notifications',
+        'user_profile__enable_stream_email_notifications',
+        'user_profile__wildcard_mentions_notify',
+        'user_profile__is_active',
+        'user_profile__enable_online_push_notifications',
+        'user_profile__is_bot',
+        'user_profile__bot_type',
+        'user_profile__long_term_idle',
+    ).order_by('user_profile_id')
+
+    for (user_profile_id, is_muted, push_notifications, email_notifications,
+         wildcard_mentions_notify, user_push_notifications, user_email_notifications,
+         user_wildcard_mentions_notify, is_active, enable_online_push_notifications,
+         is_bot, bot_type, long_term_idle) in rows:
+        info.subscriber_ids.append(user_profile_id)
+
+        # The UserProfile stream notification settings are defaults,
+        # which can be overridden by the stream-level settings (if
+        # those values are not null); muting a stream overrides both.
+        if not is_muted:
+            if (push_notifications if push_notifications is not None
+                    else user_push_notifications):
+                info.stream_push_user_ids.add(user_profile_id)
+            if (email_notifications if email_notifications is not None
+                    else user_email_notifications):
+                info.stream_email_user_ids.add(user_profile_id)
+            if (wildcard_mentions_notify if wildcard_mentions_notify is not None
+                    else user_wildcard_mentions_notify):
+                info.wildcard_mention_user_ids.add(user_profile_id)
+
+        if is_active:
+            info.user_rows[user_profile_id] = RecipientUserRow(
+                user_profile_id, enable_online_push_notifications, is_bot, bot_type,
+                long_term_idle,
+            )
+
+    info.subscriber_id_set = set(info.subscriber_ids)
+    return info
+
+def get_stream_subscriber_info(recipient_id: int, stream_id: int) -> StreamSubscriberInfo:
+    """Returns the StreamSubscriberInfo for a stream, from this
+    process's snapshot if neither the stream's subscriptions nor the
+    notification settings of users in its realm have changed since it
+    was built (see flush_recipient_subscribers and flush_user_profile),
+    or from the database otherwise.
+    """
+    realm_id = stream_realm_ids.get(stream_id, None)
+    if realm_id is None:
+        realm_id = Stream.objects.values_list('realm_id', flat=True).get(id=stream_id)
+        stream_realm_ids.set(stream_id, None, realm_id)
+
+    versions = get_versions(recipient_id, realm_id)
+    info = stream_subscriber_info_cache.get(stream_id, versions)
+    if info is None:
+        info = build_stream_subscriber_info(stream_id, realm_id)
+        stream_subscriber_info_cache.set(stream_id, versions, info)
+    return info
@@ -0,0 +1,113 @@
+"""A cache of the active users subscribed to each stream, for the code
+that needs the subscribers of many streams at once: the subscriber
+lists in /register (bulk_get_subscriber_user_ids) and the peer_add and
+peer_remove events (get_user_ids_for_streams).
+
+Each stream's subscriber IDs are stored in the remote cache as a
+sorted array of 32-bit integers, with the values the stream's
+subscribers version key and its realm's active users version key had
+before we queried them; a list is only used while both keys still
+have those values (see flush_recipient_subscribers and
+flush_user_profile).
+"""
+from array import array
+from typing import Any, Collection, Dict, List
+
+from django.db import connection
+from psycopg2.sql import SQL
+
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
+    get_version_keys,
+    realm_active_users_version_cache_key,
+    recipient_subscriber_ids_cache_key,
+    recipient_subscribers_version_cache_key,
+)
+
+
+def encode_user_ids(user_ids: List[int]) -> bytes:
+    return array('i', user_ids).tobytes()
+
+def decode_user_ids(data: bytes) -> List[int]:
+    user_ids = array('i')
+    user_ids.frombytes(data)
+    return user_ids.tolist()
+
+def fetch_subscriber_ids(recipient_ids: List[int]) -> Dict[int, List[int]]:
+    '''
+    The raw SQL below leads to more than a 2x speedup when tested with
+    20k+ total subscribers.  (For large realms with lots of default
+    streams, this function deals with LOTS of data, so it is important
+    to optimize.)
+    '''
+
+    query = SQL('''
+        SELECT
+            zerver_subscription.recipient_id,
+            zerver_subscription.user_profile_id
+        FROM
+            zerver_subscription
+        INNER JOIN zerver_userprofile ON
+            zerver_userprofile.id = zerver_subscription.user_profile_id
+        WHERE
+            zerver_subscription.recipient_id in %(recipient_ids)s AND
+            zerver_subscription.active AND
+            zerver_userprofile.is_active
+        ORDER BY
+            zerver_subscription.recipient_id,
+            zerver_subscription.user_profile_id
+        ''')
+
+    cursor = connection.cursor()
+    cursor.execute(query, {"recipient_ids": tuple(recipient_ids)})
+    rows = cursor.fetchall()
+    cursor.close()
+
+    result: Dict[int, List[int]] = {recipient_id: [] for recipient_id in recipient_ids}
+    for recipient_id, user_profile_id in rows:
+        result[recipient_id].append(user_profile_id)
+    return result
+
+def get_subscriber_ids_for_recipients(realm_id: int,
+                                      recipient_ids: Collection[int]) -> Dict[int, List[int]]:
+    """Returns the sorted IDs of the active users subscribed to each of
+    the given stream recipients, which must all be in the given realm.
+    """
+    if not recipient_ids:
+        return {}
+
+    realm_key = realm_active_users_version_cache_key(realm_id)
+    stream_keys = {
+        recipient_id: recipient_subscribers_version_cache_key(recipient_id)
+        for recipient_id in recipient_ids
+    }
+    versions = get_version_keys([realm_key, *stream_keys.values()])
+
+    cached_lists = cache_get_many([recipient_subscriber_ids_cache_key(recipient_id)
+                                   for recipient_id in recipient_ids])
+    result: Dict[int, List[int]] = {}
+    for recipient_id in recipient_ids:
+        cached = cached_lists.get(recipient_subscriber_ids_cache_key(recipient_id))
+        if cached is None:
+            continue
+        stream_version, realm_version, data = cached
+        if stream_version == versions[stream_keys[recipient_id]] and \
+                realm_version == versions[realm_key]:
+            result[recipient_id] = decode_user_ids(data)
+
+    recipient_ids_to_fetch = [recipient_id for recipient_id in recipient_ids
+                              if recipient_id not in result]
+    if recipient_ids_to_fetch:
+        fetched = fetch_subscriber_ids(recipient_ids_to_fetch)
+        items_to_cache: Dict[str, Any] = {}
+        for recipient_id, user_ids in fetched.items():
+            result[recipient_id] = user_ids
+            items_to_cache[recipient_subscriber_ids_cache_key(recipient_id)] = (
+                versions[stream_keys[recipient_id]],
+                versions[realm_key],
+                encode_user_ids(user_ids),
+            )
+        cache_set_many(items_to_cache)
+
+    return result
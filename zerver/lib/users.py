@@ -1,7 +1,7 @@
 import re
 import unicodedata
 from collections import defaultdict
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -12,7 +12,10 @@ from zulip_bots.custom_exceptions import ConfigValidationError
 
 from zerver.lib.avatar import avatar_url, get_avatar_field
 from zerver.lib.cache import (
+    SnapshotCache,
     bulk_cached_fetch,
+    get_version_keys,
+    realm_user_data_version_cache_key,
     realm_user_dict_fields,
     user_profile_by_id_cache_key,
     user_profile_cache_key_id,
@@ -441,41 +444,97 @@ def get_custom_profile_field_values(custom_profile_field_values:
             }
     return profiles_by_user_id
 
+class RealmUserData(NamedTuple):
+    # The realm's users, formatted for a user who can't see their
+    # delivery_email, which get_raw_user_data copies per request.
+    users: Dict[int, Dict[str, Any]]
+    delivery_emails: Dict[int, str]
+
+# Snapshots of the formatted users of the realms this process has
+# recently served, by realm ID, client_gravatar and
+# user_avatar_url_field_optional.  A snapshot is only used while the
+# realm's version key in the remote cache still matches it; see
+# flush_realm_user_data.
+MAX_CACHED_REALM_USER_DATA = 8
+realm_user_data_cache: SnapshotCache[Tuple[int, bool, bool], RealmUserData] = SnapshotCache(
+    MAX_CACHED_REALM_USER_DATA)
+
+def build_realm_user_data(realm: Realm, acting_user: UserProfile, client_gravatar: bool,
+                          user_avatar_url_field_optional: bool) -> RealmUserData:
+    custom_profile_field_values = CustomProfileFieldValue.objects.select_related(
+        "field").filter(field__realm_id=realm.id)
+    profiles_by_user_id = get_custom_profile_field_values(custom_profile_field_values)
+
+    users = {}
+    delivery_emails = {}
+    for row in get_realm_user_dicts(realm.id):
+        user_dict = format_user_row(realm,
+                                    acting_user=acting_user,
+                                    row=row,
+                                    client_gravatar=client_gravatar,
+                                    user_avatar_url_field_optional=user_avatar_url_field_optional,
+                                    custom_profile_field_data=profiles_by_user_id.get(row['id'], {}),
+                                    )
+        user_dict.pop('delivery_email', None)
+        users[row['id']] = user_dict
+        delivery_emails[row['id']] = row['delivery_email']
+    return RealmUserData(users, delivery_emails)
+
+def get_realm_user_data(realm: Realm, acting_user: UserProfile, client_gravatar: bool,
+                        user_avatar_url_field_optional: bool) -> RealmUserData:
+    version_key = realm_user_data_version_cache_key(realm.id)
+    version = get_version_keys([version_key])[version_key]
+    key = (realm.id, client_gravatar, user_avatar_url_field_optional)
+    data = realm_user_data_cache.get(key, version)
+    if data is None:
+        data = build_realm_user_data(realm, acting_user, client_gravatar,
+                                     user_avatar_url_field_optional)
+        realm_user_data_cache.set(key, version, data)
+    return data
+
 def get_raw_user_data(realm: Realm, acting_user: UserProfile, *, target_user: Optional[UserProfile]=None,
                       client_gravatar: bool, user_avatar_url_field_optional: bool,
                       include_custom_profile_fields: bool=True) -> Dict[int, Dict[str, str]]:
     """Fetches data about the target user(s) appropriate for sending to
     acting_user via the standard format for the Zulip API.  If
-    target_user is None, we fetch all users in the realm.
+    target_user is None, we fetch all users in the realm, from this
+    process's snapshot of them if it's current.
     """
-    profiles_by_user_id = None
-    custom_profile_field_data = None
-    # target_user is an optional parameter which is passed when user data of a specific user
-    # is required. It is 'None' otherwise.
-    if target_user is not None:
-        user_dicts = [user_profile_to_user_row(target_user)]
-    else:
-        user_dicts = get_realm_user_dicts(realm.id)
+    if target_user is None:
+        data = get_realm_user_data(realm, acting_user, client_gravatar,
+                                   user_avatar_url_field_optional)
+        show_delivery_email = (
+            realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS and
+            acting_user.is_realm_admin)
+
+        # Callers modify the dicts we return (e.g. when applying
+        # events), so each request gets its own copies.
+        result = {}
+        for user_id, user_dict in data.users.items():
+            user_dict = dict(user_dict)
+            if 'profile_data' in user_dict:
+                if include_custom_profile_fields:
+                    user_dict['profile_data'] = dict(user_dict['profile_data'])
+                else:
+                    del user_dict['profile_data']
+            if show_delivery_email:
+                user_dict['delivery_email'] = data.delivery_emails[user_id]
+            result[user_id] = user_dict
+        return result
 
+    custom_profile_field_data = None
     if include_custom_profile_fields:
-        base_query = CustomProfileFieldValue.objects.select_related("field")
-        # TODO: Consider optimizing this query away with caching.
-        if target_user is not None:
-            custom_profile_field_values = base_query.filter(user_profile=target_user)
-        else:
-            custom_profile_field_values = base_query.filter(field__realm_id=realm.id)
+        custom_profile_field_values = CustomProfileFieldValue.objects.select_related(
+            "field").filter(user_profile=target_user)
         profiles_by_user_id = get_custom_profile_field_values(custom_profile_field_values)
-
-    result = {}
-    for row in user_dicts:
-        if profiles_by_user_id is not None:
-            custom_profile_field_data = profiles_by_user_id.get(row['id'], {})
-
-        result[row['id']] = format_user_row(realm,
-                                            acting_user=acting_user,
-                                            row=row,
-                                            client_gravatar=client_gravatar,
-                                            user_avatar_url_field_optional=user_avatar_url_field_optional,
-                                            custom_profile_field_data=custom_profile_field_data,
-                                            )
-    return result
+        custom_profile_field_data = profiles_by_user_id.get(target_user.id, {})
+
+    return {
+        target_user.id: format_user_row(realm,
+                                        acting_user=acting_user,
+                                        row=user_profile_to_user_row(target_user),
+                                        client_gravatar=client_gravatar,
+                                        user_avatar_url_field_optional=user_avatar_url_field_optional,
+                                        custom_profile_field_data=custom_profile_field_data,
+                                        ),
+    }
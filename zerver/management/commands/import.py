@@ -40,7 +40,15 @@ import a database dump from one or more JSON files."""
                             dest='processes',
                             action="store",
                             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-                            help='Number of processes to use for uploading Avatars to S3 in parallel')
+                            help='Number of processes to use for uploading Avatars to S3 '
+                                 'and importing messages in parallel')
+        parser.add_argument('--defer-indexes',
+                            dest='defer_indexes',
+                            default=False,
+                            action="store_true",
+                            help='Drop the indexes on the message tables while importing, and\n'
+                                 'rebuild them at the end.  Much faster for large imports, but\n'
+                                 'only use this on a server with no other realms in use.')
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def do_destroy_and_rebuild_database(self, db_name: str) -> None:
@@ -75,6 +83,7 @@ import a database dump from one or more JSON files."""
 
         for path in paths:
             print(f"Processing dump: {path} ...")
-            realm = do_import_realm(path, subdomain, num_processes)
+            realm = do_import_realm(path, subdomain, num_processes,
+                                    defer_indexes=options['defer_indexes'])
             print("Checking the system bots.")
             do_import_system_bots(realm)
@@ -21,7 +21,12 @@ from zerver.lib.db import reset_queries
 from zerver.lib.debug import maybe_tracemalloc_listen
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.html_to_text import get_content_description
-from zerver.lib.markdown import get_markdown_requests, get_markdown_time
+from zerver.lib.markdown import (
+    get_markdown_render_cache_hits,
+    get_markdown_render_cache_misses,
+    get_markdown_requests,
+    get_markdown_time,
+)
 from zerver.lib.rate_limiter import RateLimitResult
 from zerver.lib.response import json_error, json_response_from_error
 from zerver.lib.subdomains import get_subdomain
@@ -71,6 +76,8 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
     log_data['markdown_time_start'] = get_markdown_time()
     log_data['markdown_requests_start'] = get_markdown_requests()
+    log_data['markdown_render_cache_hits_start'] = get_markdown_render_cache_hits()
+    log_data['markdown_render_cache_misses_start'] = get_markdown_render_cache_misses()
 
 def timedelta_ms(timedelta: float) -> float:
     return timedelta * 1000
@@ -177,6 +184,18 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
                 statsd.timing(f"{statsd_path}.markdown.time", timedelta_ms(markdown_time_delta))
                 statsd.incr(f"{statsd_path}.markdown.count", markdown_count_delta)
 
+    # Markdown is only rendered in regular Django requests, so unlike
+    # the counters above, these don't need to handle Tornado's
+    # stopping and restarting of long-polling requests.
+    if 'markdown_render_cache_hits_start' in log_data and not suppress_statsd:
+        render_cache_hits_delta = (get_markdown_render_cache_hits() -
+                                   log_data['markdown_render_cache_hits_start'])
+        render_cache_misses_delta = (get_markdown_render_cache_misses() -
+                                     log_data['markdown_render_cache_misses_start'])
+        if render_cache_hits_delta or render_cache_misses_delta:
+            statsd.incr(f"{statsd_path}.markdown.cache_hits", render_cache_hits_delta)
+            statsd.incr(f"{statsd_path}.markdown.cache_misses", render_cache_misses_delta)
+
     # Get the amount of time spent doing database queries
     db_time_output = ""
     queries = connection.connection.queries if connection.connection is not None else []
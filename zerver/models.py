@@ -51,6 +51,7 @@ from zerver.lib.cache import (
     flush_realm,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
@@ -2312,6 +2313,8 @@ class Subscription(models.Model):
         "role",
     ]
 
+post_save.connect(flush_subscription, sender=Subscription)
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
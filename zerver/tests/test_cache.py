@@ -8,6 +8,7 @@ from zerver.lib.cache import (
     MEMCACHED_MAX_KEY_LENGTH,
     InvalidCacheKeyException,
     NotFoundInCache,
+    SnapshotCache,
     bulk_cached_fetch,
     cache_delete,
     cache_delete_many,
@@ -16,7 +17,9 @@ from zerver.lib.cache import (
     cache_set,
     cache_set_many,
     cache_with_key,
+    delete_version_keys,
     get_cache_with_key,
+    get_version_keys,
     safe_cache_get_many,
     safe_cache_set_many,
     user_profile_by_email_cache_key,
@@ -329,3 +332,27 @@ class GenericBulkCachedFetchTest(ZulipTestCase):
             id_fetcher=get_user_email,
         )
         self.assertEqual(result, {})
+
+class SnapshotCacheTest(ZulipTestCase):
+    def test_version_keys_and_snapshots(self) -> None:
+        versions = get_version_keys(['test_version_a', 'test_version_b'])
+        self.assertEqual(get_version_keys(['test_version_a', 'test_version_b']), versions)
+
+        snapshots: SnapshotCache[int, str] = SnapshotCache(2)
+        snapshots.set(1, versions['test_version_a'], 'one')
+        snapshots.set(2, versions['test_version_a'], 'two')
+        self.assertEqual(snapshots.get(1, versions['test_version_a']), 'one')
+
+        # Deleting a version key gives it a new value, so the
+        # snapshots built under the old value aren't used.
+        delete_version_keys(['test_version_a'])
+        new_versions = get_version_keys(['test_version_a', 'test_version_b'])
+        self.assertNotEqual(new_versions['test_version_a'], versions['test_version_a'])
+        self.assertEqual(new_versions['test_version_b'], versions['test_version_b'])
+        self.assertIsNone(snapshots.get(1, new_versions['test_version_a']))
+
+        # The least recently used snapshot is evicted first.
+        snapshots.set(3, versions['test_version_b'], 'three')
+        self.assertIsNone(snapshots.get(2, versions['test_version_a']))
+        self.assertEqual(snapshots.get(1, versions['test_version_a']), 'one')
+        self.assertEqual(snapshots.get(3, versions['test_version_b']), 'three')
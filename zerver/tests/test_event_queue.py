@@ -1,22 +1,38 @@
+import os
 import time
 from typing import Any, Callable, Dict, List, Tuple
 from unittest import mock
 
 import orjson
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 
 from zerver.lib.actions import do_change_subscription_property, do_mute_topic
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
-from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.models import Recipient, Stream, Subscription, UserProfile, get_realm, get_stream
+from zerver.tornado.django_api import send_event
 from zerver.tornado.event_queue import (
+    DEFAULT_EVENT_QUEUE_TIMEOUT_SECS,
+    MAX_PENDING_NOTIFICATIONS,
+    NOTIFICATION_BATCH_SIZE,
     ClientDescriptor,
+    NotificationBatcher,
     allocate_client_descriptor,
+    clear_client_event_queues_for_testing,
+    coalesce_notices,
+    dump_event_queues,
+    gc_event_queues,
     get_client_descriptor,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
     persistent_queue_filename,
+    serialize_client_descriptor,
 )
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.sharding import get_realm_tornado_ports
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -494,6 +510,116 @@ class FileReloadLogicTest(ZulipTestCase):
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/home/zulip/tornado/event_queues.9993.last.json")
 
+    def test_dump_and_load_event_queues(self) -> None:
+        hamlet = self.example_user('hamlet')
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+        client.event_queue.push(dict(type="unknown", timestamp="1"))
+        other_client = allocate_client_descriptor(queue_data)
+        queue_dicts = {
+            client.event_queue.id: client.to_dict(),
+            other_client.event_queue.id: other_client.to_dict(),
+        }
+
+        pattern = os.path.join(settings.TEST_WORKER_DIR, "event_queues%s.json")
+        with self.settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=pattern):
+            dump_event_queues(9993)
+            clear_client_event_queues_for_testing()
+
+            # Corrupting one record only loses that queue.
+            with open(persistent_queue_filename(9993), "ab") as f:
+                f.write(b'["truncated", {"user_pro')
+            with self.assertLogs(level="ERROR"):
+                load_event_queues(9993)
+            for queue_id, queue_dict in queue_dicts.items():
+                self.assertEqual(get_client_descriptor(queue_id).to_dict(), queue_dict)
+
+            # A dump with a single queue is read the same way.
+            clear_client_event_queues_for_testing()
+            with open(persistent_queue_filename(9993), "wb") as f:
+                f.write(serialize_client_descriptor(client.event_queue.id, client))
+            load_event_queues(9993)
+            self.assertIsNone(get_client_descriptor(other_client.event_queue.id))
+            self.assertEqual(get_client_descriptor(client.event_queue.id).to_dict(),
+                             queue_dicts[client.event_queue.id])
+
+            # We can still read the legacy single-blob format.
+            clear_client_event_queues_for_testing()
+            with open(persistent_queue_filename(9993), "wb") as f:
+                f.write(orjson.dumps(list(queue_dicts.items())))
+            load_event_queues(9993)
+            for queue_id, queue_dict in queue_dicts.items():
+                self.assertEqual(get_client_descriptor(queue_id).to_dict(), queue_dict)
+            os.remove(persistent_queue_filename(9993))
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_send_event_split_by_user(self) -> None:
+        realm = get_realm("zulip")
+        with self.settings(TORNADO_SERVER="http://localhost:9800", TORNADO_PROCESSES=4), \
+                mock.patch.dict("zerver.tornado.sharding.shard_map", {realm.host: [9800, 9801]}), \
+                mock.patch("zerver.tornado.django_api.queue_json_publish") as mock_publish:
+            self.assertEqual(get_realm_tornado_ports(realm), [9800, 9801])
+            send_event(realm, dict(type="test"), [10, 11, 12])
+            self.assertEqual(
+                {args[0][0]: args[0][1]["users"] for args in mock_publish.call_args_list},
+                {"notify_tornado_port_9800": [10, 12], "notify_tornado_port_9801": [11]},
+            )
+
+            # Public stream messages go to every port, for clients
+            # with all_public_streams=True.
+            mock_publish.reset_mock()
+            send_event(realm, dict(type="message", stream_name="Denmark"), [dict(id=10)])
+            self.assertEqual(
+                {args[0][0]: args[0][1]["users"] for args in mock_publish.call_args_list},
+                {"notify_tornado_port_9800": [dict(id=10)], "notify_tornado_port_9801": []},
+            )
+
+    def test_cleanup_event_queue_on_other_port(self) -> None:
+        hamlet = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        with mock.patch("zerver.tornado.event_queue.queue_id_prefix", "9801_"):
+            queue_id = allocate_client_descriptor(queue_data).event_queue.id
+        self.assertTrue(queue_id.startswith("9801_"))
+
+        def delete_queue(user_profile: UserProfile) -> None:
+            # As received by the process on port 9800.
+            with self.settings(TORNADO_PROCESSES=2), \
+                    mock.patch("zerver.tornado.event_queue.queue_id_prefix", "9800_"), \
+                    mock.patch("zerver.tornado.django_api.queue_json_publish",
+                               wraps=queue_json_publish) as mock_publish:
+                result = cleanup_event_queue(POSTRequestMock({"queue_id": queue_id}, user_profile),
+                                             user_profile)
+            self.assert_json_success(result)
+            self.assertEqual(mock_publish.call_args[0][0], "notify_tornado_port_9801")
+
+        # Only the queue's owner can delete it.
+        delete_queue(self.example_user("cordelia"))
+        self.assertEqual(get_client_descriptor(queue_id).user_profile_id, hamlet.id)
+
+        delete_queue(hamlet)
+        with self.assertRaises(BadEventQueueIdError):
+            get_client_descriptor(queue_id)
+
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
         hamlet = self.example_user('hamlet')
@@ -543,6 +669,59 @@ class EventQueueTest(ZulipTestCase):
         self.assertEqual(queue.contents(), [out_dict])
         self.verify_to_dict_end_to_end(client)
 
+    def test_shared_event_payload(self) -> None:
+        client = self.get_client_descriptor()
+        other_client = self.get_client_descriptor()
+        event = dict(type="message", message=dict(id=5, content="hello"))
+        client.event_queue.push(event, ["read"])
+        other_client.event_queue.push(event)
+
+        # The payload isn't copied, and isn't modified by being queued.
+        self.assertIs(client.event_queue.queue[0].payload, event)
+        self.assertIs(other_client.event_queue.queue[0].payload, event)
+        self.assertEqual(event, dict(type="message", message=dict(id=5, content="hello")))
+
+        self.assertEqual(client.event_queue.contents(),
+                         [dict(id=0, type="message", message=event["message"], flags=["read"])])
+        self.assertEqual(other_client.event_queue.contents(),
+                         [dict(id=0, type="message", message=event["message"])])
+        self.verify_to_dict_end_to_end(client)
+
+    def test_message_event_shared_between_queues(self) -> None:
+        client = self.get_client_descriptor()
+        other_client = self.get_client_descriptor()
+        self.send_stream_message(self.example_user("cordelia"), "Denmark", "hello")
+
+        # Queues with the same apply_markdown, client_gravatar and
+        # flags share a single event object.
+        event = client.event_queue.queue[-1]
+        other_event = other_client.event_queue.queue[-1]
+        self.assertIs(event.payload, other_event.payload)
+        self.assertEqual(event.to_dict()["message"]["content"], "hello")
+        self.assertEqual(event.to_dict()["flags"], [])
+
+    def test_gc_event_queues(self) -> None:
+        client = self.get_client_descriptor()
+        reconnected_client = self.get_client_descriptor()
+        gc_event_queues(9993)
+        self.assertEqual(get_client_descriptor(client.event_queue.id), client)
+
+        later = time.time() + DEFAULT_EVENT_QUEUE_TIMEOUT_SECS + 1
+        reconnected_client.last_connection_time = later - 60
+        with mock.patch("zerver.tornado.event_queue.time.time", return_value=later):
+            gc_event_queues(9993)
+        with self.assertRaises(BadEventQueueIdError):
+            get_client_descriptor(client.event_queue.id)
+        self.assertEqual(get_client_descriptor(reconnected_client.event_queue.id),
+                         reconnected_client)
+
+        # The reconnected client is collected once it expires in turn.
+        with mock.patch("zerver.tornado.event_queue.time.time",
+                        return_value=later + DEFAULT_EVENT_QUEUE_TIMEOUT_SECS):
+            gc_event_queues(9993)
+        with self.assertRaises(BadEventQueueIdError):
+            get_client_descriptor(reconnected_client.event_queue.id)
+
     def test_event_collapsing(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -703,7 +882,7 @@ class EventQueueTest(ZulipTestCase):
 
         queue.push({"type": "unknown",
                     "timestamp": "1"})
-        self.assertEqual(list(queue.queue),
+        self.assertEqual([event.to_dict() for event in queue.queue],
                          [{'id': 1,
                            'type': 'unknown',
                            "timestamp": "1"}])
@@ -732,3 +911,69 @@ class EventQueueTest(ZulipTestCase):
 
         queue.prune(1)
         self.verify_to_dict_end_to_end(client)
+
+class CoalesceNoticesTest(ZulipTestCase):
+    def test_coalesce_notices(self) -> None:
+        def presence(user_id: int, client: str, timestamp: float) -> Dict[str, Any]:
+            return dict(
+                event=dict(type='presence', user_id=user_id, email='user@zulip.com',
+                           server_timestamp=timestamp,
+                           presence={client: dict(client=client, status='active')}),
+                users=[1, 2, 3],
+            )
+
+        def typing(op: str, users: List[int]) -> Dict[str, Any]:
+            return dict(
+                event=dict(type='typing', op=op,
+                           sender=dict(user_id=1, email='user@zulip.com'),
+                           recipients=[dict(user_id=2, email='other@zulip.com')]),
+                users=users,
+            )
+
+        other = dict(event=dict(type='update_message_flags'), users=[1])
+        notices = [
+            presence(1, 'website', 1),
+            typing('start', [2]),
+            other,
+            presence(2, 'website', 2),
+            presence(1, 'ZulipMobile', 3),
+            typing('stop', [2]),
+            typing('start', [2, 3]),
+        ]
+        result = coalesce_notices(notices)
+        self.assertEqual([notice['event']['type'] for notice in result],
+                         ['update_message_flags', 'presence', 'presence', 'typing', 'typing'])
+
+        # The later presence event carries the presence data for both clients.
+        self.assertEqual(result[2]['event']['server_timestamp'], 3)
+        self.assertEqual(set(result[2]['event']['presence'].keys()), {'website', 'ZulipMobile'})
+
+        # Typing notices are only merged if they go to the same users.
+        self.assertEqual(result[3]['event']['op'], 'stop')
+        self.assertEqual(result[4]['users'], [2, 3])
+
+    def test_notification_batcher(self) -> None:
+        notice = dict(event=dict(type='update_message_flags'), users=[1])
+        batcher = NotificationBatcher('notify_tornado')
+        with mock.patch('zerver.tornado.event_queue.process_notification') as mock_process, \
+                mock.patch('tornado.ioloop.IOLoop.instance') as mock_ioloop:
+            mock_add_callback = mock_ioloop.return_value.add_callback
+            for i in range(MAX_PENDING_NOTIFICATIONS - 1):
+                batcher.add_notice(notice)
+            self.assertEqual(len(batcher.pending), MAX_PENDING_NOTIFICATIONS - 1)
+            self.assertEqual(mock_process.call_count, 0)
+            mock_add_callback.assert_called_once_with(batcher.process_batch)
+
+            # A full batcher processes a batch before it returns, so
+            # that we consume no more notices until it has.
+            batcher.add_notice(notice)
+            self.assertEqual(len(batcher.pending),
+                             MAX_PENDING_NOTIFICATIONS - NOTIFICATION_BATCH_SIZE)
+            self.assertEqual(mock_process.call_count, NOTIFICATION_BATCH_SIZE)
+
+            # Before we save the event queues on exit, the notices we
+            # have already acked are all processed.
+            batcher.drain()
+            self.assertEqual(len(batcher.pending), 0)
+            self.assertEqual(mock_process.call_count, MAX_PENDING_NOTIFICATIONS)
+            self.assertEqual(mock_add_callback.call_count, 1)
@@ -1,13 +1,27 @@
+import threading
 import time
-from typing import Any, Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
 from unittest import mock
 
 import orjson
 from django.conf import settings
+from django.db import connections
 from django.http import HttpRequest, HttpResponse
 
-from zerver.lib.actions import check_send_message, do_change_user_role, do_set_realm_property
-from zerver.lib.events import fetch_initial_state_data, get_raw_user_data
+from zerver.lib.actions import (
+    check_send_message,
+    do_change_full_name,
+    do_change_user_role,
+    do_set_realm_property,
+)
+from zerver.lib.cache import cache_delete, realm_state_event_cache_key
+from zerver.lib.events import (
+    InitialStateSections,
+    fetch_initial_state_data,
+    get_raw_user_data,
+)
+from zerver.lib.realm_state_changelog import MAX_REALM_STATE_DELTA_EVENTS
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock, queries_captured, stub_event_queue_user_events
 from zerver.lib.users import get_api_key
@@ -21,11 +35,15 @@ from zerver.models import (
     get_stream,
     get_system_bot,
 )
+from zerver.tornado.django_api import send_event
 from zerver.tornado.event_queue import (
+    ClientDescriptor,
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
+    get_client_descriptors_for_users,
     get_client_info_for_message_event,
     process_message_event,
+    realm_clients_by_event_type,
 )
 from zerver.tornado.views import get_events
 from zerver.views.events_register import _default_all_public_streams, _default_narrow
@@ -432,6 +450,136 @@ class FetchInitialStateDataTest(ZulipTestCase):
             else:
                 self.assertFalse('avatar_url' in user_dict)
 
+    def test_slow_fetch_logs_section_times(self) -> None:
+        hamlet = self.example_user('hamlet')
+        # Inside the test's transaction, the sections are fetched in
+        # this thread even with several threads configured.
+        with self.settings(INITIAL_STATE_FETCH_THREADS=4), \
+                mock.patch('zerver.lib.events.SLOW_INITIAL_STATE_FETCH_THRESHOLD', 0), \
+                self.assertLogs('zulip.register', 'INFO') as logs:
+            result = fetch_initial_state_data(user_profile=hamlet,
+                                              event_types=None,
+                                              queue_id='',
+                                              client_gravatar=False,
+                                              user_avatar_url_field_optional=False)
+        self.assertIn(hamlet.id, result['raw_users'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(f'Slow initial state fetch for user {hamlet.id}', logs.output[0])
+
+    def test_concurrent_fetch(self) -> None:
+        hamlet = self.example_user('hamlet')
+
+        def fetch() -> Dict[str, Any]:
+            return fetch_initial_state_data(user_profile=hamlet,
+                                            event_types=None,
+                                            queue_id='',
+                                            client_gravatar=False,
+                                            user_avatar_url_field_optional=False)
+
+        # The pool threads' database connections can't see changes
+        # made in this test's transaction, so this test makes none.
+        serial_state = fetch()
+
+        thread_names: Set[str] = set()
+        run_in_thread = InitialStateSections.run_in_thread
+
+        def run_in_test_thread(sections: InitialStateSections, name: str,
+                               func: Callable[[], Any]) -> Any:
+            thread_names.add(threading.current_thread().name)
+            try:
+                return run_in_thread(sections, name, func)
+            finally:
+                connections.close_all()
+
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='test_initial_state')
+        try:
+            with self.settings(INITIAL_STATE_FETCH_THREADS=2), \
+                    mock.patch('zerver.lib.events.can_fetch_concurrently', return_value=True), \
+                    mock.patch('zerver.lib.events.get_initial_state_executor',
+                               return_value=executor), \
+                    mock.patch.object(InitialStateSections, 'run_in_thread', run_in_test_thread):
+                concurrent_state = fetch()
+        finally:
+            executor.shutdown(wait=True)
+
+        self.assertEqual(concurrent_state, serial_state)
+        self.assertNotEqual(thread_names, set())
+        for thread_name in thread_names:
+            self.assertTrue(thread_name.startswith('test_initial_state'))
+
+class RealmStateDeltaTest(ZulipTestCase):
+    def register(self, user: UserProfile, **params: Any) -> Dict[str, Any]:
+        params['event_types'] = orjson.dumps(['realm_user', 'presence']).decode()
+        with stub_event_queue_user_events('15:11', []):
+            result = self.api_post(user, '/json/register', params)
+        self.assert_json_success(result)
+        return result.json()
+
+    def test_register_with_realm_state_version(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        state = self.register(hamlet)
+        self.assertIn('realm_users', state)
+        self.assertNotIn('realm_state_events', state)
+        version = state['realm_state_version']
+
+        do_change_full_name(cordelia, "Cordelia, Lear's daughter", cordelia)
+
+        state = self.register(hamlet, realm_state_version=version)
+        self.assertNotIn('realm_users', state)
+        self.assertNotIn('realm_non_active_users', state)
+        self.assertNotIn('presences', state)
+        self.assertEqual(state['realm_state_events'], [
+            dict(type='realm_user', op='update',
+                 person=dict(user_id=cordelia.id, full_name="Cordelia, Lear's daughter")),
+        ])
+        self.assertEqual(state['realm_state_version'], version + 1)
+
+        # Nothing has changed since then.
+        state = self.register(hamlet, realm_state_version=version + 1)
+        self.assertEqual(state['realm_state_events'], [])
+
+        # Too old, or from a restarted counter.
+        state = self.register(hamlet, realm_state_version=version - MAX_REALM_STATE_DELTA_EVENTS)
+        self.assertIn('realm_users', state)
+        self.assertNotIn('realm_state_events', state)
+        state = self.register(hamlet, realm_state_version=version + 100)
+        self.assertIn('realm_users', state)
+
+        # A change to the user's own role changes which fields of the
+        # other users they can see.
+        do_change_user_role(hamlet, UserProfile.ROLE_REALM_ADMINISTRATOR)
+        state = self.register(hamlet, realm_state_version=version)
+        self.assertIn('realm_users', state)
+        self.assertNotIn('realm_state_events', state)
+
+    def test_register_across_event_not_sent_to_whole_realm(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        version = self.register(hamlet)['realm_state_version']
+
+        # For example, the recipients were computed before a user
+        # joined the realm.
+        event = dict(type='realm_user', op='update',
+                     person=dict(user_id=cordelia.id, full_name='Cordelia'))
+        send_event(hamlet.realm, event, [hamlet.id])
+
+        state = self.register(hamlet, realm_state_version=version)
+        self.assertIn('realm_users', state)
+        self.assertNotIn('realm_state_events', state)
+        self.assertEqual(state['realm_state_version'], version + 1)
+
+    def test_register_with_expired_realm_state_events(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        version = self.register(hamlet)['realm_state_version']
+        do_change_full_name(cordelia, "Cordelia, Lear's daughter", cordelia)
+        cache_delete(realm_state_event_cache_key(hamlet.realm_id, version + 1))
+
+        state = self.register(hamlet, realm_state_version=version)
+        self.assertIn('realm_users', state)
+        self.assertNotIn('realm_state_events', state)
+
 class ClientDescriptorsTest(ZulipTestCase):
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
@@ -540,6 +688,59 @@ class ClientDescriptorsTest(ZulipTestCase):
         test_get_info(apply_markdown=False, client_gravatar=True)
         test_get_info(apply_markdown=True, client_gravatar=True)
 
+    def test_get_client_descriptors_for_users(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        realm = hamlet.realm
+
+        def allocate(user: UserProfile, event_types: Optional[List[str]]) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=event_types,
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=user.id,
+            ))
+
+        all_events_client = allocate(hamlet, None)
+        presence_client = allocate(cordelia, ['presence'])
+        message_client = allocate(cordelia, ['message'])
+
+        # A realm-wide event is only matched against the clients that
+        # requested its event type.
+        many_users = [hamlet.id, cordelia.id] + list(range(-1, -200, -1))
+        self.assertEqual(get_client_descriptors_for_users(many_users, 'presence', realm.id),
+                         [all_events_client, presence_client])
+        self.assertEqual(get_client_descriptors_for_users(many_users, 'message', realm.id),
+                         [all_events_client, message_client])
+
+        # Events for a few users are looked up by user.
+        self.assertEqual(get_client_descriptors_for_users([cordelia.id], 'presence', realm.id),
+                         [presence_client, message_client])
+
+        # Garbage-collecting queues removes them from the index.
+        presence_client.cleanup()
+        message_client.cleanup()
+        self.assertEqual(realm_clients_by_event_type[realm.id],
+                         {None: {all_events_client.event_queue.id: all_events_client}})
+        all_events_client.cleanup()
+        self.assertNotIn(realm.id, realm_clients_by_event_type)
+
+        # Clients may register with duplicate event types, or none.
+        duplicate_types_client = allocate(hamlet, ['message', 'message'])
+        no_types_clients = [allocate(hamlet, []), allocate(cordelia, [])]
+        self.assertEqual(realm_clients_by_event_type[realm.id],
+                         {'message': {duplicate_types_client.event_queue.id: duplicate_types_client}})
+        duplicate_types_client.cleanup()
+        self.assertNotIn(realm.id, realm_clients_by_event_type)
+        for client in no_types_clients:
+            client.cleanup()
+        self.assertNotIn(realm.id, realm_clients_by_event_type)
+
     def test_process_message_event_with_mocked_client_info(self) -> None:
         hamlet = self.example_user("hamlet")
 
@@ -749,13 +950,13 @@ class FetchQueriesTest(ZulipTestCase):
             realm_incoming_webhook_bots=0,
             realm_emoji=1,
             realm_filters=1,
-            realm_user=3,
+            realm_user=2,
             realm_user_groups=2,
             recent_private_conversations=1,
             starred_messages=1,
             stream=2,
             stop_words=0,
-            subscription=5,
+            subscription=4,
             update_display_settings=0,
             update_global_notifications=0,
             update_message_flags=5,
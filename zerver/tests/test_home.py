@@ -188,6 +188,7 @@ class HomeTest(ZulipTestCase):
             "realm_push_notifications_enabled",
             "realm_send_welcome_emails",
             "realm_signup_notifications_stream_id",
+            "realm_state_version",
             "realm_upload_quota",
             "realm_uri",
             "realm_user_group_edit_policy",
@@ -349,7 +350,7 @@ class HomeTest(ZulipTestCase):
         with queries_captured() as queries2:
             result = self._get_home_page()
 
-        self.assert_length(queries2, 37)
+        self.assert_length(queries2, 35)
 
         # Do a sanity check that our new streams were in the payload.
         html = result.content.decode('utf-8')
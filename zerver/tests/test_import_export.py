@@ -1,9 +1,10 @@
 import os
-from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
 from unittest.mock import patch
 
 import orjson
 from django.conf import settings
+from django.db import connection
 from django.db.models import Q
 from django.utils.timezone import now as timezone_now
 
@@ -20,7 +21,12 @@ from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.bot_config import set_bot_config
 from zerver.lib.bot_lib import StateHandler
 from zerver.lib.export import do_export_realm, do_export_user, export_usermessages_batch
-from zerver.lib.import_realm import do_import_realm, get_incoming_message_ids
+from zerver.lib.import_realm import (
+    DEFERRED_INDEX_TABLES,
+    do_import_realm,
+    get_incoming_message_ids,
+    get_message_dump_file_ids,
+)
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import create_s3_buckets, get_test_image_file, use_s3_backend
@@ -474,6 +480,20 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(pm_b_msg_id, exported_message_ids)
         self.assertIn(pm_c_msg_id, exported_message_ids)
 
+    def test_export_streamed_tables(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        with patch('zerver.lib.export.STREAMED_TABLE_BATCH_SIZE', 2):
+            full_data = self._export_realm(realm)
+
+        # The streamed tables are written out in several batches, in
+        # order of their IDs.
+        data = full_data['realm']
+        expected_ids = list(RealmAuditLog.objects.filter(
+            modified_user__realm=realm).order_by('id').values_list('id', flat=True))
+        self.assertGreater(len(expected_ids), 2)
+        self.assertEqual([row['id'] for row in data['zerver_realmauditlog']], expected_ids)
+        self.assertIsInstance(data['zerver_realmauditlog'][0]['event_time'], float)
+
     def test_export_realm_with_exportable_user_ids(self) -> None:
         realm = Realm.objects.get(string_id='zulip')
 
@@ -1158,6 +1178,104 @@ class ImportExportTest(ZulipTestCase):
 
         self.assertEqual(message_ids, [555, 888, 999])
 
+    def test_import_realm_with_deferred_indexes(self) -> None:
+        original_realm = get_realm('zulip')
+        self.send_stream_message(self.example_user("iago"), "Denmark",
+                                 'Quotes ", commas, tabs\t and\nnewlines \\N')
+
+        def get_indexes() -> List[Tuple[str, str]]:
+            with connection.cursor() as cursor:
+                cursor.execute('''
+                    SELECT indexname, indexdef FROM pg_indexes
+                    WHERE tablename = ANY(%s) ORDER BY indexname
+                ''', [DEFERRED_INDEX_TABLES])
+                return cursor.fetchall()
+
+        indexes = get_indexes()
+        self._export_realm(original_realm)
+        with patch('logging.info'):
+            imported_realm = do_import_realm(os.path.join(settings.TEST_WORKER_DIR, 'test-export'),
+                                             'test-zulip', defer_indexes=True)
+        self.assertEqual(get_indexes(), indexes)
+
+        def get_messages(realm: Realm) -> List[Tuple[str, str, bool]]:
+            return list(Message.objects.filter(sender__realm=realm).order_by('id').values_list(
+                'subject', 'content', 'has_link'))
+
+        self.assertEqual(get_messages(imported_realm), get_messages(original_realm))
+        self.assertEqual(
+            UserMessage.objects.filter(user_profile__realm=imported_realm).count(),
+            UserMessage.objects.filter(user_profile__realm=original_realm).count(),
+        )
+
+    def test_import_realm_with_parallel_message_dumps(self) -> None:
+        original_realm = get_realm('zulip')
+        self._export_realm(original_realm)
+        import_dir = os.path.join(settings.TEST_WORKER_DIR, 'test-export')
+
+        # Split the first message dump in two, so there are several.
+        dump_file_ids = get_message_dump_file_ids(import_dir)
+        with open(os.path.join(import_dir, 'messages-000001.json'), 'rb') as f:
+            dump = orjson.loads(f.read())
+        messages = dump['zerver_message']
+        half = len(messages) // 2
+        for dump_file_id, part in [(1, messages[:half]),
+                                   (len(dump_file_ids) + 1, messages[half:])]:
+            message_ids = {message['id'] for message in part}
+            part_dump = dict(
+                dump,
+                zerver_message=part,
+                zerver_usermessage=[row for row in dump['zerver_usermessage']
+                                    if row['message'] in message_ids],
+            )
+            with open(os.path.join(import_dir, f'messages-{dump_file_id:06}.json'), 'wb') as f:
+                f.write(orjson.dumps(part_dump))
+
+        all_dump_file_ids = list(range(1, len(dump_file_ids) + 2))
+        finished: List[Any] = []
+
+        # We can't fork inside the test's transaction, so we run each
+        # job in this process instead.
+        def run_parallel(job: Callable[[Any], int], data: Iterable[Any],
+                         threads: int) -> Iterator[Tuple[int, Any]]:
+            for item in data:
+                yield (job(item), item)
+                finished.append(item)
+
+        with patch('logging.info'), \
+                patch('zerver.lib.import_realm.close_connections_for_fork'), \
+                patch('zerver.lib.import_realm.run_parallel', side_effect=run_parallel):
+            imported_realm = do_import_realm(import_dir, 'test-zulip', processes=2)
+        for dump_file_id in all_dump_file_ids:
+            self.assertIn(dump_file_id, finished)
+
+        def get_messages(realm: Realm) -> List[Tuple[str, str]]:
+            return list(Message.objects.filter(sender__realm=realm).order_by('id').values_list(
+                'subject', 'content'))
+
+        self.assertEqual(get_messages(imported_realm), get_messages(original_realm))
+        self.assertEqual(
+            UserMessage.objects.filter(user_profile__realm=imported_realm).count(),
+            UserMessage.objects.filter(user_profile__realm=original_realm).count(),
+        )
+
+        # A failed dump file still waits for the others to finish.
+        def import_message_dump(realm: Realm, sender_map: Dict[int, Any],
+                                import_dir: str, dump_file_id: int) -> None:
+            if dump_file_id == 1:
+                raise Exception('failed')
+
+        finished.clear()
+        with patch('logging.info'), patch('logging.exception'), \
+                patch('zerver.lib.import_realm.close_connections_for_fork'), \
+                patch('zerver.lib.import_realm.run_parallel', side_effect=run_parallel), \
+                patch('zerver.lib.import_realm.import_message_dump',
+                      side_effect=import_message_dump):
+            with self.assertRaisesRegex(Exception, r'Failed to import message dumps \[1\]'):
+                do_import_realm(import_dir, 'test-zulip-2', processes=2)
+        for dump_file_id in all_dump_file_ids:
+            self.assertIn(dump_file_id, finished)
+
     def test_plan_type(self) -> None:
         realm = get_realm('zulip')
         do_change_plan_type(realm, Realm.LIMITED)
@@ -1,6 +1,8 @@
 import copy
 import os
+import pickle
 import re
+from io import StringIO
 from textwrap import dedent
 from typing import Any, Dict, List, Optional, Set, Tuple
 from unittest import mock
@@ -25,6 +27,8 @@ from zerver.lib.markdown import (
     clear_state_for_testing,
     content_has_emoji_syntax,
     fetch_tweet_data,
+    get_markdown_render_cache_hits,
+    get_markdown_render_cache_misses,
     get_possible_mentions_info,
     get_tweet_id,
     image_preview_enabled,
@@ -35,16 +39,19 @@ from zerver.lib.markdown import (
     url_embed_preview_enabled,
     url_to_a,
 )
+from zerver.lib.markdown import profiler as markdown_profiler
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import possible_mentions, possible_user_group_mentions
 from zerver.lib.message import render_markdown
+from zerver.lib.render_pool import MIN_JOBS_FOR_RENDER_POOL, RenderJob, bulk_render_markdown
 from zerver.lib.request import JsonableError
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.tex import render_tex
 from zerver.lib.user_groups import create_user_group
 from zerver.models import (
     MAX_MESSAGE_LENGTH,
+    Attachment,
     Message,
     Realm,
     RealmEmoji,
@@ -1066,6 +1073,96 @@ class MarkdownTest(ZulipTestCase):
         converted_topic = topic_links(realm.id, 'hello#123 #234')
         self.assertEqual(converted_topic, ['https://trac.example.com/ticket/234', 'https://trac.example.com/hello/123'])
 
+    def test_multiple_realm_patterns(self) -> None:
+        realm = get_realm('zulip')
+        # The linkifiers are combined into one pattern, so their
+        # group names must be kept apart.
+        RealmFilter(realm=realm, pattern=r'#(?P<id>[0-9]+)',
+                    url_format_string=r'https://trac.example.com/ticket/%(id)s').save()
+        RealmFilter(realm=realm, pattern=r'(?P<project>[A-Z]+)-(?P<id>[0-9]+)',
+                    url_format_string=r'https://jira.example.com/%(project)s/%(id)s').save()
+        flush_per_request_caches()
+
+        converted = markdown_convert('Fixed #12 and ZUL-34', message_realm=realm)
+        self.assertEqual(converted,
+                         '<p>Fixed <a href="https://trac.example.com/ticket/12">#12</a>'
+                         ' and <a href="https://jira.example.com/ZUL/34">ZUL-34</a></p>')
+        self.assertEqual(topic_links(realm.id, 'ZUL-34 and #12'),
+                         ['https://trac.example.com/ticket/12', 'https://jira.example.com/ZUL/34'])
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_markdown_render_cache(self) -> None:
+        realm = get_realm('zulip')
+        hits = get_markdown_render_cache_hits()
+        misses = get_markdown_render_cache_misses()
+
+        content = 'Ticket #123 is **fixed**'
+        for i in range(2):
+            self.assertEqual(markdown_convert(content, message_realm=realm),
+                             '<p>Ticket #123 is <strong>fixed</strong></p>')
+        self.assertEqual(get_markdown_render_cache_misses(), misses + 1)
+        self.assertEqual(get_markdown_render_cache_hits(), hits + 1)
+
+        # Adding a linkifier changes the cache key.
+        RealmFilter(realm=realm, pattern=r'#(?P<id>[0-9]+)',
+                    url_format_string=r'https://trac.example.com/ticket/%(id)s').save()
+        flush_per_request_caches()
+        self.assertEqual(markdown_convert(content, message_realm=realm),
+                         '<p>Ticket <a href="https://trac.example.com/ticket/123">#123</a>'
+                         ' is <strong>fixed</strong></p>')
+        self.assertEqual(get_markdown_render_cache_misses(), misses + 2)
+        self.assertEqual(get_markdown_render_cache_hits(), hits + 1)
+
+        # Content that may mention someone is always rendered.
+        markdown_convert('Ping me @ home', message_realm=realm)
+        self.assertEqual(get_markdown_render_cache_misses(), misses + 2)
+        self.assertEqual(get_markdown_render_cache_hits(), hits + 1)
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_markdown_render_cache_restores_message_links(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login_user(hamlet)
+        f = StringIO("zulip!")
+        f.name = "zulip.txt"
+        result = self.client_post("/json/user_uploads", {'file': f})
+        uri = result.json()['uri']
+        path_id = re.sub('/user_uploads/', '', uri)
+
+        # The second message's rendering comes from the cache, but it
+        # still claims the attachment.
+        hits = get_markdown_render_cache_hits()
+        content = f'[zulip.txt]({uri})'
+        message_ids = [self.send_stream_message(hamlet, 'Denmark', content) for i in range(2)]
+        self.assertEqual(get_markdown_render_cache_hits(), hits + 1)
+        for message_id in message_ids:
+            message = Message.objects.get(id=message_id)
+            self.assertTrue(message.has_link)
+            self.assertFalse(message.has_image)
+            self.assertTrue(message.has_attachment)
+        self.assertEqual(Attachment.objects.get(path_id=path_id).messages.count(), 2)
+
+    def test_markdown_profiling(self) -> None:
+        import zerver.lib.markdown
+        zerver.lib.markdown.md_engines.clear()
+        try:
+            with override_settings(MARKDOWN_PROFILING=True):
+                markdown_profiler.reset_profile()
+                markdown_convert('**hello** world')
+                stats = dict(markdown_profiler.get_extension_stats())
+                self.assertEqual(stats['treeprocessors/inline'].calls, 1)
+                self.assertGreater(stats['inlinepatterns/strong'].calls, 0)
+                self.assertEqual(len(markdown_profiler.slow_render_samples), 0)
+
+                with mock.patch('zerver.lib.markdown.profiler.SLOW_RENDER_THRESHOLD', 0), \
+                        self.assertLogs('zulip.markdown.profile', level='INFO') as logs:
+                    markdown_convert('**hello** world')
+                self.assertEqual(len(markdown_profiler.slow_render_samples), 1)
+                self.assertIn('Slow Markdown render (message unknown, realm unknown)', logs.output[0])
+        finally:
+            # Don't leave instrumented engines behind for other tests.
+            zerver.lib.markdown.md_engines.clear()
+            markdown_profiler.reset_profile()
+
     def test_maybe_update_markdown_engines(self) -> None:
         realm = get_realm('zulip')
         url_format_string = r"https://trac.example.com/ticket/%(id)s"
@@ -1428,6 +1525,49 @@ class MarkdownTest(ZulipTestCase):
                          '</span> test</p>')
         self.assertTrue(msg.mentions_wildcard)
 
+    def test_bulk_render_markdown(self) -> None:
+        user_profile = self.example_user('othello')
+        realm = user_profile.realm
+        msg = Message(sender=user_profile, sending_client=get_client("test"))
+        jobs = [
+            RenderJob(content="@**all** test", realm=realm, message=msg),
+            RenderJob(content="**bold**", realm=realm),
+        ]
+        with self.simulated_markdown_failure():
+            self.assertEqual(bulk_render_markdown(jobs[1:]), [None])
+
+        self.assertEqual(bulk_render_markdown(jobs), [
+            '<p><span class="user-mention" data-user-id="*">@all</span> test</p>',
+            '<p><strong>bold</strong></p>',
+        ])
+        self.assertTrue(msg.mentions_wildcard)
+
+    def test_bulk_render_markdown_in_pool(self) -> None:
+        user_profile = self.example_user('othello')
+        realm = user_profile.realm
+
+        class SimulatedRenderPool:
+            # Like the pool's workers, this renders copies of the jobs.
+            def map(self, func: Any, jobs: List[RenderJob], chunksize: int) -> List[Any]:
+                return [func(pickle.loads(pickle.dumps(job))) for job in jobs]
+
+        path_id = f'{realm.id}/ab/file_id/image.png'
+        messages = [Message(sender=user_profile, sending_client=get_client("test"))
+                    for i in range(MIN_JOBS_FOR_RENDER_POOL)]
+        jobs = [RenderJob(content=f'@**all** [image.png](/user_uploads/{path_id})',
+                          realm=realm, message=message)
+                for message in messages]
+        with mock.patch('zerver.lib.render_pool.render_pool', SimulatedRenderPool()), \
+                mock.patch('zerver.lib.render_pool.render_pool_processes', 2):
+            rendered = bulk_render_markdown(jobs)
+
+        self.assertEqual(len(rendered), len(jobs))
+        for message in messages:
+            self.assertTrue(message.mentions_wildcard)
+            self.assertTrue(message.has_link)
+            self.assertTrue(message.has_image)
+            self.assertEqual(message.potential_attachment_path_ids, [path_id])
+
     def test_mention_everyone(self) -> None:
         user_profile = self.example_user('othello')
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -13,6 +13,7 @@ from zerver.decorator import JsonableError
 from zerver.lib.actions import (
     check_message,
     check_send_stream_message,
+    copy_insert_ums,
     do_change_is_api_super_user,
     do_change_stream_post_policy,
     do_create_user,
@@ -1219,6 +1220,27 @@ class StreamMessagesTest(ZulipTestCase):
         message = most_recent_message(user_profile)
         assert(UserMessage.objects.get(user_profile=user_profile, message=message).flags.mentioned.is_set)
 
+    def test_copy_insert_user_messages(self) -> None:
+        user_profile = self.example_user('iago')
+        sender = self.example_user('hamlet')
+        self.subscribe(user_profile, "Denmark")
+        with mock.patch("zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD", 1), \
+                mock.patch("zerver.lib.actions.copy_insert_ums",
+                           wraps=copy_insert_ums) as mock_copy:
+            message_id = self.send_stream_message(sender, "Denmark", content="test @**Iago** rules")
+        mock_copy.assert_called_once()
+
+        # The same users get UserMessage rows as with the INSERT path.
+        other_message_id = self.send_stream_message(sender, "Denmark", content="test")
+        ums = UserMessage.objects.filter(message_id=message_id)
+        self.assertEqual(
+            {um.user_profile_id for um in ums},
+            set(UserMessage.objects.filter(message_id=other_message_id).values_list(
+                'user_profile_id', flat=True)),
+        )
+        self.assertTrue(ums.get(user_profile=user_profile).flags.mentioned.is_set)
+        self.assertTrue(ums.get(user_profile=sender).flags.read.is_set)
+
     def test_is_private_flag(self) -> None:
         user_profile = self.example_user('iago')
         self.subscribe(user_profile, "Denmark")
@@ -17,7 +17,15 @@ from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import FromAddress
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import simulated_queue_client
-from zerver.models import PreregistrationUser, UserActivity, get_client, get_realm, get_stream
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import (
+    PreregistrationUser,
+    UserActivity,
+    UserPresence,
+    get_client,
+    get_realm,
+    get_stream,
+)
 from zerver.tornado.event_queue import build_offline_notification
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
@@ -138,6 +146,41 @@ class WorkerTest(ZulipTestCase):
                 self.assertEqual(len(activity_records), 1)
                 self.assertEqual(activity_records[0].count, 3)
 
+    def test_UserPresenceWorker(self) -> None:
+        fake_client = self.FakeClient()
+
+        user = self.example_user('hamlet')
+        UserPresence.objects.filter(user_profile=user).delete()
+
+        # Several pings from the same client, in one batch, turn into a
+        # single UserPresence row and a single presence event.
+        now = time.time()
+        for i, status in enumerate([UserPresence.IDLE, UserPresence.ACTIVE, UserPresence.IDLE]):
+            fake_client.queue.append(('user_presence', dict(
+                user_profile_id=user.id,
+                client='website',
+                time=now + i,
+                status=status,
+            )))
+
+        events: List[Mapping[str, Any]] = []
+        with loopworker_sleep_mock, self.tornado_redirected_to_list(events):
+            with simulated_queue_client(lambda: fake_client):
+                worker = queue_processors.UserPresenceWorker()
+                worker.setup()
+                try:
+                    worker.start()
+                except AbortLoop:
+                    pass
+
+        presences = UserPresence.objects.filter(user_profile=user)
+        self.assertEqual(len(presences), 1)
+        self.assertEqual(presences[0].status, UserPresence.ACTIVE)
+        self.assertEqual(presences[0].timestamp, timestamp_to_datetime(now + 1))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event']['user_id'], user.id)
+        self.assertEqual(events[0]['event']['presence']['website']['status'], 'active')
+
     def test_missed_message_worker(self) -> None:
         cordelia = self.example_user('cordelia')
         hamlet = self.example_user('hamlet')
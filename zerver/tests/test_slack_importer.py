@@ -716,7 +716,8 @@ class SlackImporter(ZulipTestCase):
             # Hacky: We should include a zerver_userprofile, not the empty []
             test_reactions, uploads, zerver_attachment = convert_slack_workspace_messages(
                 './random_path', user_list, 2, {}, {}, added_channels, {}, {},
-                realm, [], [], 'domain', output_dir=output_dir, chunk_size=1)
+                realm, [], [], 'domain', output_dir=output_dir, spool_dir=output_dir,
+                chunk_size=1)
 
         messages_file_1 = os.path.join(output_dir, 'messages-000001.json')
         self.assertTrue(os.path.exists(messages_file_1))
@@ -733,7 +734,32 @@ class SlackImporter(ZulipTestCase):
         self.assertEqual(message_json['zerver_message'], zerver_message[1:2])
         self.assertEqual(message_json['zerver_usermessage'], zerver_usermessage[2:5])
 
-        self.assertEqual(test_reactions, reactions)
+        self.assertEqual(list(test_reactions), reactions)
+        self.assertEqual(len(test_reactions), 1)
+        for spool in [test_reactions, uploads, zerver_attachment]:
+            spool.close()
+
+        # A dump file is also finished once it has enough UserMessage rows.
+        self.rm_tree(output_dir)
+        os.makedirs(output_dir)
+        mock_message.side_effect = [[zerver_message[:1], zerver_usermessage[:2], [], [], []],
+                                    [zerver_message[1:2], zerver_usermessage[2:5], [], [], []]]
+        with mock.patch('zerver.data_import.slack.SLACK_MESSAGE_BATCH_SIZE', 1), \
+                mock.patch('zerver.data_import.slack.MAX_USERMESSAGES_PER_DUMP_FILE', 2), \
+                self.assertLogs(level="INFO"):
+            spools = convert_slack_workspace_messages(
+                './random_path', user_list, 2, {}, {}, added_channels, {}, {},
+                realm, [], [], 'domain', output_dir=output_dir, spool_dir=output_dir,
+                chunk_size=10)
+        for spool in spools:
+            spool.close()
+
+        with open(messages_file_1, "rb") as f:
+            message_json = orjson.loads(f.read())
+        self.assertEqual(message_json['zerver_message'], zerver_message[:1])
+        with open(messages_file_2, "rb") as f:
+            message_json = orjson.loads(f.read())
+        self.assertEqual(message_json['zerver_message'], zerver_message[1:2])
 
     @mock.patch("zerver.data_import.slack.requests.get")
     @mock.patch("zerver.data_import.slack.process_uploads", return_value = [])
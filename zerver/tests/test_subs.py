@@ -4150,11 +4150,11 @@ class GetSubscribersTest(ZulipTestCase):
 
         create_private_streams()
 
-        def get_never_subscribed() -> List[Dict[str, Any]]:
+        def get_never_subscribed(query_count: int) -> List[Dict[str, Any]]:
             with queries_captured() as queries:
                 sub_data = gather_subscriptions_helper(self.user_profile)
             never_subscribed = sub_data[2]
-            self.assert_length(queries, 5)
+            self.assert_length(queries, query_count)
 
             # Ignore old streams.
             never_subscribed = [
@@ -4163,7 +4163,7 @@ class GetSubscribersTest(ZulipTestCase):
             ]
             return never_subscribed
 
-        never_subscribed = get_never_subscribed()
+        never_subscribed = get_never_subscribed(query_count=5)
 
         # Invite only stream should not be there in never_subscribed streams
         self.assertEqual(len(never_subscribed), len(public_streams) + len(web_public_streams))
@@ -4176,7 +4176,8 @@ class GetSubscribersTest(ZulipTestCase):
         def test_admin_case() -> None:
             self.user_profile.role = UserProfile.ROLE_REALM_ADMINISTRATOR
             # Test realm admins can get never subscribed private stream's subscribers.
-            never_subscribed = get_never_subscribed()
+            # By now, every stream's subscribers are cached.
+            never_subscribed = get_never_subscribed(query_count=4)
 
             self.assertEqual(
                 len(never_subscribed),
@@ -4313,7 +4314,37 @@ class GetSubscribersTest(ZulipTestCase):
                 self.assertTrue(len(sub["subscribers"]) == len(users_to_subscribe))
             else:
                 self.assertTrue(len(sub["subscribers"]) == 0)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 5)
+
+    def test_subscriber_ids_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        for user in [hamlet, cordelia, othello]:
+            stream = self.subscribe(user, 'cached_stream')
+
+        def get_subscriber_ids(query_count: int) -> List[int]:
+            with queries_captured() as queries:
+                subscribed_streams, _ = gather_subscriptions(hamlet, include_subscribers=True)
+            self.assert_length(
+                [query for query in queries if 'zerver_subscription.recipient_id' in query['sql']],
+                query_count,
+            )
+            [sub] = [sub for sub in subscribed_streams if sub['stream_id'] == stream.id]
+            return sub['subscribers']
+
+        # Subscribing cached the stream's new subscribers, but not those
+        # of hamlet's other streams.
+        self.assertEqual(get_subscriber_ids(1), sorted([hamlet.id, cordelia.id, othello.id]))
+        self.assertEqual(get_subscriber_ids(0), sorted([hamlet.id, cordelia.id, othello.id]))
+
+        self.unsubscribe(cordelia, 'cached_stream')
+        self.assertEqual(get_subscriber_ids(0), sorted([hamlet.id, othello.id]))
+
+        # Deactivating a user invalidates every list in the realm.
+        do_deactivate_user(othello)
+        self.assertEqual(get_subscriber_ids(1), [hamlet.id])
+        self.assertEqual(get_subscriber_ids(0), [hamlet.id])
 
     def test_nonsubscriber(self) -> None:
         """
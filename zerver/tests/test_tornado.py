@@ -1,5 +1,6 @@
 import urllib.parse
 from typing import Any, Dict, Optional
+from unittest import mock
 
 import orjson
 from django.conf import settings
@@ -14,6 +15,7 @@ from zerver.lib.test_classes import ZulipTestCase
 from zerver.tornado import event_queue
 from zerver.tornado.application import create_tornado_application
 from zerver.tornado.event_queue import process_event
+from zerver.tornado.handlers import AsyncDjangoHandler
 
 
 class TornadoWebTestCase(AsyncHTTPTestCase, ZulipTestCase):
@@ -121,3 +123,38 @@ class EventsTestCase(TornadoWebTestCase):
             {'type': 'test', 'data': 'test data', 'id': 0},
         ])
         self.assertEqual(data['result'], 'success')
+
+    def test_events_fast_path(self) -> None:
+        user_profile = self.example_user('hamlet')
+        self.login_user(user_profile)
+        event_queue_id = self.create_queue()
+        process_event(dict(type='test', data='test data'), [user_profile.id])
+
+        data = {
+            'queue_id': event_queue_id,
+            'last_event_id': -1,
+        }
+        path = f'/api/v1/events?{urllib.parse.urlencode(data)}'
+        headers = {'Authorization': self.encode_user(user_profile)}
+        # Polls for which events are already queued are answered
+        # without running the Django request handling.
+        with mock.patch.object(AsyncDjangoHandler, 'get_response') as get_response, \
+                mock.patch('zerver.tornado.fast_path.queue_json_publish') as mock_publish:
+            response = self.tornado_client_get(path, headers=headers, subdomain='zulip')
+        get_response.assert_not_called()
+        self.assertEqual(response.code, 200)
+        data = orjson.loads(response.body)
+        self.assertEqual(data['events'], [
+            {'type': 'test', 'data': 'test data', 'id': 0},
+        ])
+        self.assertEqual(data['result'], 'success')
+        mock_publish.assert_called_once()
+        queue_name, event, _ = mock_publish.call_args[0]
+        self.assertEqual(queue_name, 'user_activity')
+        self.assertEqual(event['query'], 'get_events')
+        self.assertEqual(event['user_profile_id'], user_profile.id)
+
+        # Bad credentials fall back to the normal code path.
+        headers = {'Authorization': self.encode_credentials(user_profile.delivery_email, 'bad')}
+        response = self.tornado_client_get(path, headers=headers, subdomain='zulip')
+        self.assertEqual(response.code, 401)
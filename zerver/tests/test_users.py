@@ -9,12 +9,16 @@ from django.core.exceptions import ValidationError
 from django.test import override_settings
 
 from zerver.lib.actions import (
+    RecipientInfoResult,
     create_users,
+    do_change_full_name,
+    do_change_subscription_property,
     do_change_user_role,
     do_create_user,
     do_deactivate_user,
     do_reactivate_user,
     do_set_realm_property,
+    do_update_user_custom_profile_data_if_changed,
     get_emails_from_user_ids,
     get_recipient_info,
 )
@@ -35,7 +39,12 @@ from zerver.lib.test_helpers import (
 )
 from zerver.lib.topic_mutes import add_topic_mute
 from zerver.lib.upload import upload_avatar_image
-from zerver.lib.users import access_user_by_id, get_accounts_for_email, user_ids_to_users
+from zerver.lib.users import (
+    access_user_by_id,
+    get_accounts_for_email,
+    get_raw_user_data,
+    user_ids_to_users,
+)
 from zerver.models import (
     CustomProfileField,
     InvalidFakeEmailDomain,
@@ -1474,6 +1483,43 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info['default_bot_user_ids'], {normal_bot.id})
 
+    def test_get_recipient_info_snapshot(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        stream = get_stream('Denmark', hamlet.realm)
+        self.subscribe(hamlet, stream.name)
+        stream_topic = StreamTopicTarget(stream_id=stream.id, topic_name='test topic')
+
+        def get_info() -> RecipientInfoResult:
+            return get_recipient_info(
+                recipient=stream.recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+            )
+
+        get_info()
+        # Later sends just query for muted topics.
+        with queries_captured() as queries:
+            info = get_info()
+        self.assert_length(queries, 1)
+        self.assertIn(hamlet.id, info['active_user_ids'])
+
+        # Subscription changes invalidate the snapshot...
+        self.subscribe(cordelia, stream.name)
+        self.assertIn(cordelia.id, get_info()['active_user_ids'])
+        sub = get_subscription(stream.name, cordelia)
+        do_change_subscription_property(cordelia, sub, stream, 'push_notifications', True)
+        self.assertIn(cordelia.id, get_info()['stream_push_user_ids'])
+        self.unsubscribe(cordelia, stream.name)
+        self.assertNotIn(cordelia.id, get_info()['active_user_ids'])
+
+        # ... and so do changes to users' settings.
+        hamlet.enable_online_push_notifications = True
+        hamlet.save(update_fields=['enable_online_push_notifications'])
+        self.assertIn(hamlet.id, get_info()['push_notify_user_ids'])
+        do_deactivate_user(hamlet)
+        self.assertNotIn(hamlet.id, get_info()['active_user_ids'])
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user('hamlet')
         realm = hamlet.realm
@@ -1528,6 +1574,50 @@ class BulkUsersTest(ZulipTestCase):
             get_hamlet_avatar(client_gravatar=False),
         )
 
+    def test_raw_user_data_snapshot(self) -> None:
+        hamlet = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        cordelia = self.example_user('cordelia')
+        realm = hamlet.realm
+
+        def get_user_data(acting_user: UserProfile,
+                          include_custom_profile_fields: bool=True) -> Dict[int, Dict[str, Any]]:
+            return get_raw_user_data(realm, acting_user,
+                                     client_gravatar=False,
+                                     user_avatar_url_field_optional=False,
+                                     include_custom_profile_fields=include_custom_profile_fields)
+
+        users = get_user_data(hamlet)
+        with queries_captured() as queries:
+            cached_users = get_user_data(hamlet)
+        self.assert_length(queries, 0)
+        self.assertEqual(cached_users, users)
+
+        # Each call gets its own copies of the dicts.
+        cached_users[cordelia.id]['full_name'] = 'Someone else'
+        cached_users[cordelia.id]['profile_data']['1'] = {'value': 'modified'}
+        self.assertEqual(get_user_data(hamlet), users)
+
+        do_change_full_name(cordelia, "Cordelia, Lear's daughter", cordelia)
+        self.assertEqual(get_user_data(hamlet)[cordelia.id]['full_name'],
+                         "Cordelia, Lear's daughter")
+
+        field = CustomProfileField.objects.get(name='Phone number', realm=realm)
+        do_update_user_custom_profile_data_if_changed(cordelia, [
+            {'id': field.id, 'value': '+1-234-567-8901'},
+        ])
+        self.assertEqual(get_user_data(hamlet)[cordelia.id]['profile_data'][str(field.id)],
+                         {'value': '+1-234-567-8901'})
+        self.assertNotIn('profile_data', get_user_data(hamlet, include_custom_profile_fields=False)[cordelia.id])
+
+        # The snapshot doesn't depend on who's asking, so admins get
+        # delivery_email added to their copy.
+        do_set_realm_property(realm, 'email_address_visibility',
+                              Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS)
+        self.assertNotIn('delivery_email', get_user_data(hamlet)[cordelia.id])
+        self.assertEqual(get_user_data(iago)[cordelia.id]['delivery_email'],
+                         cordelia.delivery_email)
+
 class GetProfileTest(ZulipTestCase):
 
     def test_cache_behavior(self) -> None:
@@ -5,6 +5,7 @@ from django.conf import settings
 
 from zerver.lib.queue import get_queue_client
 from zerver.tornado import autoreload
+from zerver.tornado.fast_path import EventsFastPathHandler
 from zerver.tornado.handlers import AsyncDjangoHandler
 
 
@@ -19,12 +20,15 @@ def create_tornado_application(port: int) -> tornado.web.Application:
     urls = (
         r"/notify_tornado",
         r"/json/events",
-        r"/api/v1/events",
         r"/api/v1/events/internal",
     )
+    handlers = [(url, AsyncDjangoHandler) for url in urls]
+    # Polls from API clients can often be answered without the
+    # Django stack; see EventsFastPathHandler.
+    handlers.append((r"/api/v1/events", EventsFastPathHandler))
 
     # Application is an instance of Django's standard wsgi handler.
-    return tornado.web.Application([(url, AsyncDjangoHandler) for url in urls],
+    return tornado.web.Application(handlers,
                                    debug=settings.DEBUG,
                                    autoreload=False,
                                    # Disable Tornado's own request logging, since we have our own
@@ -1,5 +1,5 @@
 from functools import lru_cache
-from typing import Any, Container, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+from typing import Any, Container, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union, cast
 
 import orjson
 import requests
@@ -9,9 +9,16 @@ from requests.models import PreparedRequest, Response
 from requests.packages.urllib3.util.retry import Retry
 
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.realm_state_changelog import REALM_STATE_EVENT_TYPES, record_realm_state_event
 from zerver.models import Client, Realm, UserProfile
 from zerver.tornado.event_queue import process_notification
-from zerver.tornado.sharding import get_tornado_port, get_tornado_uri, notify_tornado_queue_name
+from zerver.tornado.sharding import (
+    get_realm_tornado_ports,
+    get_tornado_uri,
+    get_user_id_tornado_port,
+    get_user_tornado_port,
+    notify_tornado_queue_name,
+)
 
 
 class TornadoAdapter(HTTPAdapter):
@@ -59,7 +66,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
     if not settings.TORNADO_SERVER:
         return None
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_tornado_uri(get_user_tornado_port(user_profile))
     req = {'dont_block': 'true',
            'apply_markdown': orjson.dumps(apply_markdown),
            'client_gravatar': orjson.dumps(client_gravatar),
@@ -86,7 +93,7 @@ def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int
     if not settings.TORNADO_SERVER:
         return []
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_tornado_uri(get_user_tornado_port(user_profile))
     post_data: Dict[str, Any] = {
         'queue_id': queue_id,
         'last_event_id': last_event_id,
@@ -101,22 +108,50 @@ def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int
     )
     return resp.json()['events']
 
-def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
     if not settings.TORNADO_SERVER or settings.RUNNING_INSIDE_TORNADO:
         process_notification(data)
     else:
-        tornado_uri = get_tornado_uri(realm)
+        tornado_uri = get_tornado_uri(port)
         requests_client().post(
             tornado_uri + "/notify_tornado",
             data=dict(data=orjson.dumps(data), secret=settings.SHARED_SECRET),
         )
 
+def send_cleanup_event_queue(user_profile: UserProfile, queue_id: str, port: int) -> None:
+    queue_json_publish(notify_tornado_queue_name(port),
+                       dict(event=dict(type="cleanup_event_queue", queue_id=queue_id),
+                            users=[user_profile.id], realm_id=user_profile.realm_id),
+                       lambda *args, **kwargs: send_notification_http(port, *args, **kwargs))
+
 def send_event(realm: Realm, event: Mapping[str, Any],
                users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None:
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    port = get_tornado_port(realm)
-    queue_json_publish(notify_tornado_queue_name(port),
-                       dict(event=event, users=list(users)),
-                       lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
+    if event['type'] in REALM_STATE_EVENT_TYPES:
+        # Recorded before the event reaches any queue, so that a
+        # client registering meanwhile gets it one way or the other.
+        users = cast(List[int], list(users))
+        record_realm_state_event(realm.id, event, users)
+
+    realm_ports = get_realm_tornado_ports(realm)
+    if len(realm_ports) == 1:
+        port_users: Dict[int, List[Any]] = {realm_ports[0]: list(users)}
+    else:
+        # This realm is split across several Tornado processes by user
+        # ID; each one only needs to hear about its own users.
+        port_users = {}
+        for user in users:
+            user_id = user if isinstance(user, int) else user['id']
+            port_users.setdefault(get_user_id_tornado_port(realm_ports, user_id), []).append(user)
+        if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+            # Clients registered with all_public_streams=True may be
+            # on any of the realm's processes.
+            for port in realm_ports:
+                port_users.setdefault(port, [])
+
+    for port, port_user_list in port_users.items():
+        queue_json_publish(notify_tornado_queue_name(port),
+                           dict(event=event, users=port_user_list, realm_id=realm.id),
+                           lambda *args, port=port, **kwargs: send_notification_http(port, *args, **kwargs))
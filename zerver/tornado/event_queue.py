@@ -2,6 +2,7 @@
 # high-level documentation on how this system works.
 import atexit
 import copy
+import heapq
 import logging
 import os
 import random
@@ -23,6 +24,7 @@ from typing import (
     Optional,
     Sequence,
     Set,
+    Tuple,
     Union,
     cast,
 )
@@ -50,15 +52,24 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.sharding import event_queue_id_prefix, get_event_queue_id_port
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each GC pass only examines the
+# queues whose expiry time (see queue_expiry_heap) has passed.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
+# In addition to dumping the event queues on shutdown, we write a
+# checkpoint of them every few minutes, so that a Tornado process that
+# dies without running its atexit hooks doesn't lose every queue.
+# Checkpoints are written this many queues at a time, returning to the
+# IOLoop between chunks so that event delivery isn't blocked.
+EVENT_QUEUE_CHECKPOINT_FREQ_MSECS = 1000 * 60 * 5
+EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE = 500
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -71,6 +82,16 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 HEARTBEAT_MIN_FREQ_SECS = 45
 
 class ClientDescriptor:
+    # We can have tens of thousands of these objects on a busy Tornado
+    # shard, so we avoid the overhead of a per-instance __dict__.
+    __slots__ = (
+        'user_profile_id', 'realm_id', 'current_handler_id', 'current_client_name',
+        'event_queue', 'event_types', 'last_connection_time', 'apply_markdown',
+        'client_gravatar', 'slim_presence', 'all_public_streams', 'client_type_name',
+        '_timeout_handle', 'narrow', 'narrow_filter', 'bulk_message_deletion',
+        'queue_timeout',
+    )
+
     def __init__(self,
                  user_profile_id: int,
                  realm_id: int, event_queue: 'EventQueue',
@@ -164,12 +185,13 @@ class ClientDescriptor:
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event: Mapping[str, Any]) -> None:
+    def add_event(self, event: Mapping[str, Any],
+                  flags: Optional[Iterable[str]]=None) -> None:
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_timer_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, flags)
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -200,6 +222,13 @@ class ClientDescriptor:
         return (self.current_handler_id is None and
                 now - self.last_connection_time >= self.queue_timeout)
 
+    def next_expiry_check(self, now: float) -> float:
+        # A connected client can't expire; we check it again after a
+        # full timeout, by which point it may have disconnected.
+        if self.current_handler_id is not None:
+            return now + self.queue_timeout
+        return self.last_connection_time + self.queue_timeout
+
     def connect_handler(self, handler_id: int, client_name: str) -> None:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
@@ -249,12 +278,38 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
         return "flags/{}/{}".format(event["operation"], event["flag"])
     return event["type"]
 
+class QueuedEvent:
+    """A single event sitting in an EventQueue.
+
+    The payload is shared between every queue the event was pushed to,
+    rather than copied, so it must never be mutated once pushed.  Only
+    the fields that differ between queues (the event `id`, and the
+    `flags` for message events) are stored on this object; to_dict
+    reassembles the event as it is sent to clients.
+    """
+    __slots__ = ('id', 'payload', 'flags')
+
+    def __init__(self, id: int, payload: Mapping[str, Any],
+                 flags: Optional[Iterable[str]]=None) -> None:
+        self.id = id
+        self.payload = payload
+        self.flags = flags
+
+    def to_dict(self) -> Dict[str, Any]:
+        event = dict(self.payload)
+        if self.flags is not None:
+            event['flags'] = self.flags
+        event['id'] = self.id
+        return event
+
 class EventQueue:
+    __slots__ = ('queue', 'next_event_id', 'newest_pruned_id', 'id', 'virtual_events')
+
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        self.queue: Deque[QueuedEvent] = deque()
         self.next_event_id: int = 0
         self.newest_pruned_id: Optional[int] = -1  # will only be None for migration from old versions
         self.id: str = id
@@ -267,7 +322,7 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=[event.to_dict() for event in self.queue],
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
@@ -279,43 +334,49 @@ class EventQueue:
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
         ret.newest_pruned_id = d.get('newest_pruned_id', None)
-        ret.queue = deque(d['queue'])
+        # The stored dictionaries are already private to this queue,
+        # so we can use them as the payload directly; the stale `id`
+        # key is overwritten when the event is reassembled.
+        ret.queue = deque(QueuedEvent(event['id'], event) for event in d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
-    def push(self, orig_event: Mapping[str, Any]) -> None:
-        # By default, we make a shallow copy of the event dictionary
-        # to push into the target event queue; this allows the calling
-        # code to send the same "event" object to multiple queues.
-        # This behavior is important because the event_queue system is
-        # about to mutate the event dictionary, minimally to add the
-        # event_id attribute.
-        event = dict(orig_event)
-        event['id'] = self.next_event_id
+    def push(self, orig_event: Mapping[str, Any],
+             flags: Optional[Iterable[str]]=None) -> None:
+        # We don't copy the event dictionary when queueing it; this
+        # allows the calling code to send the same "event" object to
+        # multiple queues without paying for a copy per queue.  The
+        # per-queue event_id (and flags, if passed separately) are
+        # stored alongside the shared payload in a QueuedEvent.
+        event_id = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
+        full_event_type = compute_full_event_type(orig_event)
         if (full_event_type == "restart" or
                 full_event_type.startswith("flags/")):
+            # Virtual events are mutated as later events are collapsed
+            # into them, so they need their own copy.
             if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
+                event = copy.deepcopy(dict(orig_event))
+                event['id'] = event_id
+                self.virtual_events[full_event_type] = event
                 return
             # Update the virtual event with the values from the event
             virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
+            virtual_event["id"] = event_id
+            if "timestamp" in orig_event:
+                virtual_event["timestamp"] = orig_event["timestamp"]
 
             if full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
+                virtual_event["server_generation"] = orig_event["server_generation"]
             elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
+                virtual_event["messages"] += orig_event["messages"]
         else:
-            self.queue.append(event)
+            self.queue.append(QueuedEvent(event_id, orig_event, flags))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> QueuedEvent:
         return self.queue.popleft()
 
     def empty(self) -> bool:
@@ -323,31 +384,38 @@ class EventQueue:
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.newest_pruned_id = self.queue[0]['id']
+        while len(self.queue) != 0 and self.queue[0].id <= through_id:
+            self.newest_pruned_id = self.queue[0].id
             self.pop()
 
     def contents(self) -> List[Dict[str, Any]]:
         contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(list(virtual_id_map.keys()))
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
+        if self.virtual_events:
+            virtual_id_map: Dict[int, Dict[str, Any]] = {}
+            for event_type in self.virtual_events:
+                virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
+            virtual_ids = sorted(list(virtual_id_map.keys()))
+
+            # Merge the virtual events into their final place in the queue
+            queue: Deque[QueuedEvent] = deque()
+            index = 0
+            length = len(virtual_ids)
+            for event in self.queue:
+                while index < length and virtual_ids[index] < event.id:
+                    virtual_event = virtual_id_map[virtual_ids[index]]
+                    queue.append(QueuedEvent(virtual_ids[index], virtual_event))
+                    index += 1
+                queue.append(event)
+            while index < length:
+                virtual_event = virtual_id_map[virtual_ids[index]]
+                queue.append(QueuedEvent(virtual_ids[index], virtual_event))
                 index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
 
-        self.virtual_events = {}
-        self.queue = deque(contents)
+            self.virtual_events = {}
+            self.queue = queue
+
+        for event in self.queue:
+            contents.append(event.to_dict())
         return contents
 
 # maps queue ids to client descriptors
@@ -356,6 +424,16 @@ clients: Dict[str, ClientDescriptor] = {}
 user_clients: Dict[int, List[ClientDescriptor]] = {}
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id and event type to the client descriptors, keyed by
+# queue id, that requested that event type; clients that accept all
+# event types are stored under the event type None.
+realm_clients_by_event_type: Dict[int, Dict[Optional[str], Dict[str, ClientDescriptor]]] = {}
+# heap of (time, queue id) pairs, with at least one entry per queue,
+# for when we next need to check whether the queue has expired.
+# Entries aren't updated when a client reconnects; instead, when the
+# garbage collector finds that a queue hasn't expired, it reinserts
+# it with its new expiry time.
+queue_expiry_heap: List[Tuple[float, str]] = []
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -365,12 +443,19 @@ realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
 gc_hooks: List[Callable[[int, ClientDescriptor, bool], None]] = []
 
 next_queue_id = 0
+# Set by setup_event_queue; see event_queue_id_prefix.
+queue_id_prefix = ""
 
 def clear_client_event_queues_for_testing() -> None:
     assert(settings.TEST_SUITE)
+    clear_client_event_queues()
+
+def clear_client_event_queues() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_by_event_type.clear()
+    queue_expiry_heap.clear()
     gc_hooks.clear()
     global next_queue_id
     next_queue_id = 0
@@ -384,20 +469,81 @@ def get_client_descriptor(queue_id: str) -> ClientDescriptor:
     except KeyError:
         raise BadEventQueueIdError(queue_id)
 
+def get_other_process_event_queue_port(queue_id: str) -> Optional[int]:
+    """The port of the Tornado process holding this event queue, if
+    that's not this process."""
+    port = get_event_queue_id_port(queue_id)
+    if port is None or event_queue_id_prefix(port) == queue_id_prefix:
+        return None
+    return port
+
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
     return user_clients.get(user_profile_id, [])
 
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
+MIN_USERS_FOR_REALM_SCAN = 100
+
+def get_client_descriptors_for_users(users: Sequence[int], event_type: str,
+                                     realm_id: Optional[int]=None) -> List[ClientDescriptor]:
+    """Returns the client descriptors belonging to the given users that
+    might accept an event of this type.  For realm-wide events, it's
+    cheaper to scan the realm's clients that requested this event type
+    than to look up each of the (possibly thousands of) users, most of
+    whom won't have event queues on this server.
+
+    The realm scan only finds clients in that realm, which is why we
+    restrict it to events sent to many users (i.e. realm-wide or
+    stream-wide events); events sent to a few users may include
+    cross-realm bots."""
+    if realm_id is not None and len(users) >= MIN_USERS_FOR_REALM_SCAN:
+        by_event_type = realm_clients_by_event_type.get(realm_id, {})
+        all_types = by_event_type.get(None, {})
+        this_type = by_event_type.get(event_type, {})
+        if len(all_types) + len(this_type) < len(users):
+            user_ids = set(users)
+            return [client
+                    for candidates in (all_types, this_type)
+                    for client in candidates.values()
+                    if client.user_profile_id in user_ids]
+
+    return [client
+            for user_profile_id in users
+            for client in get_client_descriptors_for_user(user_profile_id)]
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    by_event_type = realm_clients_by_event_type.setdefault(client.realm_id, {})
+    event_types: Iterable[Optional[str]] = [None] if client.event_types is None else client.event_types
+    for event_type in event_types:
+        by_event_type.setdefault(event_type, {})[client.event_queue.id] = client
+    heapq.heappush(queue_expiry_heap,
+                   (client.next_expiry_check(time.time()), client.event_queue.id))
+
+def remove_from_realm_event_type_dict(client: ClientDescriptor) -> None:
+    # Clients can register with duplicate event types, or with none
+    # at all, in which case add_to_client_dicts leaves only an empty
+    # dict for the realm, which another such client may have removed.
+    by_event_type = realm_clients_by_event_type.get(client.realm_id)
+    if by_event_type is None:
+        return
+    event_types: Iterable[Optional[str]] = [None] if client.event_types is None else set(client.event_types)
+    for event_type in event_types:
+        type_clients = by_event_type.get(event_type)
+        if type_clients is None:
+            continue
+        type_clients.pop(client.event_queue.id, None)
+        if len(type_clients) == 0:
+            del by_event_type[event_type]
+    if len(by_event_type) == 0:
+        del realm_clients_by_event_type[client.realm_id]
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = queue_id_prefix + str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
@@ -424,6 +570,7 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
         filter_client_dict(realm_clients_all_streams, realm_id)
 
     for id in to_remove:
+        remove_from_realm_event_type_dict(clients[id])
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
@@ -433,22 +580,31 @@ def gc_event_queues(port: int) -> None:
     to_remove: Set[str] = set()
     affected_users: Set[int] = set()
     affected_realms: Set[int] = set()
-    for (id, client) in clients.items():
+    while len(queue_expiry_heap) != 0 and queue_expiry_heap[0][0] <= start:
+        (_, id) = heapq.heappop(queue_expiry_heap)
+        client = clients.get(id)
+        if client is None or id in to_remove:
+            # Already garbage-collected, via ClientDescriptor.cleanup.
+            continue
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            heapq.heappush(queue_expiry_heap, (client.next_expiry_check(start), id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    gc_time = time.time() - start
     if settings.PRODUCTION:
         logging.info('Tornado %d removed %d expired event queues owned by %d users in %.3fs.'
                      '  Now %d active queues, %s',
-                     port, len(to_remove), len(affected_users), time.time() - start,
+                     port, len(to_remove), len(affected_users), gc_time,
                      len(clients), handler_stats_string())
+    statsd.timing('tornado.gc_event_queues_time', int(gc_time * 1000))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
@@ -462,35 +618,103 @@ def persistent_queue_filename(port: int, last: bool=False) -> str:
         return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port) + '.last',)
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
 
+# Event queues are persisted with one JSON-encoded [queue_id, client]
+# record per line, so that they can be written and read back one
+# queue at a time, rather than as a single giant JSON blob.
+def serialize_client_descriptor(queue_id: str, client: ClientDescriptor) -> bytes:
+    return orjson.dumps([queue_id, client.to_dict()]) + b"\n"
+
 def dump_event_queues(port: int) -> None:
     start = time.time()
+    filename = persistent_queue_filename(port)
 
-    with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
-        )
+    with open(filename + ".tmp", "wb") as stored_queues:
+        for (qid, client) in clients.items():
+            stored_queues.write(serialize_client_descriptor(qid, client))
+    os.rename(filename + ".tmp", filename)
 
     logging.info('Tornado %d dumped %d event queues in %.3fs',
                  port, len(clients), time.time() - start)
 
+checkpoint_in_progress = False
+
+def checkpoint_event_queues(port: int) -> None:
+    global checkpoint_in_progress
+    if checkpoint_in_progress:
+        return
+    checkpoint_in_progress = True
+
+    start = time.time()
+    filename = persistent_queue_filename(port)
+    stored_queues = open(filename + ".checkpoint", "wb")
+    queue_ids = list(clients.keys())
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    def write_chunk(offset: int) -> None:
+        global checkpoint_in_progress
+        try:
+            for qid in queue_ids[offset:offset + EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE]:
+                # Queues garbage-collected since the checkpoint
+                # started are simply skipped.
+                client = clients.get(qid)
+                if client is not None:
+                    stored_queues.write(serialize_client_descriptor(qid, client))
+            if offset + EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE < len(queue_ids):
+                ioloop.add_callback(write_chunk, offset + EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE)
+                return
+            stored_queues.close()
+            os.rename(filename + ".checkpoint", filename)
+        except Exception:
+            stored_queues.close()
+            checkpoint_in_progress = False
+            logging.exception("Tornado %d could not checkpoint event queues", port, stack_info=True)
+            return
+
+        checkpoint_in_progress = False
+        logging.info('Tornado %d checkpointed %d event queues in %.3fs',
+                     port, len(queue_ids), time.time() - start)
+
+    write_chunk(0)
+
+def persist_event_queues(port: int) -> None:
+    # The notices waiting in our batchers have already been acked, so
+    # we must deliver them to the queues before we save those.
+    drain_notification_batchers()
+    dump_event_queues(port)
+
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
 
     try:
         with open(persistent_queue_filename(port), "rb") as stored_queues:
-            data = orjson.loads(stored_queues.read())
+            # Records in the current format start with '["', for the
+            # queue ID.
+            if stored_queues.read(2) in (b"[[", b"[]"):
+                # Temporary migration for the old format, which stored
+                # all the queues as a single JSON list of records.
+                stored_queues.seek(0)
+                try:
+                    data = orjson.loads(stored_queues.read())
+                    clients = {
+                        qid: ClientDescriptor.from_dict(client) for (qid, client) in data
+                    }
+                except Exception:
+                    logging.exception("Tornado %d could not deserialize event queues",
+                                      port, stack_info=True)
+            else:
+                stored_queues.seek(0)
+                for line in stored_queues:
+                    # A corrupt record (e.g. a truncated final line)
+                    # only loses that one queue.
+                    try:
+                        (qid, client) = orjson.loads(line)
+                        clients[qid] = ClientDescriptor.from_dict(client)
+                    except Exception:
+                        logging.exception("Tornado %d could not deserialize an event queue",
+                                          port, stack_info=True)
     except FileNotFoundError:
         pass
-    except orjson.JSONDecodeError:
-        logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
-    else:
-        try:
-            clients = {
-                qid: ClientDescriptor.from_dict(client) for (qid, client) in data
-            }
-        except Exception:
-            logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
@@ -509,12 +733,15 @@ def send_restart_events(immediate: bool=False) -> None:
             client.add_event(event)
 
 def setup_event_queue(port: int) -> None:
+    global queue_id_prefix
+    queue_id_prefix = event_queue_id_prefix(port)
+
     if not settings.TEST_SUITE:
         load_event_queues(port)
-        atexit.register(dump_event_queues, port)
+        atexit.register(persist_event_queues, port)
         # Make sure we dump event queues even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
-        add_reload_hook(lambda: dump_event_queues(port))
+        add_reload_hook(lambda: persist_event_queues(port))
 
     try:
         os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
@@ -527,6 +754,11 @@ def setup_event_queue(port: int) -> None:
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    if not settings.TEST_SUITE:
+        checkpoint_pc = tornado.ioloop.PeriodicCallback(lambda: checkpoint_event_queues(port),
+                                                        EVENT_QUEUE_CHECKPOINT_FREQ_MSECS, ioloop)
+        checkpoint_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
@@ -808,6 +1040,24 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             client_gravatar=client_gravatar,
         )
 
+    # Most clients receiving a message share the same
+    # (apply_markdown, client_gravatar, flags) combination, so we
+    # build one event per combination and push that same object to
+    # each of their queues (EventQueue.push doesn't copy events).
+    # Only clients that need extra per-client keys get their own dict.
+    shared_user_events: Dict[Tuple[bool, bool, Tuple[str, ...]], Dict[str, Any]] = {}
+
+    def get_shared_user_event(apply_markdown: bool, client_gravatar: bool,
+                              flags: Iterable[str]) -> Dict[str, Any]:
+        key = (apply_markdown, client_gravatar, tuple(flags))
+        if key not in shared_user_events:
+            shared_user_events[key] = dict(
+                type='message',
+                message=get_client_payload(apply_markdown, client_gravatar),
+                flags=flags,
+            )
+        return shared_user_events[key]
+
     # Extra user-specific data to include
     extra_user_data: Dict[int, Any] = {}
 
@@ -853,19 +1103,21 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             # message data unnecessarily
             continue
 
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
-
+        local_message_id = event_template.get('local_id', None) if is_sender else None
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
-        user_event: Dict[str, Any] = dict(type='message', message=message_dict, flags=flags)
-        if extra_data is not None:
-            user_event.update(extra_data)
+        mark_invite_only = "mirror" in client.client_type_name and event_template.get("invite_only")
 
-        if is_sender:
-            local_message_id = event_template.get('local_id', None)
+        if extra_data is None and local_message_id is None and not mark_invite_only:
+            user_event = get_shared_user_event(client.apply_markdown, client.client_gravatar, flags)
+        else:
+            message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+            if mark_invite_only:
+                message_dict = message_dict.copy()
+                message_dict["invite_only_stream"] = True
+
+            user_event = dict(type='message', message=message_dict, flags=flags)
+            if extra_data is not None:
+                user_event.update(extra_data)
             if local_message_id is not None:
                 user_event["local_message_id"] = local_message_id
 
@@ -879,7 +1131,8 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
 
         client.add_event(user_event)
 
-def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
+def process_presence_event(event: Mapping[str, Any], users: Sequence[int],
+                           realm_id: Optional[int]=None) -> None:
     if 'user_id' not in event:
         # We only recently added `user_id` to presence data.
         # Any old events in our queue can just be dropped,
@@ -901,19 +1154,18 @@ def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> No
         presence=event['presence'],
     )
 
-    for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(event):
-                if client.slim_presence:
-                    client.add_event(slim_event)
-                else:
-                    client.add_event(legacy_event)
+    for client in get_client_descriptors_for_users(users, 'presence', realm_id):
+        if client.accepts_event(event):
+            if client.slim_presence:
+                client.add_event(slim_event)
+            else:
+                client.add_event(legacy_event)
 
-def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
-    for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(event):
-                client.add_event(event)
+def process_event(event: Mapping[str, Any], users: Sequence[int],
+                  realm_id: Optional[int]=None) -> None:
+    for client in get_client_descriptors_for_users(users, event['type'], realm_id):
+        if client.accepts_event(event):
+            client.add_event(event)
 
 def process_deletion_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
@@ -1049,9 +1301,19 @@ def maybe_enqueue_notifications_for_message_update(user_profile_id: UserProfile,
         already_notified={},
     )
 
+def process_cleanup_event_queue(queue_id: str, user_ids: List[int]) -> None:
+    # A DELETE request for one of our queues that reached another
+    # Tornado process; see cleanup_event_queue.
+    client = clients.get(queue_id)
+    if client is None or client.user_profile_id not in user_ids:
+        return
+    client.cleanup()
+
 def process_notification(notice: Mapping[str, Any]) -> None:
     event: Mapping[str, Any] = notice['event']
     users: Union[List[int], List[Mapping[str, Any]]] = notice['users']
+    # Older notices don't include the realm ID.
+    realm_id: Optional[int] = notice.get('realm_id')
     start_time = time.time()
 
     if event['type'] == "message":
@@ -1072,24 +1334,150 @@ def process_notification(notice: Mapping[str, Any]) -> None:
             user_ids = cast(List[int], users)
         process_deletion_event(event, user_ids)
     elif event['type'] == "presence":
-        process_presence_event(event, cast(Iterable[int], users))
+        process_presence_event(event, cast(List[int], users), realm_id)
+    elif event['type'] == "cleanup_event_queue":
+        process_cleanup_event_queue(event['queue_id'], cast(List[int], users))
     else:
-        process_event(event, cast(Iterable[int], users))
+        process_event(event, cast(List[int], users), realm_id)
     logging.debug(
         "Tornado: Event %s for %s users took %sms",
         event['type'], len(users), int(1000 * (time.time() - start_time)),
     )
 
-def get_wrapped_process_notification(queue_name: str) -> Callable[[Dict[str, Any]], None]:
-    def failure_processor(notice: Dict[str, Any]) -> None:
+def coalesce_notices(notices: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Within a batch of notices, presence and typing events about the
+    same user (sent to the same users) are superseded by the latest
+    one, so we only deliver that one.  For presence, we merge the
+    per-client presence data, since each event only describes the
+    client that triggered it."""
+    latest: Dict[Tuple[Any, ...], int] = {}
+    result: List[Optional[Dict[str, Any]]] = []
+    for notice in notices:
+        event = notice['event']
+        key: Optional[Tuple[Any, ...]] = None
+        if event['type'] == 'presence' and 'user_id' in event:
+            key = ('presence', event['user_id'])
+        elif event['type'] == 'typing':
+            key = ('typing', event['sender']['user_id'],
+                   tuple(sorted(recipient['user_id'] for recipient in event['recipients'])))
+
+        if key is not None and key in latest:
+            index = latest[key]
+            previous = result[index]
+            assert previous is not None
+            if previous['users'] == notice['users']:
+                if event['type'] == 'presence':
+                    event['presence'] = dict(previous['event']['presence'], **event['presence'])
+                result[index] = None
+
+        if key is not None:
+            latest[key] = len(result)
+        result.append(notice)
+    return [notice for notice in result if notice is not None]
+
+# The Tornado consumer of the notify_tornado queue processes notices
+# in batches of up to this size, returning to the IOLoop between
+# batches so that a burst of notices can't stall get_events requests.
+NOTIFICATION_BATCH_SIZE = 100
+NOTIFICATION_BATCHES_BEFORE_UPDATE_STATS = 50
+# The most notices we hold before processing some of them straight
+# away, which also stops us consuming more from RabbitMQ until we have.
+MAX_PENDING_NOTIFICATIONS = 10 * NOTIFICATION_BATCH_SIZE
+
+class NotificationBatcher:
+    def __init__(self, queue_name: str) -> None:
+        self.queue_name = queue_name
+        self.pending: Deque[Dict[str, Any]] = deque()
+        self.flush_scheduled = False
+        self.queue_last_emptied_timestamp = time.time()
+        self.consumed_since_last_emptied = 0
+        # (notices received, notices delivered after coalescing, seconds)
+        self.recent_batches: Deque[Tuple[int, int, float]] = deque(maxlen=50)
+        self.batch_counter = 0
+
+    def failure_processor(self, notice: Dict[str, Any]) -> None:
         logging.error(
             "Maximum retries exceeded for Tornado notice:%s\nStack trace:\n%s\n",
             notice, traceback.format_exc())
 
-    def wrapped_process_notification(notice: Dict[str, Any]) -> None:
-        try:
-            process_notification(notice)
-        except Exception:
-            retry_event(queue_name, notice, failure_processor)
+    def add_notice(self, notice: Dict[str, Any]) -> None:
+        self.pending.append(notice)
+        if len(self.pending) >= MAX_PENDING_NOTIFICATIONS:
+            self.process_notices()
+        self.schedule_batch()
+
+    def schedule_batch(self) -> None:
+        if self.pending and not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.process_batch)
+
+    def process_batch(self) -> None:
+        self.flush_scheduled = False
+        self.process_notices()
+        # Yield to the IOLoop before processing the next batch.
+        self.schedule_batch()
+
+    def drain(self) -> None:
+        while self.pending:
+            self.process_notices()
+
+    def process_notices(self) -> None:
+        if not self.pending:
+            return
+        start = time.time()
+        batch = [self.pending.popleft()
+                 for _ in range(min(NOTIFICATION_BATCH_SIZE, len(self.pending)))]
+        notices = coalesce_notices(batch)
+        for notice in notices:
+            try:
+                process_notification(notice)
+            except Exception:
+                retry_event(self.queue_name, notice, self.failure_processor)
+
+        self.recent_batches.append((len(batch), len(notices), time.time() - start))
+        self.consumed_since_last_emptied += len(batch)
+        if len(self.pending) == 0:
+            self.queue_last_emptied_timestamp = time.time()
+            self.consumed_since_last_emptied = 0
+        self.batch_counter += 1
+        if self.batch_counter >= NOTIFICATION_BATCHES_BEFORE_UPDATE_STATS:
+            self.batch_counter = 0
+            self.update_statistics()
+
+    def update_statistics(self) -> None:
+        # This uses the same format as QueueProcessingWorker's stats
+        # files, with additional details on the batches.
+        total_received = sum(received for received, _, _ in self.recent_batches)
+        total_delivered = sum(delivered for _, delivered, _ in self.recent_batches)
+        total_seconds = sum(seconds for _, _, seconds in self.recent_batches)
+        num_batches = len(self.recent_batches)
+        stats_dict = dict(
+            update_time=time.time(),
+            recent_average_consume_time=total_seconds / total_received if total_received else None,
+            current_queue_size=len(self.pending),
+            queue_last_emptied_timestamp=self.queue_last_emptied_timestamp,
+            consumed_since_last_emptied=self.consumed_since_last_emptied,
+            recent_average_batch_size=total_received / num_batches if num_batches else None,
+            recent_average_batch_time=total_seconds / num_batches if num_batches else None,
+            recent_coalesced_notices=total_received - total_delivered,
+        )
 
-    return wrapped_process_notification
+        os.makedirs(settings.QUEUE_STATS_DIR, exist_ok=True)
+        fn = os.path.join(settings.QUEUE_STATS_DIR, f'{self.queue_name}.stats')
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.write(
+                orjson.dumps(stats_dict, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_INDENT_2)
+            )
+        os.rename(tmp_fn, fn)
+
+notification_batchers: List[NotificationBatcher] = []
+
+def drain_notification_batchers() -> None:
+    for batcher in notification_batchers:
+        batcher.drain()
+
+def get_wrapped_process_notification(queue_name: str) -> Callable[[Dict[str, Any]], None]:
+    batcher = NotificationBatcher(queue_name)
+    notification_batchers.append(batcher)
+    return batcher.add_notice
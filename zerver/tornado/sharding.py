@@ -1,33 +1,63 @@
 import json
 import os
+from typing import Dict, List, Optional, Sequence, Union
 from urllib.parse import urlsplit
 
 from django.conf import settings
 
-from zerver.models import Realm
+from zerver.models import Realm, UserProfile
 
-shard_map = {}
+# Maps realm hosts to the Tornado port serving them, or, for realms
+# large enough to be split across several Tornado processes, to the
+# list of those ports.
+shard_map: Dict[str, Union[int, List[int]]] = {}
 if os.path.exists("/etc/zulip/sharding.json"):
     with open("/etc/zulip/sharding.json") as f:
         shard_map = json.loads(f.read())
 
-def get_tornado_port(realm: Realm) -> int:
+def get_realm_tornado_ports(realm: Realm) -> List[int]:
     if settings.TORNADO_SERVER is None:
-        return 9993
+        return [9993]
     if settings.TORNADO_PROCESSES == 1:
         r = urlsplit(settings.TORNADO_SERVER)
         assert r.port is not None
-        return r.port
-    return shard_map.get(realm.host, 9800)
+        return [r.port]
+    ports = shard_map.get(realm.host, 9800)
+    if isinstance(ports, int):
+        return [ports]
+    return ports
 
-def get_tornado_uri(realm: Realm) -> str:
+def get_user_id_tornado_port(realm_ports: Sequence[int], user_id: int) -> int:
+    # Within a realm split across several Tornado processes, all of a
+    # user's event queues live on the same process, picked by user ID.
+    return realm_ports[user_id % len(realm_ports)]
+
+def get_user_tornado_port(user_profile: UserProfile) -> int:
+    return get_user_id_tornado_port(get_realm_tornado_ports(user_profile.realm),
+                                    user_profile.id)
+
+def get_tornado_uri(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return settings.TORNADO_SERVER
 
-    port = get_tornado_port(realm)
     return f"http://127.0.0.1:{port}"
 
 def notify_tornado_queue_name(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return "notify_tornado"
     return f"notify_tornado_port_{port}"
+
+def event_queue_id_prefix(port: int) -> str:
+    # With multiple Tornado processes, event queue IDs start with the
+    # port of the process holding them, so that nginx can route
+    # get_events requests for realms split across several processes.
+    if settings.TORNADO_PROCESSES == 1:
+        return ""
+    return f"{port}_"
+
+def get_event_queue_id_port(queue_id: str) -> Optional[int]:
+    # The inverse of event_queue_id_prefix.
+    port, sep, _ = queue_id.partition("_")
+    if not sep or not port.isdigit():
+        return None
+    return int(port)
@@ -15,7 +15,13 @@ from zerver.lib.validator import (
     to_non_negative_int,
 )
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
-from zerver.tornado.event_queue import fetch_events, get_client_descriptor, process_notification
+from zerver.tornado.django_api import send_cleanup_event_queue
+from zerver.tornado.event_queue import (
+    fetch_events,
+    get_client_descriptor,
+    get_other_process_event_queue_port,
+    process_notification,
+)
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import AsyncDjangoHandler
 
@@ -28,6 +34,15 @@ def notify(request: HttpRequest) -> HttpResponse:
 @has_request_variables
 def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: str=REQ()) -> HttpResponse:
+    port = get_other_process_event_queue_port(queue_id)
+    if port is not None:
+        # nginx can't route DELETE requests by the queue_id in their
+        # body, so this can reach any of the realm's Tornado
+        # processes; forward it to the one holding the queue.
+        send_cleanup_event_queue(user_profile, queue_id, port)
+        request._log_data['extra'] = f"[{queue_id}]"
+        return json_success()
+
     client = get_client_descriptor(str(queue_id))
     if client is None:
         raise BadEventQueueIdError(queue_id)
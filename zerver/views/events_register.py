@@ -5,7 +5,7 @@ from django.http import HttpRequest, HttpResponse
 from zerver.lib.events import do_events_register
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
-from zerver.lib.validator import check_bool, check_dict, check_list, check_string
+from zerver.lib.validator import check_bool, check_dict, check_int, check_list, check_string
 from zerver.models import Stream, UserProfile
 
 
@@ -46,6 +46,7 @@ def events_register_backend(
         fetch_event_types: Optional[Iterable[str]]=REQ(validator=check_list(check_string), default=None),
         narrow: NarrowT=REQ(validator=check_list(check_list(check_string, length=2)), default=[]),
         queue_lifespan_secs: int=REQ(converter=int, default=0, documentation_pending=True),
+        realm_state_version: Optional[int]=REQ(validator=check_int, default=None),
 ) -> HttpResponse:
     all_public_streams = _default_all_public_streams(user_profile, all_public_streams)
     narrow = _default_narrow(user_profile, narrow)
@@ -58,5 +59,6 @@ def events_register_backend(
                              event_types, queue_lifespan_secs, all_public_streams,
                              narrow=narrow, include_subscribers=include_subscribers,
                              client_capabilities=client_capabilities,
-                             fetch_event_types=fetch_event_types)
+                             fetch_event_types=fetch_event_types,
+                             since_realm_state_version=realm_state_version)
     return json_success(ret)
@@ -42,12 +42,12 @@ from zulip_bots.lib import ExternalBotHandler, extract_query_without_mention
 
 from zerver.context_processors import common_context
 from zerver.lib.actions import (
+    do_bulk_update_user_activity,
+    do_bulk_update_user_presence,
     do_mark_stream_messages_as_read,
     do_send_confirmation_email,
     do_update_embedded_data,
-    do_update_user_activity,
     do_update_user_activity_interval,
-    do_update_user_presence,
     internal_send_private_message,
     notify_realm_export,
     render_incoming_message,
@@ -421,16 +421,12 @@ class UserActivityWorker(LoopQueueProcessingWorker):
                 count, time = uncommitted_events[key_tuple]
                 uncommitted_events[key_tuple] = (count + 1, max(time, event['time']))
 
-        # Then we insert the updates into the database.
-        #
-        # TODO: Doing these updates in sequence individually is likely
-        # inefficient; the idealized version would do some sort of
-        # bulk insert_or_update query.
-        for key_tuple in uncommitted_events:
-            (user_profile_id, client_id, query) = key_tuple
-            count, time = uncommitted_events[key_tuple]
-            log_time = timestamp_to_datetime(time)
-            do_update_user_activity(user_profile_id, client_id, query, count, log_time)
+        # Then we insert the updates into the database, in a single
+        # bulk insert-or-update query.
+        do_bulk_update_user_activity({
+            key_tuple: (count, timestamp_to_datetime(time))
+            for key_tuple, (count, time) in uncommitted_events.items()
+        })
 
 @assign_queue('user_activity_interval')
 class UserActivityIntervalWorker(QueueProcessingWorker):
@@ -439,15 +435,30 @@ class UserActivityIntervalWorker(QueueProcessingWorker):
         log_time = timestamp_to_datetime(event["time"])
         do_update_user_activity_interval(user_profile, log_time)
 
-@assign_queue('user_presence')
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        logging.debug("Received presence event: %s", event)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+@assign_queue('user_presence', queue_type="loop")
+class UserPresenceWorker(LoopQueueProcessingWorker):
+    """Presence pings arrive every minute from each open client, and
+    the resulting updates can send a presence event to every user in
+    the realm.  We process them in batches, so that repeated pings
+    from the same client are collapsed into a single database write
+    and at most one event.
+    """
+    sleep_delay = 1
+    sleep_only_if_empty = True
+
+    def consume_batch(self, presence_events: List[Dict[str, Any]]) -> None:
+        user_profiles = UserProfile.objects.select_related('realm').in_bulk(
+            {event["user_profile_id"] for event in presence_events},
+        )
+        presence_updates: List[Tuple[UserProfile, Client, datetime.datetime, int]] = []
+        for event in presence_events:
+            logging.debug("Received presence event: %s", event)
+            user_profile = user_profiles[event["user_profile_id"]]
+            client = get_client(event["client"])
+            log_time = timestamp_to_datetime(event["time"])
+            status = event["status"]
+            presence_updates.append((user_profile, client, log_time, status))
+        do_bulk_update_user_presence(presence_updates)
 
 @assign_queue('missedmessage_emails', queue_type="loop")
 class MissedMessageWorker(QueueProcessingWorker):
@@ -0,0 +1,60 @@
+import time
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+
+from zerver.lib.actions import UserMessageLite, copy_insert_ums, values_insert_ums
+from zerver.models import Message, UserMessage
+
+
+class Command(BaseCommand):
+    help = """Compare the two ways bulk_insert_ums writes UserMessage rows:
+a multi-row INSERT (execute_values) and COPY FROM STDIN.
+
+Inserts rows for synthetic recipients of the most recent message
+inside a transaction that is rolled back, so the database is left
+unchanged.
+
+Usage: ./manage.py benchmark_bulk_insert_ums [--recipients=1000,10000,100000] [--repeat=3]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--recipients', default='1000,10000,100000',
+                            help='Comma-separated recipient counts to measure')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of runs at each size')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message = Message.objects.order_by('id').last()
+        if message is None:
+            raise CommandError("This benchmark needs at least one message in the database.")
+        # Foreign key constraints are deferred until commit, and we
+        # always roll back, so these user IDs don't need to exist; we
+        # just need them not to collide with existing rows.
+        first_user_id = 1 + (UserMessage.objects.order_by('user_profile_id')
+                             .values_list('user_profile_id', flat=True).last() or 0)
+        flags = int(UserMessage.flags.read)
+
+        def measure(insert: Callable[[List[UserMessageLite]], None],
+                    ums: List[UserMessageLite]) -> float:
+            best = float('inf')
+            for i in range(options['repeat']):
+                with transaction.atomic():
+                    start = time.perf_counter()
+                    insert(ums)
+                    best = min(best, time.perf_counter() - start)
+                    transaction.set_rollback(True)
+            return best
+
+        for num_recipients in [int(n) for n in options['recipients'].split(',')]:
+            ums = [
+                UserMessageLite(user_profile_id=first_user_id + i, message_id=message.id,
+                                flags=flags if i % 2 else 0)
+                for i in range(num_recipients)
+            ]
+            values_time = measure(values_insert_ums, ums)
+            copy_time = measure(copy_insert_ums, ums)
+            self.stdout.write(
+                f'{num_recipients:>8} recipients: INSERT {values_time * 1000:9.2f}ms, '
+                f'COPY {copy_time * 1000:9.2f}ms ({values_time / copy_time:.1f}x)'
+            )
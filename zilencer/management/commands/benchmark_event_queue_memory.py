@@ -0,0 +1,130 @@
+import gc
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.narrow import build_narrow_filter
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue
+
+
+def sample_events(count: int) -> List[Dict[str, Any]]:
+    # Shaped like the message and presence events an idle mobile
+    # client accumulates; the same event object is pushed to every
+    # queue, as process_event does.
+    events: List[Dict[str, Any]] = []
+    for i in range(count):
+        if i % 2 == 0:
+            events.append(dict(
+                type='message',
+                message=dict(id=i, sender_id=10, content='<p>hello</p>',
+                             display_recipient='Denmark', subject='topic'),
+            ))
+        else:
+            events.append(dict(
+                type='presence',
+                user_id=10,
+                server_timestamp=time.time(),
+                presence={'website': {'status': 'active', 'timestamp': 1}},
+            ))
+    return events
+
+class LegacyEventQueue:
+    # EventQueue before it had __slots__, storing a private copy of
+    # each event with the queue's event id added.
+    def __init__(self, id: str) -> None:
+        self.queue: Deque[Dict[str, Any]] = deque()
+        self.next_event_id = 0
+        self.newest_pruned_id: Optional[int] = -1
+        self.id = id
+        self.virtual_events: Dict[str, Dict[str, Any]] = {}
+
+    def push(self, event: Dict[str, Any]) -> None:
+        event = dict(event)
+        event['id'] = self.next_event_id
+        self.next_event_id += 1
+        self.queue.append(event)
+
+class LegacyClientDescriptor:
+    # ClientDescriptor before it had __slots__.
+    def __init__(self, queue_id: int) -> None:
+        self.user_profile_id = queue_id
+        self.realm_id = 1
+        self.current_handler_id: Optional[int] = None
+        self.current_client_name: Optional[str] = None
+        self.event_queue = LegacyEventQueue(str(queue_id))
+        self.event_types = None
+        self.last_connection_time = time.time()
+        self.apply_markdown = True
+        self.client_gravatar = True
+        self.slim_presence = False
+        self.all_public_streams = False
+        self.client_type_name = 'ZulipMobile'
+        self._timeout_handle: Any = None
+        self.narrow: List[List[str]] = []
+        self.narrow_filter = build_narrow_filter([])
+        self.bulk_message_deletion = False
+
+def make_client(queue_id: int) -> ClientDescriptor:
+    return ClientDescriptor(
+        user_profile_id=queue_id,
+        realm_id=1,
+        event_queue=EventQueue(str(queue_id)),
+        event_types=None,
+        client_type_name='ZulipMobile',
+    )
+
+def measure(build: Callable[[], List[Any]]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    retained = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del retained
+    return after - before
+
+class Command(BaseCommand):
+    help = """Measure the memory cost per Tornado event queue.
+
+Compares the current compact representation (slotted descriptors,
+shared event payloads) against a copy-per-queue baseline emulating
+the previous storage format.
+
+Usage: ./manage.py benchmark_event_queue_memory [--queues=5000] [--events=20]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--queues', type=int, default=5000,
+                            help='Number of event queues to allocate')
+        parser.add_argument('--events', type=int, default=20,
+                            help='Number of pending events per queue')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_queues = options['queues']
+        events = sample_events(options['events'])
+
+        def build_legacy() -> List[Any]:
+            clients: List[LegacyClientDescriptor] = []
+            for queue_id in range(num_queues):
+                client = LegacyClientDescriptor(queue_id)
+                for event in events:
+                    client.event_queue.push(event)
+                clients.append(client)
+            return clients
+
+        def build_compact() -> List[Any]:
+            clients: List[ClientDescriptor] = []
+            for queue_id in range(num_queues):
+                client = make_client(queue_id)
+                for event in events:
+                    client.event_queue.push(event)
+                clients.append(client)
+            return clients
+
+        legacy = measure(build_legacy)
+        compact = measure(build_compact)
+        self.stdout.write(f'{num_queues} queues with {len(events)} pending events each')
+        self.stdout.write(f'copy-per-queue: {legacy // num_queues} bytes/queue')
+        self.stdout.write(f'compact:        {compact // num_queues} bytes/queue')
@@ -0,0 +1,79 @@
+import re
+import time
+from typing import Any, Callable, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import build_engine, prepare_realm_pattern, realm_filter_matcher_for
+
+# A key for the Markdown engines we build here, which isn't any
+# realm's ID or one of the special keys zerver.lib.markdown uses.
+BENCHMARK_MARKDOWN_KEY = -100
+
+class Command(BaseCommand):
+    help = """Measure how the cost of applying a realm's linkifiers
+(realm filters) grows with the number of linkifiers.
+
+Renders a message with a Markdown engine built for N synthetic
+linkifiers, and finds the linkifiers in a topic both with the combined
+matcher and by trying each linkifier's pattern in turn.  Doesn't
+access the database.
+
+Usage: ./manage.py benchmark_linkifiers [--linkifiers=1,10,50,100,200] [--repeat=1000]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--linkifiers', default='1,10,50,100,200',
+                            help='Comma-separated linkifier counts to measure')
+        parser.add_argument('--repeat', type=int, default=1000,
+                            help='Number of renders at each count')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        repeat = options['repeat']
+
+        def measure(func: Callable[[], Any]) -> float:
+            start = time.perf_counter()
+            for i in range(repeat):
+                func()
+            return (time.perf_counter() - start) / repeat
+
+        for num_linkifiers in [int(n) for n in options['linkifiers'].split(',')]:
+            realm_filters: List[Tuple[str, str, int]] = [
+                (f'PROJ{i}-(?P<id>[0-9]+)', f'https://tracker.example.com/proj{i}/%(id)s', i)
+                for i in range(num_linkifiers)
+            ]
+            last = num_linkifiers - 1
+            content = (f'Fixed PROJ0-123 and PROJ{last}-456 in the latest deploy; '
+                       'see the **release notes** for the details, and '
+                       'https://example.com/changelog for everything else.')
+            topic = f'PROJ{last}-456 follow-up (was PROJ0-123)'
+
+            engine = build_engine(realm_filters, BENCHMARK_MARKDOWN_KEY, email_gateway=False)
+
+            def render() -> None:
+                engine.reset()
+                engine.zulip_message = None
+                engine.zulip_realm = None
+                engine.zulip_db_data = None
+                engine.image_preview_enabled = False
+                engine.url_embed_preview_enabled = False
+                engine.convert(content)
+
+            patterns = [re.compile(prepare_realm_pattern(pattern)) for pattern, url, id in realm_filters]
+
+            def match_each() -> None:
+                for pattern in patterns:
+                    list(pattern.finditer(topic))
+
+            matcher = realm_filter_matcher_for(realm_filters)
+
+            def match_combined() -> None:
+                list(matcher.regex.finditer(topic))
+
+            render_time = measure(render)
+            each_time = measure(match_each)
+            combined_time = measure(match_combined)
+            self.stdout.write(
+                f'{num_linkifiers:>5} linkifiers: render {render_time * 1000:7.3f}ms, '
+                f'topic per-linkifier {each_time * 1e6:8.1f}us, '
+                f'combined {combined_time * 1e6:8.1f}us'
+            )
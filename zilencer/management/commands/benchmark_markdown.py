@@ -0,0 +1,148 @@
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+import orjson
+from django.conf import settings
+from django.core.management.base import CommandError, CommandParser
+
+from zerver.lib.exceptions import MarkdownRenderingException
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import do_render_markdown
+from zerver.models import (
+    Message,
+    UserProfile,
+    per_request_realm_filters_cache,
+)
+
+CORPUS_PATH = os.path.join(settings.DEPLOY_ROOT, 'zerver/tests/fixtures/markdown_benchmark_corpus.json')
+
+def percentile(sorted_times: List[float], fraction: float) -> float:
+    return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * fraction))]
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark Markdown rendering against a versioned corpus of
+representative messages: code blocks, mentions, linkifiers, tables,
+emoji, TeX, quotes and pathological inputs.
+
+Each message is rendered through markdown_convert as if sent by the
+given user in the given realm (by default, the first active human in
+the realm), with the corpus's linkifiers swapped in for the realm's
+in this process only.  Reports messages/second and p50/p99 latency,
+overall and per category, and peak memory (measured in a separate
+pass, since tracing allocations slows rendering down).  Nothing is
+written to the database.
+
+Usage: ./manage.py benchmark_markdown -r zulip [--repeat=20] [--category=tables]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--corpus', default=CORPUS_PATH,
+                            help='Path to the corpus JSON file')
+        parser.add_argument('--sender',
+                            help='Email of the user to render the messages as')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Number of passes over the corpus')
+        parser.add_argument('--category', action='append',
+                            help='Only render messages in this category (can be repeated)')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON, for comparing runs')
+        self.add_realm_args(parser, True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+
+        with open(options['corpus'], 'rb') as f:
+            corpus = orjson.loads(f.read())
+        messages: List[Tuple[str, str, str]] = [
+            (entry['name'], entry['category'],
+             entry['input'] * entry.get('repeat', 1) + entry.get('suffix', ''))
+            for entry in corpus['messages']
+            if not options['category'] or entry['category'] in options['category']
+        ]
+        if not messages:
+            raise CommandError("No messages in the corpus match the given categories.")
+
+        if options['sender']:
+            sender = self.get_user(options['sender'], realm)
+        else:
+            sender = UserProfile.objects.filter(
+                realm=realm, is_active=True, is_bot=False).order_by('id').first()
+            if sender is None:
+                raise CommandError("The realm has no active users to render messages as.")
+
+        # realm_filters_for_realm checks this per-process cache first,
+        # so this uses the corpus's linkifiers without touching the
+        # database or the remote cache.
+        per_request_realm_filters_cache[realm.id] = [
+            (pattern, url_format_string, -i)
+            for i, (pattern, url_format_string) in enumerate(corpus['linkifiers'], start=1)
+        ]
+        failures: Dict[str, int] = defaultdict(int)
+
+        def render(name: str, content: str) -> None:
+            message = Message(sender=sender)
+            try:
+                do_render_markdown(message, content, realm, sent_by_bot=False,
+                                   translate_emoticons=False)
+            except MarkdownRenderingException:
+                failures[name] += 1
+
+        # Warm up the Markdown engines and caches.
+        for name, category, content in messages:
+            render(name, content)
+
+        times: Dict[str, List[float]] = defaultdict(list)
+        start = time.perf_counter()
+        for i in range(options['repeat']):
+            for name, category, content in messages:
+                render_start = time.perf_counter()
+                render(name, content)
+                times[category].append(time.perf_counter() - render_start)
+        total_time = time.perf_counter() - start
+
+        tracemalloc.start()
+        for name, category, content in messages:
+            render(name, content)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        def summarize(category_times: List[float], elapsed: float) -> Dict[str, float]:
+            sorted_times = sorted(category_times)
+            return {
+                'messages': len(sorted_times),
+                'messages_per_second': len(sorted_times) / elapsed,
+                'p50_ms': percentile(sorted_times, 0.5) * 1000,
+                'p99_ms': percentile(sorted_times, 0.99) * 1000,
+            }
+
+        all_times = [t for category_times in times.values() for t in category_times]
+        results: Dict[str, Any] = {
+            'corpus_version': corpus['version'],
+            'realm': realm.string_id,
+            'overall': summarize(all_times, total_time),
+            'categories': {
+                category: summarize(category_times, sum(category_times))
+                for category, category_times in sorted(times.items())
+            },
+            'peak_memory_kb': peak_memory / 1024,
+            'failures': dict(failures),
+        }
+
+        if options['json']:
+            self.stdout.write(orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
+            return
+
+        self.stdout.write(f"Corpus version {results['corpus_version']}, "
+                          f"{len(messages)} messages x {options['repeat']} passes")
+        self.stdout.write(f'{"category":<16} {"messages":>9} {"msgs/s":>10} {"p50 ms":>9} {"p99 ms":>9}')
+        for category, summary in [('overall', results['overall']), *results['categories'].items()]:
+            self.stdout.write(
+                f"{category:<16} {summary['messages']:>9} {summary['messages_per_second']:>10.1f} "
+                f"{summary['p50_ms']:>9.2f} {summary['p99_ms']:>9.2f}"
+            )
+        self.stdout.write(f"Peak traced memory while rendering: {results['peak_memory_kb']:.0f} KiB")
+        for name, count in sorted(failures.items()):
+            self.stdout.write(f'{name} failed to render {count} times')
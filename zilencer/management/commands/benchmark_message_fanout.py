@@ -0,0 +1,73 @@
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from zerver.lib.message import MessageDict
+from zerver.models import Message, Recipient, get_stream_by_id_in_realm
+from zerver.tornado.event_queue import (
+    allocate_client_descriptor,
+    clear_client_event_queues,
+    process_message_event,
+)
+
+
+class Command(BaseCommand):
+    help = """Measure how long Tornado takes to deliver one message event
+to the event queues of a stream's subscribers.
+
+Allocates one event queue per synthetic subscriber in this process
+(not in the running Tornado server), then times process_message_event
+for the most recent stream message in the database.
+
+Usage: ./manage.py benchmark_message_fanout [--subscribers=100,1000,10000] [--repeat=10]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--subscribers', default='100,1000,10000',
+                            help='Comma-separated subscriber counts to measure')
+        parser.add_argument('--repeat', type=int, default=10,
+                            help='Number of messages to deliver at each size')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message = Message.objects.filter(recipient__type=Recipient.STREAM).order_by('id').last()
+        if message is None:
+            raise CommandError("This benchmark needs at least one stream message in the database.")
+        realm_id = message.sender.realm_id
+        stream = get_stream_by_id_in_realm(message.recipient.type_id, message.sender.realm)
+        wide_dict = MessageDict.wide_dict(message)
+
+        for num_subscribers in [int(n) for n in options['subscribers'].split(',')]:
+            clear_client_event_queues()
+            for user_id in range(num_subscribers):
+                allocate_client_descriptor(dict(
+                    user_profile_id=user_id,
+                    realm_id=realm_id,
+                    event_types=None,
+                    client_type_name='website',
+                    apply_markdown=user_id % 2 == 0,
+                    client_gravatar=True,
+                    slim_presence=False,
+                    all_public_streams=False,
+                    queue_timeout=0,
+                ))
+            users: List[Dict[str, Any]] = [
+                dict(id=user_id, flags=[] if user_id % 10 else ['read'])
+                for user_id in range(num_subscribers)
+            ]
+            event_template = dict(
+                type='message',
+                message_dict=wide_dict,
+                realm_id=realm_id,
+                stream_name=stream.name,
+                invite_only=stream.invite_only,
+                presence_idle_user_ids=[],
+            )
+
+            start = time.perf_counter()
+            for i in range(options['repeat']):
+                process_message_event(event_template, users)
+            elapsed = (time.perf_counter() - start) / options['repeat']
+            self.stdout.write(
+                f'{num_subscribers:>8} subscribers: {elapsed * 1000:8.2f}ms per message, '
+                f'{elapsed * 1000000 / num_subscribers:6.2f}us per subscriber'
+            )
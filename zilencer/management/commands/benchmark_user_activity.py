@@ -0,0 +1,72 @@
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+
+from zerver.lib.actions import do_update_user_activity
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import Client, UserProfile
+from zerver.worker.queue_processors import UserActivityWorker
+
+QUERIES = ['get_events', 'send_message', 'update_message_flags', 'get_messages',
+           'set_typing_status', 'update_presence']
+
+class Command(BaseCommand):
+    help = """Measure how long UserActivityWorker takes to process a batch
+of user_activity events.
+
+Generates synthetic events for existing users and clients, and times
+consume_batch against a baseline doing one do_update_user_activity
+call per deduplicated row.  All database changes are rolled back.
+
+Usage: ./manage.py benchmark_user_activity [--events=100000] [--users=1000]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--events', type=int, default=100000,
+                            help='Number of synthetic events to process')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Maximum number of distinct users to generate events for')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        user_ids = list(UserProfile.objects.values_list('id', flat=True)[:options['users']])
+        client_ids = list(Client.objects.values_list('id', flat=True)[:10])
+        if not user_ids or not client_ids:
+            raise CommandError("This benchmark needs users and clients in the database.")
+
+        now = time.time()
+        rand = random.Random(42)
+        events: List[Dict[str, Any]] = [
+            dict(
+                user_profile_id=rand.choice(user_ids),
+                client_id=rand.choice(client_ids),
+                query=rand.choice(QUERIES),
+                time=now - rand.random() * 600,
+            )
+            for i in range(options['events'])
+        ]
+
+        def run_per_row() -> None:
+            uncommitted_events: Dict[Tuple[int, int, str], Tuple[int, float]] = {}
+            for event in events:
+                key_tuple = (event['user_profile_id'], event['client_id'], event['query'])
+                count, event_time = uncommitted_events.get(key_tuple, (0, 0.0))
+                uncommitted_events[key_tuple] = (count + 1, max(event_time, event['time']))
+            for (user_profile_id, client_id, query), (count, event_time) in uncommitted_events.items():
+                do_update_user_activity(user_profile_id, client_id, query, count,
+                                        timestamp_to_datetime(event_time))
+
+        def run_bulk() -> None:
+            UserActivityWorker().consume_batch(events)
+
+        for name, func in [('per-row updates', run_per_row), ('bulk upsert', run_bulk)]:
+            with transaction.atomic():
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                transaction.set_rollback(True)
+            self.stdout.write(
+                f'{name:>16}: {elapsed * 1000:9.2f}ms for {len(events)} events '
+                f'({len(events) / elapsed:,.0f} events/s)'
+            )
@@ -0,0 +1,68 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import enable_markdown_profiling
+from zerver.lib.markdown import profiler as markdown_profiler
+from zerver.lib.message import render_markdown
+from zerver.models import Message
+
+
+class Command(BaseCommand):
+    help = """Render messages with per-extension Markdown profiling, and
+report how much time each preprocessor, inline pattern and processor
+took.
+
+Renders either the given messages (e.g. the IDs of slow renders logged
+by the MARKDOWN_PROFILING mode) or the most recent ones.  Nothing is
+saved.  The "treeprocessors/inline" time includes the time of all the
+inline patterns.
+
+Usage: ./manage.py profile_markdown [--message-ids=1,2,3] [--amount=1000] [--repeat=1]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--message-ids',
+                            help='Comma-separated IDs of the messages to render')
+        parser.add_argument('--amount', type=int, default=1000,
+                            help='Number of recent messages to render, if no IDs are given')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Number of times to render each message')
+        parser.add_argument('--top', type=int, default=25,
+                            help='Number of extensions to report')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options['message_ids']:
+            message_ids = [int(message_id) for message_id in options['message_ids'].split(',')]
+            messages: List[Message] = list(Message.objects.filter(id__in=message_ids).order_by('id'))
+        else:
+            messages = list(Message.objects.order_by('-id')[:options['amount']])
+
+        enable_markdown_profiling()
+        # Build the engines before we start counting.
+        for message in messages[:1]:
+            render_markdown(message, message.content)
+        markdown_profiler.reset_profile()
+
+        start = time.perf_counter()
+        for i in range(options['repeat']):
+            for message in messages:
+                render_markdown(message, message.content)
+        total_time = time.perf_counter() - start
+        renders = len(messages) * options['repeat']
+
+        self.stdout.write(f'Rendered {renders} messages in {total_time:.3f}s')
+        self.stdout.write(f'{"extension":<45} {"calls":>10} {"total ms":>10} {"us/call":>10} {"share":>7}')
+        for name, stats in markdown_profiler.get_extension_stats()[:options['top']]:
+            per_call = stats.time / stats.calls * 1e6 if stats.calls else 0.0
+            share = stats.time / total_time * 100 if total_time else 0.0
+            self.stdout.write(
+                f'{name:<45} {stats.calls:>10} {stats.time * 1000:>10.1f} '
+                f'{per_call:>10.1f} {share:>6.1f}%'
+            )
+
+        if markdown_profiler.slow_render_samples:
+            self.stdout.write('\nSlow renders:')
+            for sample in markdown_profiler.slow_render_samples:
+                slowest = ', '.join(name for name, extension_time in sample.extension_times[:3])
+                self.stdout.write(f'  message {sample.message_id}: {sample.time:.3f}s ({slowest})')
@@ -254,6 +254,24 @@ REALM_MOBILE_REMAP_URIS: Dict[str, str] = {}
 # testing.
 USING_PGROONGA = False
 
+# Whether to cache rendered Markdown in memcached, keyed by the
+# content and everything else its rendering depends on, for content
+# without mentions, stream links or alert words.  Useful on servers
+# where bots and integrations send a lot of identical messages.
+MARKDOWN_RENDER_CACHE = False
+
+# Whether to time each Markdown preprocessor, pattern and processor,
+# logging a breakdown of slow renders; see zerver/lib/markdown/profiler.py.
+MARKDOWN_PROFILING = False
+
+# The number of threads fetch_initial_state_data uses to fetch the
+# expensive sections of the /register response concurrently; 1 fetches
+# them one after another.  Each thread keeps its own database
+# connection, so each Django process can use this many more
+# connections to PostgreSQL.  Requires uWSGI's enable-threads option,
+# which our uwsgi.ini sets.
+INITIAL_STATE_FETCH_THREADS = 1
+
 # How Django should send emails.  Set for most contexts in settings.py, but
 # available for sysadmin override in unusual cases.
 EMAIL_BACKEND: Optional[str] = None